@@ -5,9 +5,12 @@ Author  : Matthew Holsey
 """
 
 
-import re
+import json
 import os
 
+from VendingMachineDir.MachineRegistry import is_safe_id
+from VendingMachineDir.ProductCatalog import ProductCatalog
+from VendingMachineDir.StateLoader import load_state_file
 from VendingMachineDir.VM_globals import Globals
 
 
@@ -19,62 +22,102 @@ class ArgHandler:
     def parse_args(self, arguments):
         if arguments.state_file:
             self.handle_state_file(arguments)
+        if arguments.product_file:
+            self.handle_product_file(arguments)
+        # After the state file, so recovered state replaces the start-up state
+        if arguments.journal_dir:
+            self.handle_journal_dir(arguments)
 
     def handle_state_file(self, arguments):
         """
         Function to add new vending machine 'state' on startup.
-        Checking for file existence, reading and checking format
+        Checking for file existence, then loading csv, json or binary state
+        for the default machine and any machine ids in the file
 
-        If successful, the global vending machine variable will
-        contain a new default state for this instance of the program.
+        If successful, each machine in the file will contain a new default
+        state for this instance of the program. Coins missing from the file
+        keep their current default quantity.
 
         :param arguments: ArgParse arguments passed to program
         """
-        if os.path.isfile(arguments.state_file):
-            # Use context so we don't leave file open
-            with open(arguments.state_file, 'r') as infile:
-                for line in infile:
-
-                    # removing trailing chars / Whitespace
-                    line = str(line).strip()
-
-                    # Use handle deposit for each line
-                    if not self.check_csv_line(line):
-                        continue
-
-                    # CSV line in form 'Coin:Quantity'
-                    coin_value = line.split(",")
-                    if int(coin_value[0]) in Globals.v_machine.default_state:
-                        # As we're setting the new state, this is overridden, not appended to
-                        Globals.v_machine.default_state[int(coin_value[0])] = int(coin_value[1])
-                    else:
-                        print(f"Coin '{coin_value[0]}', does not exist!")
+        if not os.path.isfile(arguments.state_file):
+            print(f"Could not find file, is path correct? {arguments.state_file}")
+            return
+
+        result = load_state_file(arguments.state_file, Globals.v_machine.default_state.layout)
+        for line in result.summary():
+            print(line)
+        if result.errors:
+            self.error_flag = True
+
+        for machine_id, coins in result.machines.items():
+            if not Globals.machines.owns(machine_id):
+                # Served by another worker process
+                continue
+            machine = Globals.machines.create(machine_id)
+            # As we're setting the new state, this is overridden, not appended to
+            for coin, quantity in coins.items():
+                machine.default_state[coin] = quantity
 
             # Copy the new default state of coins in machine into current coins
-            Globals.v_machine.current_coins = Globals.v_machine.default_state.copy()
-            Globals.v_machine.current_change_total = Globals.v_machine.calc_current_change_total()
+            machine.reset_coins_to_default()
 
-        else:
-            print(f"Could not find file, is path correct? {arguments.state_file}")
+        if len(result.machines) > 1:
+            print(f"Loaded state for {len(result.machines)} machines from {arguments.state_file}")
+
+    def handle_product_file(self, arguments):
+        """
+        Function to load the products sold by slot id on startup, from a json file
 
-    def check_csv_line(self, line):
+            {"A1": {"price": 85, "quantity": 10, "name": "Crisps"}, ...}
+                Every machine, including machines created later, sells these
+            {"machines": {"machine_id": {"A1": {...}}}}
+                Products per machine
+
+        :param arguments: ArgParse arguments passed to program
         """
-        Check the line read from CSV file is formatted correctly
-        Prints any errors to terminal
+        if not os.path.isfile(arguments.product_file):
+            print(f"Could not find file, is path correct? {arguments.product_file}")
+            return
+
+        try:
+            with open(arguments.product_file, "r") as infile:
+                products = json.load(infile)
+            if isinstance(products, dict) and "machines" in products:
+                catalogs = {str(machine_id): ProductCatalog.from_dict(machine_products)
+                            for machine_id, machine_products in products["machines"].items()}
+            else:
+                Globals.machines.products = ProductCatalog.from_dict(products)
+                catalogs = {machine_id: Globals.machines.products for machine_id in Globals.machines.ids()}
+        except (ValueError, AttributeError) as e:
+            print(f"Could not load products from {arguments.product_file} : {e}")
+            self.error_flag = True
+            return
+
+        for machine_id, catalog in catalogs.items():
+            if not is_safe_id(machine_id):
+                print(f"{arguments.product_file} : Machine id '{machine_id}' must not be empty or hold "
+                      f"'..', '/', '\\' or ':', skipping its products")
+                self.error_flag = True
+                continue
+            if not Globals.machines.owns(machine_id):
+                # Served by another worker process
+                continue
+            Globals.machines.create(machine_id).products = catalog.copy()
+        print(f"Loaded products for {len(catalogs)} machines from {arguments.product_file}")
+
+    def handle_journal_dir(self, arguments):
+        """
+        Function to recover every machine from its journal on startup,
+        then keep journaling their changes in the same directory
 
-        :param line:    Str     : String line read from csv file
-        :return:        Boolean : True if correctly formatted else False
+        :param arguments: ArgParse arguments passed to program
         """
-        if not re.match("\d+,\d+", line):
-            print("Invalid line in csv, required form 'int,int'")
-            return False
-
-        coin_quantity = line.split(",")
-        for item in coin_quantity:
-            try:
-                x = int(item)
-            except ValueError:
-                print(f"value : '{item}' is invalid. Requires whole numbers")
-                return False
-
-        return True
+        Globals.machines.journal_dir = arguments.journal_dir
+        Globals.machines.journal_options = {"group_commit": arguments.durability == "group",
+                                            "fsync_interval": arguments.commit_window / 1000,
+                                            "fsync_batch": arguments.commit_batch}
+        for machine_id in Globals.machines.ids():
+            replayed = Globals.machines.attach_journal(machine_id, Globals.machines.get(machine_id))
+            if replayed:
+                print(f"Machine '{machine_id}' recovered, replayed {replayed} journal entries")
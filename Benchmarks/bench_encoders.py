@@ -0,0 +1,58 @@
+"""Benchmark encoding cost and payload size of each response format
+
+    > python -m Benchmarks.bench_encoders
+    > python -m Benchmarks.bench_encoders --json
+"""
+import json
+import timeit
+from argparse import ArgumentParser
+
+from Server.api_result import ApiResult
+from Server.encoders import available_formats, get_encoder
+
+
+def sample_results():
+    """
+    :return: Dict{str, ApiResult}   : Typical responses keyed by name
+    """
+    deposit = ApiResult("Successful deposit.", success=True, deposit_total=300)
+    purchase = ApiResult("Successful purchase.", success=True, change={200: 1, 50: 1, 20: 2, 5: 1, 2: 1})
+    machine = ApiResult("Machine state.", success=True,
+                        machine_coins={1: 5, 2: 5, 5: 5, 10: 5, 20: 5, 50: 5, 100: 5, 200: 5})
+    failure = ApiResult("Fail", success=False, errors=[f"Invalid key found in json : '{key}'" for key in range(10)])
+    batch = ApiResult("Successful batch.", success=True, deposit_total=0,
+                      results=[deposit, purchase] * 50)
+    return {"deposit": deposit, "purchase": purchase, "machine_coins": machine,
+            "errors": failure, "batch_100": batch}
+
+
+def run(number):
+    """
+    :param number:  int     : Encodes timed per format and sample
+    :return:        list    : Dict of format, sample, bytes and nanoseconds per encode
+    """
+    rows = []
+    for name in available_formats():
+        encoder = get_encoder(name)
+        for sample_name, result in sample_results().items():
+            seconds = min(timeit.repeat(lambda: encoder.encode(result), number=number, repeat=3))
+            rows.append({"format": name,
+                         "sample": sample_name,
+                         "bytes": len(encoder.encode(result)),
+                         "ns_per_encode": round(seconds / number * 1e9)})
+    return rows
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=2000, help="Encodes timed per format and sample")
+    parser.add_argument("--json", action="store_true", help="Print results as json")
+    args = parser.parse_args()
+
+    results = run(args.number)
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print(f"{'format':<10}{'sample':<16}{'bytes':>8}{'ns/encode':>12}")
+        for row in results:
+            print(f"{row['format']:<10}{row['sample']:<16}{row['bytes']:>8}{row['ns_per_encode']:>12}")
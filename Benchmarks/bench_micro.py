@@ -0,0 +1,138 @@
+"""Micro benchmarks for each stage of a purchase
+
+    parse       : parse_json_in_to_dict, per request size
+    change      : VendingMachine.subtract_value, per coin stock and change value
+    reach       : VendingMachine.can_make_change, per coin stock, 'warm' reads the
+                  reachable change bitset, 'rebuild' builds it again first
+    total       : VendingMachine.calc_current_change_total, per coin stock
+    format      : format_json_response, per error list size
+
+    > python -m Benchmarks.bench_micro
+    > python -m Benchmarks.bench_micro --filter change --json
+"""
+import json
+import timeit
+from argparse import ArgumentParser
+
+from Server.json_IO import format_json_response, parse_json_in_to_dict
+from VendingMachineDir.CoinInventory import GBP_LAYOUT
+from VendingMachineDir.VendingMachine import VendingMachine
+
+# Quantity of every coin held
+STOCKS = {"no_small_coins": {1: 0, 2: 0, 5: 1, 10: 1, 20: 1, 50: 1, 100: 1, 200: 1},
+          "default": {coin: 5 for coin in GBP_LAYOUT.coins},
+          "deep": {coin: 1000 for coin in GBP_LAYOUT.coins}}
+
+# Change given, in pence
+CHANGE_VALUES = (35, 385, 1995, 100000)
+
+ERROR_COUNTS = (0, 10, 100)
+
+BATCH_SIZES = (1, 10, 100)
+
+
+def timed(function, number):
+    """
+    :param function:    callable    : Call to time, takes no arguments
+    :param number:      int         : Calls per repeat
+    :return:            int         : Nanoseconds per call, best of 3 repeats
+    """
+    return round(min(timeit.repeat(function, number=number, repeat=3)) / number * 1e9)
+
+
+def bench_parse(number):
+    rows = []
+    purchase = {"deposit": {"coins": {"100": 1, "20": 1}}, "purchase": {"value": 85}}
+    for size in BATCH_SIZES:
+        request = json.dumps({"batch": [purchase] * size} if size > 1 else purchase).encode()
+        rows.append(("parse", f"batch of {size}", timed(lambda: parse_json_in_to_dict(request), number)))
+    return rows
+
+
+def bench_change(number):
+    rows = []
+    for stock_name, stock in STOCKS.items():
+        machine = VendingMachine(stock)
+        snapshot = machine.snapshot()
+        for value in CHANGE_VALUES:
+            if machine.find_change(value) is None:
+                continue
+
+            def restore():
+                machine.restore(snapshot)
+
+            def change():
+                machine.restore(snapshot)
+                machine.subtract_value(value)
+
+            # Each call puts the stock back first, that cost is taken off
+            overhead = timed(restore, number)
+            rows.append(("change", f"{stock_name} {value}p", timed(change, max(1, number // 50)) - overhead))
+    return rows
+
+
+def bench_reach(number):
+    rows = []
+    for stock_name, stock in STOCKS.items():
+        machine = VendingMachine(stock)
+
+        def rebuild():
+            machine._reachable = None
+            machine.can_make_change(385)
+
+        rows.append(("reach", f"{stock_name} warm", timed(lambda: machine.can_make_change(385), number)))
+        rows.append(("reach", f"{stock_name} rebuild", timed(rebuild, number)))
+    return rows
+
+
+def bench_total(number):
+    rows = []
+    for stock_name, stock in STOCKS.items():
+        machine = VendingMachine(stock)
+        rows.append(("total", stock_name, timed(machine.calc_current_change_total, number)))
+    return rows
+
+
+def bench_format(number):
+    rows = []
+    change = {200: 1, 50: 1, 20: 2, 5: 1, 2: 1}
+    for count in ERROR_COUNTS:
+        errors = [f"Invalid key found in json : '{key}'. Skipping value." for key in range(count)] or None
+        rows.append(("format", f"{count} errors",
+                     timed(lambda: format_json_response("Fail", False, add_change=change, errors=errors), number)))
+    return rows
+
+
+BENCHMARKS = {"parse": bench_parse, "change": bench_change, "reach": bench_reach, "total": bench_total,
+              "format": bench_format}
+
+
+def run(number, name_filter=None):
+    """
+    :param number:      int     : Calls timed per case
+    :param name_filter: str     : Only run benchmarks with this in their name
+    :return:            list    : Dict of benchmark, case and nanoseconds per call
+    """
+    rows = []
+    for name, benchmark in BENCHMARKS.items():
+        if name_filter and name_filter not in name:
+            continue
+        rows.extend({"benchmark": bench, "case": case, "ns_per_call": ns} for bench, case, ns in benchmark(number))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=2000, help="Calls timed per case")
+    parser.add_argument("-f", "--filter", help="Only run benchmarks with this in their name, e.g. " +
+                                               ", ".join(BENCHMARKS))
+    parser.add_argument("--json", action="store_true", help="Print results as json")
+    args = parser.parse_args()
+
+    results = run(args.number, args.filter)
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print(f"{'benchmark':<10}{'case':<24}{'ns/call':>12}")
+        for row in results:
+            print(f"{row['benchmark']:<10}{row['case']:<24}{row['ns_per_call']:>12}")
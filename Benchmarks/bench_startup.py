@@ -0,0 +1,95 @@
+"""Benchmark process start-up time, from launch to ready
+
+    > python -m Benchmarks.bench_startup
+    > python -m Benchmarks.bench_startup -n 20 --json
+
+check_state     : launch to exit of 'main.py --check_state'
+listen          : launch until the server accepts a connection
+listen_async    : as listen, with --async_server
+"""
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT, "main.py")
+STATE_FILE = os.path.join(ROOT, "Resources", "in.csv")
+
+
+def free_port():
+    """
+    :return: int    : TCP port nothing is listening on
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def time_exit(arguments):
+    """
+    :param arguments:   list    : Arguments for main.py
+    :return:            float   : Seconds from launch to exit
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, MAIN] + arguments, cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def time_listen(arguments, timeout=10):
+    """
+    :param arguments:   list    : Arguments for main.py, a port is added
+    :param timeout:     float   : Seconds to wait for the server
+    :return:            float   : Seconds from launch to the first accepted connection
+    """
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, MAIN, "--port", str(port)] + arguments, cwd=ROOT,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                socket.create_connection(("localhost", port), timeout=1).close()
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.001)
+        raise RuntimeError(f"Server did not start within {timeout} seconds")
+    finally:
+        process.kill()
+        process.wait()
+
+
+def run(number):
+    """
+    :param number:  int     : Launches per scenario
+    :return:        list    : Dict of scenario, min and median milliseconds
+    """
+    scenarios = {"check_state": lambda: time_exit(["--check_state", STATE_FILE]),
+                 "listen": lambda: time_listen([]),
+                 "listen_async": lambda: time_listen(["--async_server"])}
+    rows = []
+    for name, launch in scenarios.items():
+        times = [launch() for _ in range(number)]
+        rows.append({"scenario": name,
+                     "min_ms": round(min(times) * 1000, 1),
+                     "median_ms": round(statistics.median(times) * 1000, 1)})
+    return rows
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=10, help="Launches per scenario")
+    parser.add_argument("--json", action="store_true", help="Print results as json")
+    args = parser.parse_args()
+
+    results = run(args.number)
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print(f"{'scenario':<16}{'min ms':>10}{'median ms':>12}")
+        for row in results:
+            print(f"{row['scenario']:<16}{row['min_ms']:>10}{row['median_ms']:>12}")
@@ -0,0 +1,315 @@
+"""Load generator and latency benchmark for the socket api
+
+Drives a mix of deposit, purchase and invalid requests at a server on
+127.0.0.1, either at fixed concurrency (closed loop - each client sends its
+next request once the last is answered) or at a fixed rate (open loop -
+requests are sent on a schedule and latency is measured from the time
+they were due, so a stalled server shows up in the tail).
+
+    > python -m Benchmarks.load_test --start_server sync
+    > python -m Benchmarks.load_test --start_server async --rate 2000 --concurrency 16
+    > python -m Benchmarks.load_test --port 22222 --mix deposit=50,purchase=50 --keep_alive
+    > python -m Benchmarks.load_test --start_server async --json --output results.json
+    > python -m Benchmarks.load_test --start_server async --workers 4 --machines 16
+"""
+import json
+import math
+import socket
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+from Benchmarks.bench_startup import MAIN, ROOT, free_port
+
+# Request body sent for each kind of request in the mix
+# Purchases pay in the coins their change needs, so the machine never runs short
+REQUESTS = {"deposit": {"deposit": {"coins": {"100": 1}}},
+            "purchase": {"deposit": {"coins": {"100": 1, "20": 1, "10": 1, "5": 1}}, "purchase": {"value": 100}},
+            "invalid": {"purchase": {"value": 5}}}
+
+PERCENTILES = {"p50": 0.5, "p99": 0.99, "p999": 0.999}
+
+
+def parse_mix(mix):
+    """
+    :param mix:     str     : Weights per request kind, e.g. 'deposit=70,purchase=20,invalid=10'
+    :return:        list    : Request kinds, each repeated by its weight
+    """
+    kinds = []
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in REQUESTS:
+            raise ValueError(f"Unknown request kind '{kind}', expected one of {list(REQUESTS)}")
+        kinds.extend([kind] * int(weight or 1))
+    if not kinds:
+        raise ValueError("Request mix is empty")
+    return kinds
+
+
+def percentile(ordered, fraction):
+    """
+    :param ordered:     list    : Sorted samples
+    :param fraction:    float   : Percentile wanted, e.g. 0.99
+    :return:            float   : Nearest rank sample, 0 with no samples
+    """
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+class Client:
+    """One client thread's connection, a new socket per request unless keep_alive"""
+
+    def __init__(self, host, port, keep_alive, machine_id=None, timeout=10):
+        """
+
+        :param host:        str     : Server address
+        :param port:        int     : Server port
+        :param keep_alive:  Boolean : Send every request over one session
+        :param machine_id:  str     : 'machine_id' added to each request, None for the default machine
+        :param timeout:     float   : Seconds to wait for a response
+        """
+        self.address = (host, port)
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.payloads = {}
+        for kind, body in REQUESTS.items():
+            if machine_id is not None:
+                body = dict(body, machine_id=machine_id)
+            self.payloads[kind] = json.dumps(body, separators=(",", ":")).encode() + b"\n"
+
+    def request(self, kind):
+        """
+        :param kind:    str         : Request kind from REQUESTS
+        :return:        Boolean     : 'success' value of the response
+        """
+        if not self.keep_alive:
+            with socket.create_connection(self.address, timeout=self.timeout) as sock:
+                sock.sendall(self.payloads[kind])
+                chunks = []
+                while True:
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            return json.loads(b"".join(chunks))["success"]
+
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address, timeout=self.timeout)
+            self.reader = self.sock.makefile("rb")
+            self.sock.sendall(b'{"keep_alive":true,"format":"compact"}\n')
+            self.reader.readline()
+        self.sock.sendall(self.payloads[kind])
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Server closed the session")
+        return json.loads(line)["success"]
+
+    def close(self):
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+            self.sock = None
+
+
+def client_loop(client, kinds, offset, start, end, interval, samples):
+    """
+    Send requests until end, recording (kind, due time, latency, success or None on error)
+
+    :param client:      Client  : Connection to send on
+    :param kinds:       list    : Request mix, walked in order from offset
+    :param offset:      int     : This client's number, spreading clients over the mix
+    :param start:       float   : perf_counter time this client starts
+    :param end:         float   : perf_counter time the run ends
+    :param interval:    float   : Seconds between this client's requests, 0 for closed loop
+    :param samples:     list    : Shared list the samples are appended to
+    """
+    records = []
+    sent = 0
+    while True:
+        if interval:
+            due = start + sent * interval
+            now = time.perf_counter()
+            if due >= end:
+                break
+            if due > now:
+                time.sleep(due - now)
+        else:
+            due = time.perf_counter()
+            if due >= end:
+                break
+
+        kind = kinds[(offset + sent) % len(kinds)]
+        try:
+            success = client.request(kind)
+        except (OSError, ValueError, KeyError):
+            success = None
+            client.close()
+        records.append((kind, due, time.perf_counter() - due, success))
+        sent += 1
+    client.close()
+    samples.extend(records)
+
+
+def run(host, port, kinds, concurrency=8, duration=5, warmup=1, rate=0, keep_alive=False, machines=0):
+    """
+    :param host:        str     : Server address
+    :param port:        int     : Server port
+    :param kinds:       list    : Request mix from parse_mix
+    :param concurrency: int     : Client threads
+    :param duration:    float   : Seconds measured
+    :param warmup:      float   : Seconds run before measuring, not counted
+    :param rate:        float   : Requests per second over all clients, 0 for closed loop
+    :param keep_alive:  Boolean : Send each client's requests over one session
+    :param machines:    int     : Spread clients over machine ids "1" to "N", 0 for the default machine
+    :return:            Dict    : Throughput, latency percentiles and counts, overall and per kind
+    """
+    interval = concurrency / rate if rate else 0
+    samples = []
+    start = time.perf_counter()
+    measure_from = start + warmup
+    end = measure_from + duration
+
+    threads = []
+    for number in range(concurrency):
+        machine_id = str(number % machines + 1) if machines else None
+        client = Client(host, port, keep_alive, machine_id)
+        # Stagger open loop clients evenly across the interval
+        client_start = start + (number * interval / concurrency if interval else 0)
+        thread = threading.Thread(target=client_loop,
+                                  args=(client, kinds, number, client_start, end, interval, samples))
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    measured = [sample for sample in samples if sample[1] >= measure_from]
+    results = {"config": {"host": host, "port": port, "concurrency": concurrency, "duration": duration,
+                          "warmup": warmup, "rate": rate, "keep_alive": keep_alive, "machines": machines,
+                          "mode": "open" if rate else "closed"},
+               "commit": git_commit()}
+    results.update(summarise(measured, duration))
+    results["by_kind"] = {kind: summarise([sample for sample in measured if sample[0] == kind], duration)
+                          for kind in sorted(set(kinds))}
+    return results
+
+
+def summarise(samples, duration):
+    """
+    :param samples:     list    : (kind, due time, latency, success) tuples
+    :param duration:    float   : Seconds the samples were taken over
+    :return:            Dict    : Counts, throughput and latency in milliseconds
+    """
+    latencies = sorted(sample[2] for sample in samples)
+    latency_ms = {name: round(percentile(latencies, fraction) * 1000, 3) for name, fraction in PERCENTILES.items()}
+    latency_ms["max"] = round(latencies[-1] * 1000, 3) if latencies else 0
+    latency_ms["mean"] = round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0
+    return {"requests": len(samples),
+            "succeeded": sum(1 for sample in samples if sample[3] is True),
+            "failed": sum(1 for sample in samples if sample[3] is False),
+            "errors": sum(1 for sample in samples if sample[3] is None),
+            "throughput_rps": round(len(samples) / duration, 1),
+            "latency_ms": latency_ms}
+
+
+def git_commit():
+    """
+    :return: str    : Commit of the code being measured, None outside a git checkout
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(server, port, machines, timeout=10, workers=1):
+    """
+    Launch main.py on a port and wait for it to accept connections
+
+    :param server:      str     : 'sync' or 'async'
+    :param port:        int     : Port to listen on
+    :param machines:    int     : Extra machines to serve
+    :param timeout:     float   : Seconds to wait for the server
+    :param workers:     int     : Worker processes, more than 1 always uses the asyncio server
+    :return:            Popen   : Server process, kill once done
+    """
+    arguments = [sys.executable, MAIN, "--port", str(port), "--machines", str(machines)]
+    if server == "async":
+        arguments.append("--async_server")
+    if workers > 1:
+        # Private ports for forwarding between workers, clear of the free port picked
+        arguments.extend(["--workers", str(workers), "--worker_port", str(free_port())])
+    process = subprocess.Popen(arguments, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.01)
+    process.terminate()
+    raise RuntimeError(f"Server did not start within {timeout} seconds")
+
+
+def print_table(results):
+    print(f"{results['config']['mode']} loop, {results['config']['concurrency']} clients, "
+          f"{results['throughput_rps']} requests/s, {results['errors']} errors")
+    print(f"{'kind':<10}{'requests':>10}{'ok':>8}{'fail':>8}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}")
+    rows = dict(results["by_kind"], all=results)
+    for kind, row in rows.items():
+        latency = row["latency_ms"]
+        print(f"{kind:<10}{row['requests']:>10}{row['succeeded']:>8}{row['failed']:>8}"
+              f"{latency['p50']:>10}{latency['p99']:>10}{latency['p999']:>10}")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", help="Server address")
+    parser.add_argument("-p", "--port", type=int, default=22222, help="Server port")
+    parser.add_argument("--start_server", choices=("sync", "async"),
+                        help="Launch main.py on a free port for the run instead of using --port")
+    parser.add_argument("--mix", default="deposit=60,purchase=30,invalid=10",
+                        help="Request kinds and weights, from " + ", ".join(REQUESTS))
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="Client threads")
+    parser.add_argument("-d", "--duration", type=float, default=5, help="Seconds measured")
+    parser.add_argument("-w", "--warmup", type=float, default=1, help="Seconds run before measuring")
+    parser.add_argument("-r", "--rate", type=float, default=0,
+                        help="Open loop requests per second over all clients, 0 for closed loop")
+    parser.add_argument("--keep_alive", action="store_true", help="Send each client's requests over one session")
+    parser.add_argument("-m", "--machines", type=int, default=0,
+                        help="Spread clients over machine ids '1' to 'N'")
+    parser.add_argument("--workers", type=int, default=1, help="With --start_server, worker processes to start")
+    parser.add_argument("--json", action="store_true", help="Print results as json")
+    parser.add_argument("-o", "--output", help="Also write json results to this file")
+    args = parser.parse_args()
+
+    process = None
+    port = args.port
+    if args.start_server:
+        port = free_port()
+        process = start_server(args.start_server, port, args.machines, workers=args.workers)
+    try:
+        results = run(args.host, port, parse_mix(args.mix), args.concurrency, args.duration, args.warmup,
+                      args.rate, args.keep_alive, args.machines)
+    finally:
+        if process is not None:
+            # Not kill, the main process passes SIGTERM on to any workers
+            process.terminate()
+            process.wait()
+    if args.start_server:
+        results["config"]["server"] = args.start_server
+        results["config"]["workers"] = args.workers
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=4)
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_table(results)
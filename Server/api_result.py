@@ -0,0 +1,99 @@
+"""Result returned from the api handlers
+
+Handlers build an ApiResult and the server encodes it to bytes once, when
+it is written to the socket.
+"""
+
+
+class ApiResult:
+    def __init__(self, response, success, change=None, errors=None, deposit_total=None,
+                 machine_coins=None, results=None, stats=None, status=None, session=None):
+        """
+
+        :param response: String             : String containing action state
+        :param success: Boolean             : True if success else False
+        :param change: Dict                 : Dict containing change left from purchase
+        :param errors: str/list/dict        : Variable containing any errors
+        :param deposit_total: int           : Current deposit amount
+        :param machine_coins: Dict          : Dict containing coins in machine
+        :param results: list                : ApiResult for each operation in a batch
+        :param stats: Dict                  : Server counters and timings
+        :param status: Dict                 : Machine status, e.g. exact change only
+        :param session: str                 : Token of a session just opened
+        """
+        self.response = response
+        self.success = success
+        self.change = change
+        self.errors = errors
+        self.deposit_total = deposit_total
+        self.machine_coins = machine_coins
+        self.results = results
+        self.stats = stats
+        self.status = status
+        self.session = session
+
+    def to_dict(self):
+        """
+        Dict in the layout documented for the api, ready to be encoded
+
+        :return: Dict
+        """
+        response_dict = {"response": self.response,
+                         "success": self.success}
+
+        if self.change and isinstance(self.change, dict):
+            # Adds a dict of the coins
+            response_dict["coins"] = self.change
+
+        if self.deposit_total:
+            response_dict["deposit_total"] = self.deposit_total
+
+        if self.machine_coins and isinstance(self.machine_coins, dict):
+            response_dict["machine_coins"] = self.machine_coins
+
+        if self.results is not None:
+            response_dict["results"] = [result.to_dict() for result in self.results]
+
+        if self.stats is not None:
+            response_dict["stats"] = self.stats
+
+        if self.status is not None:
+            response_dict["status"] = self.status
+
+        if self.session is not None:
+            response_dict["session"] = self.session
+
+        if self.errors:
+            errors_dict = {}
+            if isinstance(self.errors, list):
+                for index, item in enumerate(self.errors):
+                    errors_dict[index] = item
+            if isinstance(self.errors, dict):
+                errors_dict = self.errors
+            if isinstance(self.errors, str):
+                errors_dict[1] = self.errors
+            response_dict["errors"] = errors_dict
+
+        return response_dict
+
+    @classmethod
+    def from_dict(cls, response_dict):
+        """
+        Rebuild a result from its decoded dict, e.g. a response relayed from another worker
+
+        :param response_dict: Dict          : Dict in the layout made by to_dict
+        :return: ApiResult
+        """
+        def coins(value):
+            return {int(coin): quantity for coin, quantity in value.items()} if value else None
+
+        results = response_dict.get("results")
+        return cls(response_dict["response"], response_dict["success"],
+                   change=coins(response_dict.get("coins")),
+                   errors=response_dict.get("errors"),
+                   deposit_total=response_dict.get("deposit_total"),
+                   machine_coins=coins(response_dict.get("machine_coins")),
+                   results=[cls.from_dict(result) for result in results] if results is not None else None,
+                   stats=response_dict.get("stats"),
+                   status=response_dict.get("status"),
+                   session=response_dict.get("session"))
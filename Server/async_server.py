@@ -0,0 +1,250 @@
+"""Asyncio server class
+Accepts many connections concurrently on the same api as Server
+
+Connections are read and written on the event loop, the api handlers run
+on a small thread pool so the vending machine lock serialises coin state
+changes without stalling the other sockets.
+"""
+import asyncio
+import functools
+import logging
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from Server.deadlines import ReadDeadline
+from Server.frame_decoder import FrameTooLargeError, JsonFrameDecoder
+from Server.api_result import ApiResult
+from Server.server_handler import Server
+from VendingMachineDir.VM_globals import Globals
+
+
+class AsyncServer(Server):
+    def __init__(self):
+        super().__init__()
+        # Pending connections allowed by the listening socket
+        self.backlog = 128
+        # Threads available to run api handlers
+        self.workers = 4
+        self.loop = None
+        self.executor = None
+        # WorkerRouter when run as one of several worker processes, None to serve every machine here
+        self.router = None
+
+    def init_server(self):
+        """
+        Function to setup the asyncio socket listener
+        Bound to port 22222
+        Accepts many connections at a time
+        Runs until the global running flag is cleared
+        """
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.start_metrics_endpoint()
+        # Workers share the port, the kernel spreads connections between them
+        servers = [await asyncio.start_server(self.handle_client, '127.0.0.1', self.tcp_port,
+                                              reuse_address=True, reuse_port=self.router is not None,
+                                              backlog=self.backlog)]
+        if self.router is not None:
+            # Requests forwarded by the other workers, for machines this worker owns
+            servers.append(await asyncio.start_server(
+                functools.partial(self.handle_client, forwarded=True), self.router.host,
+                self.router.private_port(self.router.index), reuse_address=True, backlog=self.backlog))
+        try:
+            while Globals.running:
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            for server in servers:
+                server.close()
+                await server.wait_closed()
+            if self.router is not None:
+                self.router.close()
+            self.executor.shutdown(wait=True)
+            self.stop_metrics_endpoint()
+
+    async def handle_client(self, reader, writer, forwarded=False):
+        """
+        Function to read a request from a client and write back the response
+
+        If the request asks for 'keep_alive' the connection is kept open for a
+        session of newline delimited requests
+
+        Closes connection on function finish
+
+        :param forwarded:   Boolean : Connection from another worker, its requests are never forwarded on
+        """
+        decoder = JsonFrameDecoder(self.max_frame_size)
+        encoder = self.encoder
+        self.metrics.increment("connections")
+        try:
+            json_dict = await self.read_request_async(reader, decoder, self.timeout)
+            if json_dict is None:
+                return
+            try:
+                encoder = self.select_encoder(json_dict, encoder)
+            except ValueError as e:
+                writer.write(self.encode(ApiResult("Fail", success=False, errors=str(e)), encoder))
+                return
+
+            response = await self.respond(json_dict, forwarded)
+            if self.wants_keep_alive(json_dict):
+                writer.write(self.encode(response, encoder, framed=True))
+                await self.serve_session(reader, writer, decoder, encoder, forwarded)
+            else:
+                writer.write(self.encode(response, encoder))
+
+        except FrameTooLargeError as e:
+            logging.warning(f"Request too large: {e}")
+            self.metrics.increment("errors_too_large")
+            writer.write(self.encode(ApiResult("Fail", success=False, errors=f"Value error: {e}"), encoder))
+        except ValueError as e:
+            logging.warning(f"Couldn't parse json from request: {e}")
+            self.metrics.increment("errors_parse")
+            writer.write(self.encode(ApiResult("Fail", success=False,
+                                               errors="Value error: Couldn't parse data read into json obj"), encoder))
+        except TimeoutError as e:
+            # Missed read deadlines get a response, a client too slow to read its response does not
+            deadline = getattr(e, "deadline", "write")
+            logging.warning(f"Timeout ({deadline}) - server")
+            self.metrics.increment(f"errors_timeout_{deadline}")
+            if deadline != "write":
+                writer.write(self.encode(ApiResult("Fail", success=False, errors=f"Timeout during read, {e}"),
+                                         encoder))
+        except asyncio.CancelledError:
+            # Server shutting down while the connection was open, e.g. a session from another worker
+            pass
+        except Exception as e:
+            # Only this connection is dropped, the other clients keep being served
+            logging.error(f"Unknown exception hit during parse of data: {e}")
+            self.metrics.increment("errors_unknown")
+        finally:
+            await self.close_writer(writer)
+
+    async def serve_session(self, reader, writer, decoder, encoder, forwarded=False):
+        """
+        Function to serve a keep alive session
+        Each request read gets one response back, text formats one per line
+
+        :param decoder: JsonFrameDecoder    : Decoder holding any requests already read
+        :param encoder: ResponseEncoder     : Response format for this connection
+        :param forwarded: Boolean           : Session from another worker
+        """
+        while Globals.running:
+            try:
+                json_dict = await self.read_request_async(reader, decoder, self.keep_alive_timeout)
+            except FrameTooLargeError as e:
+                logging.warning(f"Request too large: {e}")
+                self.metrics.increment("errors_too_large")
+                writer.write(self.encode(ApiResult("Fail", success=False, errors=f"Value error: {e}"), encoder,
+                                         framed=True))
+                return
+            except ValueError as e:
+                logging.warning(f"Couldn't parse json from request: {e}")
+                self.metrics.increment("errors_parse")
+                writer.write(self.encode(ApiResult(
+                    "Fail", success=False, errors="Value error: Couldn't parse data read into json obj"),
+                    encoder, framed=True))
+                continue
+            except TimeoutError as e:
+                logging.warning(f"Keep alive session timeout ({e.deadline}) - server")
+                self.metrics.increment(f"errors_timeout_{e.deadline}")
+                writer.write(self.encode(ApiResult("Fail", success=False, errors=f"Timeout during read, {e}"),
+                                         encoder, framed=True))
+                return
+            if json_dict is None:
+                # Client closed the session
+                return
+            try:
+                encoder = self.select_encoder(json_dict, encoder)
+            except ValueError as e:
+                writer.write(self.encode(ApiResult("Fail", success=False, errors=str(e)), encoder, framed=True))
+                continue
+
+            response = await self.respond(json_dict, forwarded)
+            writer.write(self.encode(response, encoder, framed=True))
+            # A client not reading its responses is cut off rather than buffered for
+            await asyncio.wait_for(writer.drain(), self.request_timeout)
+            if json_dict.get("keep_alive") is False:
+                return
+
+    async def respond(self, json_dict, forwarded=False):
+        """
+        Run a request on the thread pool, or forward it to the worker owning its machine
+
+        :param json_dict:   Dict        : dictionary containing json read from socket
+        :param forwarded:   Boolean     : Request came from another worker, so is always run here
+        :return:            ApiResult   : Result to send back on the socket
+        """
+        if self.router is not None and not forwarded and self.is_machine_request(json_dict):
+            machine_id = json_dict.get("machine_id")
+            if not self.router.owns(machine_id):
+                self.metrics.increment("forwarded")
+                start = time.perf_counter()
+                result = await self.router.forward(json_dict, self.request_timeout)
+                self.metrics.observe("forward", time.perf_counter() - start)
+                return result
+        if not self.is_machine_request(json_dict):
+            return await self.loop.run_in_executor(self.executor, self.handle_request, json_dict)
+
+        result, journal, seq = await self.loop.run_in_executor(self.executor, self.apply, json_dict)
+        if seq is not None:
+            # Waits on the event loop, so the pool thread is free for other machines meanwhile
+            start = time.perf_counter()
+            await journal.wait_durable_async(seq)
+            self.metrics.observe("journal_wait", time.perf_counter() - start)
+        return result
+
+    async def read_request_async(self, reader, decoder, timeout):
+        """
+        Read from the stream until the decoder holds a full json object
+
+        :param reader:  asyncio.StreamReader    : Stream for the client connection
+        :param decoder: JsonFrameDecoder        : Decoder for this connection
+        :param timeout: float                   : Seconds allowed for the request to start
+        :return:        Dict or None            : Request read, None if the client closed
+        :raises RequestTimeout                  : The header, idle or total deadline passed
+        """
+        start = time.perf_counter()
+        json_dict = decoder.next_frame()
+        parse_time = time.perf_counter() - start
+        deadline = ReadDeadline(timeout, self.idle_timeout, self.request_timeout)
+        if decoder.has_partial():
+            deadline.received()
+        while json_dict is None:
+            # Raises once a deadline has passed, kept out of the try as RequestTimeout is a TimeoutError
+            remaining = deadline.remaining()
+            try:
+                chunk = await asyncio.wait_for(reader.read(4096), remaining)
+            except asyncio.TimeoutError:
+                continue
+            if not chunk:
+                if decoder.has_partial():
+                    raise ValueError("Connection closed part way through a request")
+                return None
+            deadline.received()
+            decoder.feed(chunk)
+            parse_start = time.perf_counter()
+            json_dict = decoder.next_frame()
+            parse_time += time.perf_counter() - parse_start
+
+        self.metrics.observe("read", time.perf_counter() - start - parse_time)
+        self.metrics.observe("parse", parse_time)
+        return json_dict
+
+    async def close_writer(self, writer):
+        try:
+            await asyncio.wait_for(writer.drain(), self.request_timeout)
+        except asyncio.TimeoutError:
+            # Client is not reading, drop what is still buffered
+            writer.transport.abort()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,69 @@
+"""Deadlines for reading one request from a client
+
+    header  : The request must start within this time, the connection
+              timeout for a first request, the keep alive timeout after that
+    idle    : Once started, bytes must keep arriving, no gap longer than this
+    total   : Once started, the whole request must arrive within this time
+
+A client sending one byte at a time is cut off by the total deadline
+however often it sends, rather than holding the connection open for as
+long as it likes.
+"""
+import time
+
+MESSAGES = {"header": "no request received",
+            "idle": "request stalled",
+            "total": "request took too long"}
+
+
+class RequestTimeout(TimeoutError):
+    def __init__(self, deadline):
+        """
+
+        :param deadline:    str     : Deadline passed, 'header', 'idle' or 'total'
+        """
+        super().__init__(MESSAGES[deadline])
+        self.deadline = deadline
+
+
+class ReadDeadline:
+    __slots__ = ("started", "header_timeout", "idle_timeout", "request_timeout", "first_byte", "last_byte")
+
+    def __init__(self, header_timeout, idle_timeout, request_timeout):
+        """
+
+        :param header_timeout:  float   : Seconds allowed for the request to start
+        :param idle_timeout:    float   : Seconds allowed between bytes once started
+        :param request_timeout: float   : Seconds allowed for the whole request once started
+        """
+        self.started = time.monotonic()
+        self.header_timeout = header_timeout
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.first_byte = None
+        self.last_byte = None
+
+    def received(self):
+        """
+        Record bytes of the request arriving
+        """
+        now = time.monotonic()
+        if self.first_byte is None:
+            self.first_byte = now
+        self.last_byte = now
+
+    def remaining(self):
+        """
+        :return:            float   : Seconds until the nearest deadline
+        :raises RequestTimeout      : A deadline has passed
+        """
+        now = time.monotonic()
+        if self.first_byte is None:
+            left, deadline = self.started + self.header_timeout - now, "header"
+        else:
+            idle = self.last_byte + self.idle_timeout - now
+            total = self.first_byte + self.request_timeout - now
+            left, deadline = (idle, "idle") if idle < total else (total, "total")
+        if left <= 0:
+            raise RequestTimeout(deadline)
+        return left
@@ -0,0 +1,276 @@
+"""Response encoders, selected per connection with the '"format"' request key
+
+    json     : Indented json, the default response format
+    compact  : Json without whitespace
+    orjson   : Compact json using orjson, if installed
+    msgpack  : MessagePack, if installed
+    binary   : Fixed layout binary record, see BinaryEncoder
+
+Inside a keep alive session text formats are sent one per line, binary
+formats are prefixed with their length as a 4 byte big endian int.
+
+orjson and msgpack are only imported the first time their format is
+asked for, so start-up does not pay for packages no client uses.
+"""
+import importlib
+import json
+import struct
+
+from Server.json_IO import encode_response
+
+# Optional packages by name, None once an import has failed
+_optional_modules = {}
+
+
+def _optional_module(name):
+    """
+    :param name:    str     : Package to import on first use
+    :return:        module  : The package, None if it is not installed
+    """
+    if name not in _optional_modules:
+        try:
+            _optional_modules[name] = importlib.import_module(name)
+        except ImportError:
+            _optional_modules[name] = None
+    return _optional_modules[name]
+
+
+class ResponseEncoder:
+    name = None
+    # Package the encoder needs, None if only the standard library is used
+    requires = None
+    # True if the output never holds a newline, so sessions can send it as a line
+    line_safe = True
+
+    def encode(self, result):
+        """
+        :param result: ApiResult    : Result returned from an api handler
+        :return: bytes
+        """
+        raise NotImplementedError
+
+    def frame(self, result):
+        """
+        Encode a result for a keep alive session
+
+        :param result: ApiResult    : Result returned from an api handler
+        :return: bytes
+        """
+        data = self.encode(result)
+        if self.line_safe:
+            return data + b"\n"
+        return struct.pack("!I", len(data)) + data
+
+
+class JsonEncoder(ResponseEncoder):
+    name = "json"
+    line_safe = False
+
+    def encode(self, result):
+        return encode_response(result)
+
+    def frame(self, result):
+        # Indented json would span lines, sessions get the compact form
+        return CompactJsonEncoder().frame(result)
+
+
+class CompactJsonEncoder(ResponseEncoder):
+    name = "compact"
+
+    def encode(self, result):
+        return encode_response(result, indent=None)
+
+
+class OrjsonEncoder(ResponseEncoder):
+    name = "orjson"
+    requires = "orjson"
+
+    def __init__(self):
+        self.orjson = _optional_module(self.requires)
+
+    def encode(self, result):
+        # Coin and error dicts are keyed by int
+        return self.orjson.dumps(result.to_dict(), option=self.orjson.OPT_NON_STR_KEYS)
+
+
+class MsgpackEncoder(ResponseEncoder):
+    name = "msgpack"
+    requires = "msgpack"
+    line_safe = False
+
+    def __init__(self):
+        self.msgpack = _optional_module(self.requires)
+
+    def encode(self, result):
+        return self.msgpack.packb(result.to_dict())
+
+
+class BinaryEncoder(ResponseEncoder):
+    """
+    Fixed layout record, all ints big endian
+
+        header      : magic b"VM", version, flags, deposit total (int64),
+                      change / machine coin / error / result counts (uint16),
+                      response / session lengths (uint16), status / stats lengths (uint32)
+        response    : utf-8 bytes
+        session     : utf-8 bytes, token of a session just opened
+        status      : compact json bytes, machine status
+        stats       : compact json bytes, server counters and timings
+        change      : (denomination uint32, quantity uint32) per coin
+        machine     : (denomination uint32, quantity uint32) per coin
+        errors      : uint16 length then utf-8 bytes per error
+        results     : uint32 length then a nested record per batch result
+
+    flags - bit 0 success
+    A length of 0 means the field was not set
+    """
+    name = "binary"
+    line_safe = False
+
+    MAGIC = b"VM"
+    VERSION = 2
+    HEADER = struct.Struct("!2sBBqHHHHHHII")
+    COIN = struct.Struct("!II")
+    ERROR_LENGTH = struct.Struct("!H")
+    RESULT_LENGTH = struct.Struct("!I")
+
+    def encode(self, result):
+        response = str(result.response).encode()
+        session = result.session.encode() if result.session else b""
+        status = self._json(result.status)
+        stats = self._json(result.stats)
+        change = self._coins(result.change)
+        machine_coins = self._coins(result.machine_coins)
+        errors = self._errors(result.errors)
+        results = [self.encode(item) for item in result.results or []]
+
+        parts = [self.HEADER.pack(self.MAGIC, self.VERSION, 1 if result.success else 0,
+                                  int(result.deposit_total or 0), len(change), len(machine_coins),
+                                  len(errors), len(results), len(response), len(session), len(status),
+                                  len(stats)),
+                 response, session, status, stats]
+        parts.extend(self.COIN.pack(coin, quantity) for coin, quantity in change)
+        parts.extend(self.COIN.pack(coin, quantity) for coin, quantity in machine_coins)
+        for error in errors:
+            parts.append(self.ERROR_LENGTH.pack(len(error)))
+            parts.append(error)
+        for item in results:
+            parts.append(self.RESULT_LENGTH.pack(len(item)))
+            parts.append(item)
+        return b"".join(parts)
+
+    @staticmethod
+    def _json(value):
+        if value is None:
+            return b""
+        return json.dumps(value, separators=(",", ":")).encode()
+
+    @staticmethod
+    def _coins(coins):
+        if not coins or not isinstance(coins, dict):
+            return []
+        return [(int(coin), int(quantity)) for coin, quantity in coins.items()]
+
+    @staticmethod
+    def _errors(errors):
+        if not errors:
+            return []
+        if isinstance(errors, str):
+            errors = [errors]
+        elif isinstance(errors, dict):
+            errors = list(errors.values())
+        return [str(error).encode() for error in errors]
+
+    @classmethod
+    def decode(cls, data, offset=0):
+        """
+        Read a binary record back into the dict layout used by the json formats
+
+        :param data:    bytes   : Encoded record
+        :param offset:  int     : Offset of the record in data
+        :return:        Dict
+        """
+        (magic, version, flags, deposit_total, n_change, n_machine, n_errors, n_results, response_length,
+         session_length, status_length, stats_length) = cls.HEADER.unpack_from(data, offset)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError("Not a binary vending machine response")
+        offset += cls.HEADER.size
+
+        response_dict = {"response": data[offset:offset + response_length].decode(),
+                         "success": bool(flags & 1)}
+        offset += response_length
+        session = data[offset:offset + session_length].decode()
+        offset += session_length
+        status = json.loads(data[offset:offset + status_length]) if status_length else None
+        offset += status_length
+        stats = json.loads(data[offset:offset + stats_length]) if stats_length else None
+        offset += stats_length
+
+        change = {}
+        for _ in range(n_change):
+            coin, quantity = cls.COIN.unpack_from(data, offset)
+            change[coin] = quantity
+            offset += cls.COIN.size
+        machine_coins = {}
+        for _ in range(n_machine):
+            coin, quantity = cls.COIN.unpack_from(data, offset)
+            machine_coins[coin] = quantity
+            offset += cls.COIN.size
+
+        errors = {}
+        for index in range(n_errors):
+            length, = cls.ERROR_LENGTH.unpack_from(data, offset)
+            offset += cls.ERROR_LENGTH.size
+            errors[index] = data[offset:offset + length].decode()
+            offset += length
+
+        results = []
+        for _ in range(n_results):
+            length, = cls.RESULT_LENGTH.unpack_from(data, offset)
+            offset += cls.RESULT_LENGTH.size
+            results.append(cls.decode(data, offset))
+            offset += length
+
+        if change:
+            response_dict["coins"] = change
+        if deposit_total:
+            response_dict["deposit_total"] = deposit_total
+        if machine_coins:
+            response_dict["machine_coins"] = machine_coins
+        if n_results:
+            response_dict["results"] = results
+        if stats is not None:
+            response_dict["stats"] = stats
+        if status is not None:
+            response_dict["status"] = status
+        if session:
+            response_dict["session"] = session
+        if errors:
+            response_dict["errors"] = errors
+        return response_dict
+
+
+ENCODERS = {encoder.name: encoder for encoder in (JsonEncoder, CompactJsonEncoder, OrjsonEncoder,
+                                                  MsgpackEncoder, BinaryEncoder)}
+
+
+def available_formats():
+    """
+    :return: list   : Names of the formats usable with the installed packages
+    """
+    return [name for name, encoder in ENCODERS.items()
+            if encoder.requires is None or _optional_module(encoder.requires) is not None]
+
+
+def get_encoder(name):
+    """
+    Look up an encoder by format name
+
+    :param name:    str             : Format name sent by the client
+    :return:        ResponseEncoder
+    :raises ValueError              : Unknown format, or its package is not installed
+    """
+    encoder = ENCODERS.get(name)
+    if encoder is None or (encoder.requires is not None and _optional_module(encoder.requires) is None):
+        raise ValueError(f"Unknown response format '{name}', expected one of {available_formats()}")
+    return encoder()
@@ -0,0 +1,154 @@
+"""Incremental decoder splitting a socket byte stream into json requests
+
+Bytes are appended to one buffer and each byte is scanned once, the scan
+position, nesting depth and string state are kept between reads. Only
+braces, quotes and escapes are visited in python, the regex engine skips
+everything in between. A request is parsed once its closing brace arrives.
+"""
+import json
+import re
+
+# Bytes that change the nesting state outside / inside a json string
+_STRUCTURE = re.compile(rb'[{}"]')
+_STRING = re.compile(rb'["\\]')
+_NOT_SPACE = re.compile(rb'\S')
+
+
+class FrameTooLargeError(ValueError):
+    """Raised when a request grows past the decoder's max frame size"""
+
+
+class JsonFrameDecoder:
+    def __init__(self, max_frame_size=1024 * 1024):
+        """
+
+        :param max_frame_size:  int     : Largest request accepted, in bytes
+        """
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+        # Scan state, carried over between calls to feed
+        self._pos = 0           # Next byte to scan
+        self._start = -1        # Offset of the current request's opening brace
+        self._depth = 0
+        self._in_string = False
+        self._skip_line = False
+
+    def feed(self, data):
+        """
+        Add bytes read from the socket
+
+        :param data: bytes  : Data read from the socket
+        """
+        self.buffer += data
+        if self._start >= 0 and len(self.buffer) - self._start > self.max_frame_size:
+            raise FrameTooLargeError(f"Request larger than {self.max_frame_size} bytes")
+
+    def has_partial(self):
+        """
+        :return: Boolean    : True if part of a request is buffered
+        """
+        return self._start >= 0
+
+    def next_frame(self):
+        """
+        Return the next complete request from the buffer
+
+        Garbage before a request is dropped up to the next newline so a
+        keep alive session can carry on after a bad line.
+
+        :return: Dict or None   : Parsed request, None if more data is needed
+        :raises ValueError      : Data was not a json object
+        """
+        if self._skip_line and not self._discard_line():
+            return None
+
+        if self._start < 0:
+            match = _NOT_SPACE.search(self.buffer, self._pos)
+            if not match:
+                self._compact(len(self.buffer))
+                return None
+            if self.buffer[match.start()] != ord('{'):
+                self._pos = match.start()
+                self._skip_line = True
+                self._discard_line()
+                raise ValueError("Request is not a json object")
+            self._start = match.start()
+            self._pos = self._start
+
+        end = self._scan()
+        if end < 0:
+            if len(self.buffer) - self._start > self.max_frame_size:
+                raise FrameTooLargeError(f"Request larger than {self.max_frame_size} bytes")
+            return None
+
+        frame = bytes(self.buffer[self._start:end])
+        self._start = -1
+        self._compact(end)
+        try:
+            return json.loads(frame)
+        except ValueError:
+            raise ValueError(f"Cannot convert {frame[:64]} to jsonObj")
+
+    def _scan(self):
+        """
+        Continue scanning from the last position
+
+        :return: int    : Offset just past the closing brace, -1 if not complete
+        """
+        buffer = self.buffer
+        pos = self._pos
+        while True:
+            if self._in_string:
+                match = _STRING.search(buffer, pos)
+                if not match:
+                    self._pos = len(buffer)
+                    return -1
+                pos = match.end()
+                if buffer[match.start()] == ord('\\'):
+                    if pos >= len(buffer):
+                        # Escaped byte not read yet, rescan the backslash next time
+                        self._pos = match.start()
+                        return -1
+                    pos += 1
+                else:
+                    self._in_string = False
+                continue
+
+            match = _STRUCTURE.search(buffer, pos)
+            if not match:
+                self._pos = len(buffer)
+                return -1
+            pos = match.end()
+            char = buffer[match.start()]
+            if char == ord('"'):
+                self._in_string = True
+            elif char == ord('{'):
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    return pos
+
+    def _discard_line(self):
+        """
+        Drop buffered bytes up to and including the next newline
+
+        :return: Boolean    : True once the newline has been found
+        """
+        newline = self.buffer.find(b"\n", self._pos)
+        if newline < 0:
+            self._compact(len(self.buffer))
+            return False
+        self._skip_line = False
+        self._compact(newline + 1)
+        return True
+
+    def _compact(self, offset):
+        """
+        Forget every byte before offset
+
+        :param offset: int  : First byte still needed
+        """
+        del self.buffer[:offset]
+        self._pos = 0
@@ -6,9 +6,11 @@ Author  : Matthew Holsey
 
 import json
 
+from Server.api_result import ApiResult
+
 
 def format_json_response(response, success, add_change=False, errors=None, add_deposit_val=False,
-                         add_v_machine_coins=False):
+                         add_v_machine_coins=False, add_results=None):
     """
     Function to format parameters into a json object
 
@@ -18,38 +20,26 @@ def format_json_response(response, success, add_change=False, errors=None, add_d
     :param add_change: Dict             : Dict containing change left from purchase
     :param add_v_machine_coins: Boolean : Add Dict containing coins in machine
     :param errors: str/list/dict        : Variable containing any errors
+    :param add_results: list            : List of ApiResult for each operation in a batch
 
     :return: bytes
     """
-    response_dict = {"response": response,
-                     "success": success}
-
-    if add_change:
-        if isinstance(add_change, dict):
-            # Adds a dict of the coins
-            response_dict["coins"] = add_change
-
-    if add_deposit_val:
-        response_dict["deposit_total"] = add_deposit_val
+    return encode_response(ApiResult(response, success, change=add_change, errors=errors,
+                                     deposit_total=add_deposit_val, machine_coins=add_v_machine_coins,
+                                     results=add_results))
 
-    if add_v_machine_coins:
-        if isinstance(add_v_machine_coins, dict):
-            response_dict["machine_coins"] = add_v_machine_coins
 
-    if errors:
-        errors_dict = {}
-        if isinstance(errors, list):
-            for index, item in enumerate(errors):
-                errors_dict[index] = item
-        if isinstance(errors, dict):
-            errors_dict = errors
-        if isinstance(errors, str):
-            errors_dict[1] = errors
-        response_dict["errors"] = errors_dict
-
-    json_object = json.dumps(response_dict, indent=4)
+def encode_response(result, indent=4):
+    """
+    Encode an api result to the bytes sent on the socket
 
-    return str(json_object).encode()
+    :param result: ApiResult    : Result returned from an api handler
+    :param indent: int          : Json indent, None for compact json
+    :return: bytes
+    """
+    if indent is None:
+        return json.dumps(result.to_dict(), separators=(",", ":")).encode()
+    return json.dumps(result.to_dict(), indent=indent).encode()
 
 
 def parse_json_in_to_dict(json_str):
@@ -64,5 +54,3 @@ def parse_json_in_to_dict(json_str):
 
     except Exception as e:
         raise ValueError(f"Cannot convert {json_str} to jsonObj")
-
-
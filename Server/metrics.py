@@ -0,0 +1,175 @@
+"""Counters and timing histograms for the server hot path
+
+Each thread records into its own buffer, so recording never takes a lock
+and threads never contend on shared counts. Buffers are only merged when
+stats are read, through the '{"stats": {}}' request or the Prometheus text
+endpoint started with --metrics_port.
+
+Timings are counted in power of two buckets from 1 microsecond to about
+17 seconds, percentiles read from them are the upper bound of the bucket.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bound of each timing bucket in seconds, anything slower goes in a final overflow bucket
+BUCKET_BOUNDS = tuple(1e-6 * 2 ** power for power in range(25))
+
+PERCENTILES = {"p50_ms": 0.5, "p99_ms": 0.99, "p999_ms": 0.999}
+
+
+class _ThreadBuffer:
+    """Counts recorded by one thread, only ever written by that thread"""
+    __slots__ = ("counters", "buckets", "sums")
+
+    def __init__(self):
+        self.counters = {}
+        # Timing name -> count per bucket, overflow last
+        self.buckets = {}
+        # Timing name -> total seconds
+        self.sums = {}
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self._local = threading.local()
+        self._buffers = []
+        # Only taken the first time a thread records
+        self._lock = threading.Lock()
+
+    def _buffer(self):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = _ThreadBuffer()
+            with self._lock:
+                self._buffers.append(buffer)
+        return buffer
+
+    def increment(self, name, amount=1):
+        """
+        :param name:    str     : Counter name, e.g. 'connections'
+        :param amount:  int     : Amount to add
+        """
+        counters = self._buffer().counters
+        counters[name] = counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        """
+        :param name:    str     : Timing name, e.g. 'read'
+        :param seconds: float   : Time taken
+        """
+        buffer = self._buffer()
+        buckets = buffer.buckets.get(name)
+        if buckets is None:
+            buckets = buffer.buckets[name] = [0] * (len(BUCKET_BOUNDS) + 1)
+            buffer.sums[name] = 0.0
+        buckets[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        buffer.sums[name] += seconds
+
+    def collect(self):
+        """
+        Merge every thread's buffer
+
+        :return: tuple  : (counters Dict{str, int}, buckets Dict{str, list}, sums Dict{str, float})
+        """
+        counters, buckets, sums = {}, {}, {}
+        with self._lock:
+            buffers = list(self._buffers)
+        for buffer in buffers:
+            for name, value in list(buffer.counters.items()):
+                counters[name] = counters.get(name, 0) + value
+            for name, counts in list(buffer.buckets.items()):
+                merged = buckets.get(name)
+                if merged is None:
+                    merged = buckets[name] = [0] * len(counts)
+                    sums[name] = 0.0
+                for index, count in enumerate(counts):
+                    merged[index] += count
+                sums[name] += buffer.sums[name]
+        return counters, buckets, sums
+
+    def stats(self):
+        """
+        :return: Dict   : Uptime, counters and per timing count, mean and percentiles in milliseconds
+        """
+        counters, buckets, sums = self.collect()
+        timings = {}
+        for name, counts in sorted(buckets.items()):
+            total = sum(counts)
+            timing = {"count": total, "mean_ms": round(sums[name] / total * 1000, 4) if total else 0}
+            for key, fraction in PERCENTILES.items():
+                timing[key] = round(self._bucket_percentile(counts, total, fraction) * 1000, 4)
+            timings[name] = timing
+        return {"uptime_seconds": round(time.time() - self.started, 1),
+                "counters": dict(sorted(counters.items())),
+                "timings": timings}
+
+    @staticmethod
+    def _bucket_percentile(counts, total, fraction):
+        """
+        :return: float  : Upper bound in seconds of the bucket holding the percentile, 0 with no samples
+        """
+        if not total:
+            return 0
+        rank = fraction * total
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return BUCKET_BOUNDS[min(index, len(BUCKET_BOUNDS) - 1)]
+        return BUCKET_BOUNDS[-1]
+
+    def prometheus_text(self, prefix="vending_"):
+        """
+        :param prefix:  str     : Prefix for every metric name
+        :return:        str     : Metrics in the Prometheus text exposition format
+        """
+        counters, buckets, sums = self.collect()
+        lines = []
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE {prefix}{name}_total counter")
+            lines.append(f"{prefix}{name}_total {value}")
+        for name, counts in sorted(buckets.items()):
+            metric = f"{prefix}{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(BUCKET_BOUNDS, counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound:g}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {sum(counts)}')
+            lines.append(f"{metric}_sum {sums[name]:.9f}")
+            lines.append(f"{metric}_count {sum(counts)}")
+        return "\n".join(lines) + "\n"
+
+
+def start_metrics_endpoint(metrics, port):
+    """
+    Serve metrics as Prometheus text on http://127.0.0.1:<port>/metrics, from a background thread
+
+    :param metrics: Metrics     : Metrics to serve
+    :param port:    int         : TCP port to listen on
+    :return:        HTTPServer  : Running server, call shutdown() to stop it
+    """
+    # Only needed when the endpoint is enabled, so not imported at start-up
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes are frequent, keep them out of the server log
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-endpoint", daemon=True).start()
+    return server
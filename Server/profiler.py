@@ -0,0 +1,103 @@
+"""Sampling profiler that can be switched on inside a running server
+
+A background thread takes the stack of every other thread every interval
+seconds, for a set number of seconds, then writes the stacks in collapsed
+form - one line per distinct stack, frames root first separated by ';',
+then the number of samples. flamegraph.pl, speedscope and inferno read
+the file as it is.
+
+Frames are named 'module:qualified name', e.g.
+
+    Server.server_handler:Server.handle_connection;...;VendingMachineDir.VendingMachine:VendingMachine.subtract_value 12
+
+Started with a '{"profile": {"seconds": N}}' request or SIGUSR1, when the
+server was started with --profile_dir.
+"""
+import os
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    # Longest run allowed from a request, in seconds
+    MAX_SECONDS = 300
+
+    def __init__(self, output_dir, interval=0.005):
+        """
+
+        :param output_dir:  str     : Directory the collapsed stack files are written to
+        :param interval:    float   : Seconds between samples
+        """
+        self.output_dir = output_dir
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds):
+        """
+        Sample every thread for a number of seconds, in the background
+
+        :param seconds: float   : How long to sample for, at most MAX_SECONDS
+        :return:        str     : Path the stacks will be written to, None if a run is already going
+        :raises ValueError      : Seconds not a positive number
+        """
+        if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or seconds <= 0:
+            raise ValueError("Profile seconds must be a number greater than 0")
+        seconds = min(seconds, self.MAX_SECONDS)
+
+        with self._lock:
+            if self.running():
+                return None
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.collapsed")
+            self._thread = threading.Thread(target=self._run, args=(seconds, path), name="sampling-profiler",
+                                            daemon=True)
+            self._thread.start()
+        return path
+
+    def join(self, timeout=None):
+        """
+        Wait for the current run to write its file
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self, seconds, path):
+        stacks = self.sample(seconds)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as outfile:
+            for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+                outfile.write(f"{stack} {count}\n")
+        # Only appears once complete
+        os.replace(temp_path, path)
+
+    def sample(self, seconds):
+        """
+        :param seconds: float   : How long to sample for
+        :return:        Dict    : Collapsed stack -> samples
+        """
+        own_id = threading.get_ident()
+        names = {}
+        stacks = {}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    name = names.get(code)
+                    if name is None:
+                        module = frame.f_globals.get("__name__", "?")
+                        name = names[code] = f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+                    frames.append(name)
+                    frame = frame.f_back
+                stack = ";".join(reversed(frames))
+                stacks[stack] = stacks.get(stack, 0) + 1
+            time.sleep(self.interval)
+        return stacks
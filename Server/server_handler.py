@@ -12,16 +12,44 @@ import time
 import logging
 import traceback
 
-from Server.json_IO import *
+from Server.deadlines import ReadDeadline
+from Server.frame_decoder import FrameTooLargeError, JsonFrameDecoder
+from Server.api_result import ApiResult
+from Server.encoders import get_encoder
+from Server.metrics import Metrics, start_metrics_endpoint
+from VendingMachineDir.CoinInventory import CoinInventory
+from VendingMachineDir.MachineRegistry import MachineRegistry
 from VendingMachineDir.VM_globals import Globals
 
 
 class Server:
+    # Request keys that configure the connection rather than the machine
+    CONNECTION_OPTIONS = {"keep_alive", "format"}
+
     def __init__(self):
         self.sock = None
         self.tcp_port = 22222
         self.conn = None
         self.timeout = 5
+        # How often the accept loop re-checks the running flag
+        self.poll_interval = 0.1
+        # Seconds a keep alive session may sit idle between requests
+        self.keep_alive_timeout = 30
+        # Seconds allowed between bytes of a request once it has started
+        self.idle_timeout = 2
+        # Seconds allowed for a whole request once started, and for writing a response
+        self.request_timeout = 5
+        # Largest request accepted, in bytes
+        self.max_frame_size = 1024 * 1024
+        # Default response format, clients can change it per connection
+        self.encoder = get_encoder("json")
+        # Counters and timings, read with '{"stats": {}}' or the metrics endpoint
+        self.metrics = Metrics()
+        # Port for the Prometheus text endpoint, None to not serve it
+        self.metrics_port = None
+        self.metrics_endpoint = None
+        # SamplingProfiler started by '{"profile": {}}' requests, None to refuse them
+        self.profiler = None
 
     def init_server(self):
         """
@@ -32,16 +60,23 @@ class Server:
         """
 
         try:
+            self.start_metrics_endpoint()
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.sock.bind(('127.0.0.1', self.tcp_port))
             # only allow 1 connection at a time..
             # Assuming only 1 person using it at a time
             self.sock.listen(1)
+            wait_start = time.perf_counter()
             while Globals.running:
-                # Wait for the next connection
+                # Poll for the next connection so a cleared running flag is noticed
+                ready = select.select([self.sock], [], [], self.poll_interval)
+                if not ready[0]:
+                    continue
                 try:
                     self.conn, addr = self.sock.accept()
+                    # Reads wait in select, this bounds sendall to a client not reading its response
+                    self.conn.settimeout(self.request_timeout)
                 except OSError as err:
                     # Check if the error came from a 'closed' conn
                     if "closed" in str(self.conn):
@@ -52,143 +87,642 @@ class Server:
                 except Exception as e:
                     raise e
 
-                self.handle_connection()
+                self.metrics.observe("accept_wait", time.perf_counter() - wait_start)
+                self.metrics.increment("connections")
+                try:
+                    self.handle_connection()
+                except OSError as e:
+                    # Client went away, or stopped reading, while an error response was sent
+                    logging.warning(f"Connection dropped: {e}")
+                wait_start = time.perf_counter()
         except Exception as e:
             print(traceback.format_exc())
             print(e)
         finally:
             self.sock.close()
+            self.stop_metrics_endpoint()
+
+    def start_metrics_endpoint(self):
+        if self.metrics_port is not None:
+            self.metrics_endpoint = start_metrics_endpoint(self.metrics, self.metrics_port)
+
+    def stop_metrics_endpoint(self):
+        if self.metrics_endpoint is not None:
+            self.metrics_endpoint.shutdown()
+            self.metrics_endpoint.server_close()
+            self.metrics_endpoint = None
 
     def close_connection(self):
         self.conn.close()
 
+    def send(self, result, encoder):
+        """
+        Encode an api result and write it to the connection
+
+        :param result: ApiResult            : Result returned from an api handler
+        :param encoder: ResponseEncoder     : Response format for this connection
+        """
+        self.conn.sendall(self.encode(result, encoder))
+
+    def send_framed(self, result, encoder):
+        """
+        Write an api result framed for a keep alive session
+
+        :param result: ApiResult            : Result returned from an api handler
+        :param encoder: ResponseEncoder     : Response format for this connection
+        """
+        self.conn.sendall(self.encode(result, encoder, framed=True))
+
+    def encode(self, result, encoder, framed=False):
+        """
+        Encode an api result, timed as 'encode'
+
+        :param result: ApiResult            : Result returned from an api handler
+        :param encoder: ResponseEncoder     : Response format for this connection
+        :param framed: Boolean              : Frame the result for a keep alive session
+        :return: bytes
+        """
+        start = time.perf_counter()
+        data = encoder.frame(result) if framed else encoder.encode(result)
+        self.metrics.observe("encode", time.perf_counter() - start)
+        return data
+
     def handle_connection(self):
         """
-        Function to read from the socket and pass the data read to be parsed
+        Function to read from the socket and pass the request read to be handled
+
+        If the request asks for 'keep_alive' the socket is kept open for a
+        session of newline delimited requests
 
         Closes connection on function finish
         """
-        data = ""
+        decoder = JsonFrameDecoder(self.max_frame_size)
+        encoder = self.encoder
         try:
-            data = self.read_data()
-            response = self.handle_response(parse_json_in_to_dict(data))
-            # response is json object at the moment, need to convert to bytes in order to send
-            self.conn.sendall(response)
-
-        except ValueError:
-            logging.warning(f"Couldn't parse json from string: '{data}'")
-            self.conn.sendall(format_json_response("Fail", success=False,
-                                                   errors="Value error: Couldn't parse data read into json obj"))
-        except TimeoutError:
-            logging.warning("Timeout during socket read - server")
-            self.conn.sendall(format_json_response("Fail", success=False,
-                                                   errors="Timeout during read"))
+            json_dict = self.read_request(decoder, self.timeout)
+            if json_dict is None:
+                # Client closed without sending anything
+                return
+            try:
+                encoder = self.select_encoder(json_dict, encoder)
+            except ValueError as e:
+                self.send(ApiResult("Fail", success=False, errors=str(e)), encoder)
+                return
+
+            response = self.handle_request(json_dict)
+            if self.wants_keep_alive(json_dict):
+                self.send_framed(response, encoder)
+                self.handle_session(decoder, encoder)
+            else:
+                self.send(response, encoder)
+
+        except FrameTooLargeError as e:
+            logging.warning(f"Request too large: {e}")
+            self.metrics.increment("errors_too_large")
+            self.send(ApiResult("Fail", success=False, errors=f"Value error: {e}"), encoder)
+        except ValueError as e:
+            logging.warning(f"Couldn't parse json from request: {e}")
+            self.metrics.increment("errors_parse")
+            self.send(ApiResult("Fail", success=False,
+                                errors="Value error: Couldn't parse data read into json obj"), encoder)
+        except TimeoutError as e:
+            # Missed read deadlines get a response, a client too slow to read its response does not
+            deadline = getattr(e, "deadline", "write")
+            logging.warning(f"Timeout ({deadline}) - server")
+            self.metrics.increment(f"errors_timeout_{deadline}")
+            if deadline != "write":
+                self.send(ApiResult("Fail", success=False, errors=f"Timeout during read, {e}"), encoder)
         except Exception as e:
             logging.error(f"Unknown exception hit during parse of data: {e}")
+            self.metrics.increment("errors_unknown")
             Globals.running = False
         finally:
             # Closing connection / socket on finish
             self.close_connection()
 
-    def read_data(self):
-        ready = self.check_read_pipe()
-        if ready[0]:
-            data = self.conn.recv(4096)
-            data = data.decode("utf-8")
-            start_time = time.time()
-            # Loop until full json object
-            while not data.count('{') == data.count('}') or not data:
-                data += self.conn.recv(4096).decode("utf-8")
-                if time.time() - start_time > self.timeout:
-                    raise TimeoutError
+    def handle_session(self, decoder, encoder):
+        """
+        Function to serve a keep alive session
+        Each request read gets one response back, text formats one per line
 
-            return data
+        Runs until the client closes the socket, sends '"keep_alive": false'
+        or stays idle for longer than the keep alive timeout
 
-        raise TimeoutError
+        :param decoder: JsonFrameDecoder    : Decoder holding any requests already read
+        :param encoder: ResponseEncoder     : Response format for this connection
+        """
+        while Globals.running:
+            try:
+                json_dict = self.read_request(decoder, self.keep_alive_timeout)
+            except FrameTooLargeError as e:
+                logging.warning(f"Request too large: {e}")
+                self.metrics.increment("errors_too_large")
+                self.send_framed(ApiResult("Fail", success=False, errors=f"Value error: {e}"), encoder)
+                return
+            except ValueError as e:
+                logging.warning(f"Couldn't parse json from request: {e}")
+                self.metrics.increment("errors_parse")
+                self.send_framed(ApiResult(
+                    "Fail", success=False, errors="Value error: Couldn't parse data read into json obj"), encoder)
+                continue
+            except TimeoutError as e:
+                logging.warning(f"Keep alive session timeout ({e.deadline}) - server")
+                self.metrics.increment(f"errors_timeout_{e.deadline}")
+                self.send_framed(ApiResult("Fail", success=False, errors=f"Timeout during read, {e}"), encoder)
+                return
+            if json_dict is None:
+                return
+            try:
+                encoder = self.select_encoder(json_dict, encoder)
+            except ValueError as e:
+                self.send_framed(ApiResult("Fail", success=False, errors=str(e)), encoder)
+                continue
+
+            self.send_framed(self.handle_request(json_dict), encoder)
+            if json_dict.get("keep_alive") is False:
+                return
+
+    def read_request(self, decoder, timeout):
+        """
+        Read from the socket until the decoder holds a full json object
 
-    def check_read_pipe(self):
-        ready = select.select([self.conn], [], [], self.timeout)
+        :param decoder: JsonFrameDecoder    : Decoder for this connection
+        :param timeout: float               : Seconds allowed for the request to start
+        :return:        Dict or None        : Request read, None if the client closed
+        :raises RequestTimeout              : The header, idle or total deadline passed
+        """
+        start = time.perf_counter()
+        json_dict = decoder.next_frame()
+        parse_time = time.perf_counter() - start
+        deadline = ReadDeadline(timeout, self.idle_timeout, self.request_timeout)
+        if decoder.has_partial():
+            deadline.received()
+        while json_dict is None:
+            if not self.check_read_pipe(deadline.remaining())[0]:
+                # Nothing arrived, remaining() raises once the deadline has passed
+                continue
+            chunk = self.conn.recv(4096)
+            if not chunk:
+                if decoder.has_partial():
+                    raise ValueError("Connection closed part way through a request")
+                return None
+            deadline.received()
+            decoder.feed(chunk)
+            parse_start = time.perf_counter()
+            json_dict = decoder.next_frame()
+            parse_time += time.perf_counter() - parse_start
+
+        self.metrics.observe("read", time.perf_counter() - start - parse_time)
+        self.metrics.observe("parse", parse_time)
+        return json_dict
+
+    def check_read_pipe(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        ready = select.select([self.conn], [], [], timeout)
         return ready
 
-    def handle_response(self, json_dict):
+    @staticmethod
+    def wants_keep_alive(json_dict):
+        """
+        Check if a request asks for the connection to stay open
+
+        :param json_dict:   Dict    : dictionary containing json read from socket
+        :return:            Boolean : True if '"keep_alive": true' was sent
+        """
+        return isinstance(json_dict, dict) and json_dict.get("keep_alive") is True
+
+    @staticmethod
+    def select_encoder(json_dict, encoder):
+        """
+        Switch the response format for the rest of the connection if the request asks for one
+
+        :param json_dict:   Dict            : dictionary containing json read from socket
+        :param encoder:     ResponseEncoder : Response format in use
+        :return:            ResponseEncoder : Response format to use from this request on
+        :raises ValueError                  : Unknown response format
+        """
+        if "format" in json_dict:
+            return get_encoder(json_dict["format"])
+        return encoder
+
+    def is_machine_request(self, json_dict):
+        """
+        :param json_dict:   Dict    : dictionary containing json read from socket
+        :return:            Boolean : True if the request acts on a machine, False if it is for the
+                                      connection or the server, e.g. stats
+        """
+        return not (set(json_dict) <= self.CONNECTION_OPTIONS or "stats" in json_dict or "profile" in json_dict)
+
+    def handle_request(self, json_dict):
+        """
+        Answer a message only holding connection options, pass anything else to the api handlers
+
+        :param json_dict:   Dict    : dictionary containing json read from socket
+        :return:            ApiResult   : Result to send back on the socket
+        """
+        if set(json_dict) <= self.CONNECTION_OPTIONS:
+            return ApiResult("Connection options set.", success=True)
+        if "stats" in json_dict:
+            return ApiResult("Server stats.", success=True, stats=self.metrics.stats())
+        if "profile" in json_dict:
+            return self.handle_profile(json_dict)
+        return self.dispatch(json_dict)
+
+    def handle_profile(self, json_dict):
+        """
+        Function to handle api 'profile', sampling every thread in the background
+
+        :param json_dict:   Dict        : dictionary containing json read from socket
+        :return:            ApiResult   : Result holding the path of the collapsed stack file
+        """
+        if self.profiler is None:
+            return ApiResult("Fail", success=False, errors="Profiling is not enabled, start with --profile_dir")
+        options = json_dict["profile"]
+        if not isinstance(options, dict):
+            return ApiResult("Fail", success=False, errors="'profile' must be a json object")
+
+        try:
+            path = self.profiler.start(options.get("seconds", 10))
+        except ValueError as e:
+            return ApiResult("Fail", success=False, errors=str(e))
+        if path is None:
+            return ApiResult("Fail", success=False, errors="A profile is already running")
+        return ApiResult(f"Profiling started, writing {path}", success=True)
+
+    def dispatch(self, json_dict):
+        """
+        Run the api handlers for a parsed request, then wait for its journal line to reach disk
+        if the machine uses group commit
+
+        :param json_dict:   Dict    : dictionary containing json read from socket
+        :return:            ApiResult   : Result to send back on the socket
+        """
+        result, journal, seq = self.apply(json_dict)
+        if seq is not None:
+            # Outside the lock, so requests arriving meanwhile can join the same group commit
+            start = time.perf_counter()
+            journal.wait_durable(seq)
+            self.metrics.observe("journal_wait", time.perf_counter() - start)
+        return result
+
+    def apply(self, json_dict):
+        """
+        Run the api handlers for a parsed request, without waiting for the journal
+        Holds the lock of the machine addressed, so coin state changes are
+        serialised per machine while other machines carry on
+
+        :param json_dict:   Dict    : dictionary containing json read from socket
+        :return:            tuple   : (ApiResult, TransactionJournal, journal line sequence number),
+                                      the journal and sequence number are None if nothing was journaled
+        """
+        if not isinstance(json_dict.get("machine_id", ""), str):
+            return ApiResult("Fail", success=False, errors="'machine_id' must be a string"), None, None
+        machine = self.resolve_machine(json_dict)
+        if machine is None:
+            return ApiResult("Fail", success=False,
+                             errors=f"Unknown machine id '{json_dict['machine_id']}'"), None, None
+
+        action = self.action_name(json_dict)
+        start = time.perf_counter()
+        journal = machine.journal
+        if journal is None:
+            with machine.lock:
+                result = self.handle_with_session(json_dict, machine)
+            seq = None
+        else:
+            # Counted from before the lock, so a group commit waits for requests queued on it
+            journal.begin_write()
+            try:
+                with machine.lock:
+                    before = machine.snapshot()
+                    token = json_dict.get("session")
+                    session_before = machine.sessions.state(token)
+                    try:
+                        result = self.handle_with_session(json_dict, machine)
+                    finally:
+                        # Handlers can raise part way through, record whatever they changed
+                        seq = journal.record(before, machine, action, token, session_before)
+            finally:
+                journal.end_write()
+        self.metrics.observe(f"handler_{action}", time.perf_counter() - start)
+        return result, journal, seq
+
+    @staticmethod
+    def action_name(json_dict):
+        """
+        :param json_dict:   Dict    : dictionary containing json read from socket
+        :return:            str     : Name of the api action, as written to the journal
+        """
+        for action in ("batch", "purchase", "refund", "deposit", "status", "open_session", "close_session"):
+            if action in json_dict:
+                return action
+        return "unknown"
+
+    @staticmethod
+    def resolve_machine(json_dict):
+        """
+        Find the machine a request is for
+
+        :param json_dict:   Dict            : dictionary containing json read from socket
+        :return:            VendingMachine  : Machine for 'machine_id', the default machine if not sent,
+                                              None if the id is unknown
+        """
+        machine_id = json_dict.get("machine_id")
+        if machine_id is None or machine_id == MachineRegistry.DEFAULT_ID:
+            return Globals.v_machine
+        if Globals.machines is None:
+            return None
+        return Globals.machines.get(machine_id)
+
+    def handle_with_session(self, json_dict, machine):
+        """
+        Find the session a request names, then run it against that session's credit
+        Called holding the machine's lock
+
+        :param json_dict:   Dict            : dictionary containing json read from socket
+        :param machine:     VendingMachine  : Machine the request is for
+        :return:            ApiResult       : Result to send back on the socket
+        """
+        if "open_session" in json_dict:
+            session = machine.sessions.open()
+            if session is None:
+                return ApiResult("Fail", success=False, errors="Too many open sessions, try again later")
+            return ApiResult("Session opened.", success=True, session=session.token)
+
+        if "session" not in json_dict:
+            return self.handle_response(json_dict, machine)
+        session = machine.sessions.get(json_dict["session"])
+        if session is None:
+            return ApiResult("Fail", success=False, errors="Unknown or expired session")
+
+        if "close_session" in json_dict:
+            if session.credit:
+                return ApiResult("Fail", success=False, deposit_total=session.credit,
+                                 errors="Session still holds credit, make a purchase or refund first")
+            machine.sessions.close(session.token)
+            return ApiResult("Session closed.", success=True)
+        return self.handle_response(json_dict, machine, session)
+
+    @staticmethod
+    def credit(machine, session):
+        """
+        :return: int    : Credit of the session, the machine wide deposit total without one
+        """
+        return machine.user_deposited_total if session is None else session.credit
+
+    @staticmethod
+    def set_credit(machine, session, value):
+        if session is None:
+            machine.user_deposited_total = value
+        else:
+            session.credit = value
+
+    @staticmethod
+    def inserted_coins(machine, session):
+        """
+        :return: Dict{int, int} : Coins making up the credit, updated in place
+        """
+        return machine.user_deposited_coins if session is None else session.coins
+
+    def handle_response(self, json_dict, machine, session=None):
+        if "batch" in json_dict:
+            return self.handle_batch(json_dict, machine, session)
         # Keep in this order - Handle deposit before purchase
         if "deposit" in json_dict:
             # Can only do purchase after making deposit
             if "purchase" in json_dict:
-                return self.handle_purchase(json_dict)
-            return self.handle_deposit(json_dict)
+                return self.handle_purchase(json_dict, machine, session)
+            return self.handle_deposit(json_dict, machine, session)
         if "purchase" in json_dict:
-            return format_json_response("Fail", success=False, errors="Cannot make purchase without a deposit!")
+            return ApiResult("Fail", success=False, errors="Cannot make purchase without a deposit!")
+        if "refund" in json_dict:
+            return self.handle_refund(json_dict, machine, session)
+        if "status" in json_dict:
+            return self.handle_status(json_dict, machine, session)
+        return ApiResult("Fail", success=False, errors="No valid action found in json")
+
+    def handle_refund(self, json_dict, machine, session=None):
+        """
+        Function to handle api 'refund', giving back the credit not yet spent
+        The coins inserted are returned where the machine still holds them,
+        the change engine makes up the rest
 
-    def handle_purchase(self, json_dict):
+        :param: json_dict   : Dict  : dictionary containing json read from socket
+        :param: machine     : VendingMachine    : Machine the request is for
+        :param: session     : Session           : Session refunded, None for the machine's credit
+
+        :return: ApiResult  : Result holding the coins given back
+        """
+        credit = self.credit(machine, session)
+        if credit <= 0:
+            return ApiResult("No credit to refund.", success=True)
+
+        inserted = self.inserted_coins(machine, session)
+        coins = machine.refund(credit, inserted)
+        if coins is None:
+            logging.debug("Coins in machine cannot make the credit to refund")
+            return ApiResult("Fail", success=False, deposit_total=credit,
+                             errors="Machine cannot make the coins to refund, credit kept")
+
+        self.set_credit(machine, session, 0)
+        inserted.clear()
+        return ApiResult("Successful refund.", success=True, change=coins)
+
+    def handle_status(self, json_dict, machine, session=None):
         """
-        Function to handle api 'purchase' of item
+        Function to handle api 'status', reporting whether change can be given
 
         :param: json_dict   : Dict  : dictionary containing json read from socket
+        :param: machine     : VendingMachine    : Machine the request is for
+        :param: session     : Session           : Session whose credit is reported, None for the machine's
 
-        :return: function call  : JSON  : Json object contianing api response
+        :return: ApiResult  : Result holding the machine's status
+        """
+        status = {"exact_change_only": machine.exact_change_only(),
+                  "change_total": machine.current_change_total}
+        if len(machine.products):
+            status["stock"] = machine.products.stock()
+        return ApiResult("Machine status.", success=True, deposit_total=self.credit(machine, session),
+                         status=status)
+
+    def handle_batch(self, json_dict, machine, session=None):
+        """
+        Function to handle api 'batch' of operations
+        Each operation is a deposit / purchase request, run in order under the
+        single lock acquisition made by dispatch
+
+        With '"atomic": true' the machine is rolled back to its state before
+        the batch as soon as any operation fails
+
+        All operations run on the machine addressed by the batch, any
+        'machine_id' inside an operation is ignored
+
+        :param: json_dict   : Dict  : dictionary containing json read from socket
+        :param: machine     : VendingMachine    : Machine the request is for
+        :param: session     : Session           : Session the operations use the credit of, None for the machine's
+
+        :return: function call  : ApiResult : Result containing a result per operation
+        """
+        operations = json_dict["batch"]
+        if not isinstance(operations, list):
+            return ApiResult("Fail", success=False, errors="'batch' must be a list of operations")
+
+        atomic = json_dict.get("atomic") is True
+        snapshot = machine.snapshot() if atomic else None
+        session_credit = self.credit(machine, session)
+        session_coins = dict(self.inserted_coins(machine, session))
+
+        results = []
+        for index, operation in enumerate(operations):
+            if not isinstance(operation, dict) or "batch" in operation:
+                result = ApiResult("Fail", success=False,
+                                   errors="Batch operations must be deposit / purchase / refund objects")
+            else:
+                try:
+                    result = self.handle_response(operation, machine, session)
+                except (ValueError, TypeError) as e:
+                    result = ApiResult("Fail", success=False, errors=f"Value error: {e}")
+                except Exception as e:
+                    # Still a failed operation, so an atomic batch is rolled back below
+                    logging.error(f"Batch operation {index} raised\n{traceback.format_exc()}")
+                    result = ApiResult("Fail", success=False, errors=f"Operation raised {type(e).__name__}")
+            results.append(result)
+
+            if atomic and not result.success:
+                machine.restore(snapshot)
+                if session is not None:
+                    session.credit = session_credit
+                    session.coins = session_coins
+                logging.debug(f"Batch operation {index} failed, rolling back batch")
+                return ApiResult("Batch rolled back.", success=False, results=results,
+                                 errors=f"Operation {index} failed, no operations applied")
+
+        success = all(result.success for result in results)
+        return ApiResult("Successful batch." if success else "Batch completed with failures.",
+                         success=success, results=results,
+                         deposit_total=self.credit(machine, session))
+
+    def handle_purchase(self, json_dict, machine, session=None):
+        """
+        Function to handle api 'purchase' of item, by 'value' or by product 'slot'
+        A slot purchase checks stock, price and change in one step
+
+        :param: json_dict   : Dict  : dictionary containing json read from socket
+        :param: machine     : VendingMachine    : Machine the request is for
+        :param: session     : Session           : Session whose credit pays, None for the machine's
+
+        :return: function call  : ApiResult : Result containing api response
         """
 
         # Handle deposit first
-        json_depo_str = self.handle_deposit(json_dict)
-        json_depo_obj = json.loads(json_depo_str)          # There's more efficient ways than converting to str and back
-        # Check 'success' value is there and that it was true
-        if "success" not in json_depo_obj or not json_depo_obj["success"]:
-            return json_depo_str
+        deposit_result = self.handle_deposit(json_dict, machine, session)
+        if not deposit_result.success:
+            return deposit_result
+
+        if not isinstance(json_dict["purchase"], dict):
+            return ApiResult("Fail", success=False, errors="'purchase' must be a json object")
+
+        # Purchase by slot, the price comes from the machine's product catalog
+        slot = json_dict["purchase"].get("slot")
+        if slot is not None:
+            product = machine.products.get(slot)
+            if product is None:
+                logging.debug(f"Fail: unknown slot '{slot}'")
+                return ApiResult("Fail", success=False, errors=f"Unknown slot '{slot}'")
+            if machine.products.quantity(slot) <= 0:
+                logging.debug(f"Fail: slot '{slot}' sold out")
+                return ApiResult("Fail", success=False, errors=f"Slot '{slot}' is sold out")
+            value = product.price
 
         # checking necessary key in json
-        if "value" not in json_dict["purchase"]:
+        elif "value" not in json_dict["purchase"]:
             logging.debug("Fail: 'Value' key not found in json")
-            return format_json_response("Fail", success=False, errors="'Value' key not found in json.")
-
-        value = json_dict["purchase"]["value"]
-        change = Globals.v_machine.user_deposited_total - value
+            return ApiResult("Fail", success=False, errors="'Value' or 'slot' key not found in json.")
+        else:
+            value = json_dict["purchase"]["value"]
+            if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+                logging.debug(f"Fail: invalid purchase value {value!r}")
+                return ApiResult("Fail", success=False, errors="'value' must be a whole number of pence greater than 0")
+        change = self.credit(machine, session) - value
 
         if change < 0:
             logging.debug("Value of product being bought was greater than total change left in machine")
-            return format_json_response("Fail", success=False,
-                                        errors="Not enough money deposited into system from user!")
+            return ApiResult("Fail", success=False,
+                             errors="Not enough money deposited into system from user!")
 
-        if int(change) > Globals.v_machine.calc_current_change_total():
+        if int(change) > machine.current_change_total:
             logging.debug("Value of product being bought was greater than total change left in machine")
-            return format_json_response("Fail", success=False, errors="Not enough change in machine left for purchase")
+            return ApiResult("Fail", success=False, errors="Not enough change in machine left for purchase")
 
-        # dict of change
-        return_change = Globals.v_machine.subtract_value(change)
+        # Bitset lookup, rejects before any change tables are built
+        if not machine.can_make_change(change):
+            logging.debug("Coins in machine cannot make the exact change for purchase")
+            return ApiResult("Fail", success=False, errors="Machine cannot make exact change for purchase")
+
+        # dict of change, None if the coins held cannot make the amount
+        return_change = machine.subtract_value(change)
+        if return_change is None:
+            logging.debug("Coins in machine cannot make the exact change for purchase")
+            return ApiResult("Fail", success=False, errors="Machine cannot make exact change for purchase")
 
         # Successful purchase, reduce deposit total back to 0
-        Globals.v_machine.user_deposited_total = 0
+        self.set_credit(machine, session, 0)
+        self.inserted_coins(machine, session).clear()
+        if slot is not None:
+            machine.products.take(slot)
 
-        return format_json_response(f"Successful purchase.", success=True, add_change=return_change)
+        return ApiResult(f"Successful purchase.", success=True, change=return_change)
 
-    def handle_deposit(self, json_dict):
+    def handle_deposit(self, json_dict, machine, session=None):
         """
         Function to handle API 'deposit' of coins
 
         :param: json_dict       : Dict  : dictionary containing json read from socket
+        :param: machine         : VendingMachine    : Machine the request is for
+        :param: session         : Session           : Session credited, None to credit the machine
 
-        :return: function call  : JSON  : Json object contianing api response
+        :return: function call  : ApiResult : Result containing api response
         """
 
+        if not isinstance(json_dict["deposit"], dict):
+            return ApiResult("Fail", success=False, errors="'deposit' must be a json object")
         # checking necessary key in json
         if "coins" not in json_dict["deposit"]:
             logging.debug("Failed: 'coins' key not found in json")
-            return format_json_response("Fail", success=False, errors="No 'coins' found in json")
+            return ApiResult("Fail", success=False, errors="No 'coins' found in json")
+        if not isinstance(json_dict["deposit"]["coins"], dict):
+            return ApiResult("Fail", success=False, errors="'coins' must be a json object of coin to quantity")
 
         errors = None
+        deposited = {}
+        # Every coin is checked before any are added, so a bad quantity leaves the machine untouched
         for key, value in json_dict["deposit"]["coins"].items():
-            if int(key) not in Globals.v_machine.coin_names:
+            if int(key) not in machine.valid_coins:
                 if not errors:
                     errors = []
-                errors.append("Invalid key found in json : '{key}'. Skipping value.")
+                errors.append(f"Invalid key found in json : '{key}'. Skipping value.")
                 logging.warning(f"Invalid key found in json : '{key}'. Skipping value.")
+            elif isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+                logging.debug(f"Failed: invalid quantity {value!r} for coin '{key}'")
+                return ApiResult("Fail", success=False,
+                                 errors=f"Quantity for coin '{key}' must be a whole number greater than 0")
             else:
-                # Add the quantity passed to the current coins in vending machine
-                Globals.v_machine.current_coins[int(key)] += int(value)
-                # Increase current deposit amount
-                Globals.v_machine.user_deposited_total += int(key) * int(value)
-
-        return format_json_response("Successful deposit.", success=True, errors=errors,
-                                    add_deposit_val=Globals.v_machine.user_deposited_total)
+                deposited[int(key)] = deposited.get(int(key), 0) + value
+
+        for coin, quantity in deposited.items():
+            if machine.current_coins[coin] + quantity > CoinInventory.MAX_QUANTITY:
+                return ApiResult("Fail", success=False, errors=f"Machine cannot hold that many {coin} coins")
+
+        # Add the quantity passed to the current coins in vending machine
+        machine.add_coins(deposited)
+        # Increase current deposit amount
+        credit = self.credit(machine, session) + sum(coin * quantity for coin, quantity in deposited.items())
+        self.set_credit(machine, session, credit)
+        inserted = self.inserted_coins(machine, session)
+        for coin, quantity in deposited.items():
+            inserted[coin] = inserted.get(coin, 0) + quantity
+
+        return ApiResult("Successful deposit.", success=True, errors=errors, deposit_total=credit)
 
 
@@ -0,0 +1,211 @@
+"""Pre-fork worker processes, sharing the listening port with SO_REUSEPORT
+
+Started with --workers N. The main process forks N workers, each running
+its own asyncio server bound to the same port, so the kernel spreads new
+connections across them and json parsing and encoding use N cores.
+
+Each machine is owned by exactly one worker (see MachineRegistry.owner_of)
+and only that worker holds its coin state, so no locking is needed between
+processes. A request reaching a worker that does not own its machine is
+forwarded to the owner on the owner's private port, <worker port base> + index,
+and the owner's response is relayed back in the client's format.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from Server.api_result import ApiResult
+from VendingMachineDir.MachineRegistry import owner_of
+from VendingMachineDir.VM_globals import Globals
+
+
+def supported():
+    """
+    :return: Boolean    : True if the platform can fork and share a port between processes
+    """
+    return hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")
+
+
+class WorkerRouter:
+    # Idle connections kept open to each other worker
+    MAX_IDLE = 16
+    # Seconds an idle connection is reused for, below the owner's keep alive timeout
+    IDLE_SECONDS = 10
+    # Largest response relayed, as a multiple of the largest request, a batch's results outgrow its operations
+    RESPONSE_SIZE_RATIO = 64
+
+    def __init__(self, index, worker_count, port_base, host="127.0.0.1", max_frame_size=1024 * 1024):
+        """
+
+        :param index:           int     : This worker's index, 0 to worker_count - 1
+        :param worker_count:    int     : Worker processes serving machines
+        :param port_base:       int     : Private port of worker 0, worker n listens on port_base + n
+        :param host:            str     : Address the workers listen on
+        :param max_frame_size:  int     : Largest request accepted, in bytes
+        """
+        self.index = index
+        self.worker_count = worker_count
+        self.port_base = port_base
+        self.host = host
+        self.max_response_size = max_frame_size * self.RESPONSE_SIZE_RATIO
+        # Worker index -> [(reader, writer, last used)], only used on the event loop
+        self._idle = {}
+
+    def owner(self, machine_id):
+        return owner_of(machine_id, self.worker_count)
+
+    def owns(self, machine_id):
+        return self.owner(machine_id) == self.index
+
+    def private_port(self, index):
+        return self.port_base + index
+
+    async def forward(self, json_dict, timeout):
+        """
+        Send a request to the worker owning its machine and wait for the response
+
+        :param json_dict:   Dict        : Request read from the client
+        :param timeout:     float       : Seconds to wait for the owner to respond
+        :return:            ApiResult   : Owner's result, a failure if the owner could not be reached
+        """
+        owner = self.owner(json_dict.get("machine_id"))
+        # Options belong to the client's connection, not the session to the owner
+        request = {key: value for key, value in json_dict.items() if key not in ("keep_alive", "format")}
+        data = json.dumps(request, separators=(",", ":")).encode() + b"\n"
+
+        # Pooled connections the owner has closed are dropped here, before anything is sent
+        connection = self._take_idle(owner)
+        if connection is None:
+            try:
+                connection = await asyncio.wait_for(self._connect(owner), timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.warning(f"Could not connect to worker {owner}: {e}")
+                return ApiResult("Fail", success=False, errors=f"Worker {owner} for this machine is unavailable")
+
+        # Once sent the owner may have run the request, so it is never sent again
+        reader, writer = connection
+        try:
+            writer.write(data)
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if not line.endswith(b"\n"):
+                raise ConnectionError("Worker closed the connection")
+            result = ApiResult.from_dict(json.loads(line))
+        except ValueError as e:
+            # readline raises ValueError once a line passes the reader's limit
+            writer.close()
+            logging.warning(f"Could not relay response from worker {owner}: {e}")
+            return ApiResult("Fail", success=False,
+                             errors=f"Response from worker {owner} was larger than {self.max_response_size} bytes "
+                                    f"or not valid json, the request may have been applied")
+        except (OSError, asyncio.TimeoutError) as e:
+            writer.close()
+            logging.warning(f"No response from worker {owner}: {e!r}")
+            return ApiResult("Fail", success=False,
+                             errors=f"No response from worker {owner} for this machine, "
+                                    f"the request may have been applied")
+        self._put_idle(owner, reader, writer)
+        return result
+
+    async def _connect(self, owner):
+        reader, writer = await asyncio.open_connection(self.host, self.private_port(owner),
+                                                       limit=self.max_response_size)
+        writer.write(b'{"keep_alive":true,"format":"compact"}\n')
+        if not await reader.readline():
+            raise ConnectionError("Worker closed the connection")
+        return reader, writer
+
+    def _take_idle(self, owner):
+        idle = self._idle.get(owner)
+        now = time.monotonic()
+        while idle:
+            reader, writer, last_used = idle.pop()
+            if now - last_used < self.IDLE_SECONDS and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    def _put_idle(self, owner, reader, writer):
+        idle = self._idle.setdefault(owner, [])
+        if len(idle) < self.MAX_IDLE:
+            idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    def close(self):
+        for idle in self._idle.values():
+            for _, writer, _ in idle:
+                writer.close()
+        self._idle = {}
+
+
+def run_workers(worker_count, run_worker):
+    """
+    Fork the worker processes and wait for them to exit
+    SIGINT / SIGTERM to this process stops every worker, as does any worker exiting
+
+    :param worker_count:    int         : Worker processes to fork
+    :param run_worker:      callable    : Called with the worker index in each child, returns its exit code
+    :return:                int         : Exit code, 1 if any worker failed
+    """
+    workers = {}
+    for index in range(worker_count):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(_worker_main(index, run_worker))
+        workers[pid] = index
+
+    stopping = False
+
+    def stop(signum=None, frame=None):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    exit_code = 0
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = workers.pop(pid, None)
+        code = os.waitstatus_to_exitcode(status)
+        if code:
+            logging.error(f"Worker {index} exited with code {code}")
+            exit_code = 1
+        if not stopping:
+            # The machines it owned can no longer be served
+            stop()
+    return exit_code
+
+
+def _worker_main(index, run_worker):
+    """
+    :return:    int     : Exit code for the worker process
+    """
+    def stop(signum, frame):
+        Globals.running = False
+
+    # The main process passes on Ctrl-C as SIGTERM, so journals are closed cleanly
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        return run_worker(index) or 0
+    except Exception:
+        print(traceback.format_exc())
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
@@ -0,0 +1,211 @@
+import json
+import unittest
+import time
+import threading
+import select
+import socket
+
+from Server.async_server import AsyncServer
+from Server.encoders import BinaryEncoder
+from VendingMachineDir.MachineRegistry import MachineRegistry
+from VendingMachineDir.VM_globals import Globals
+from VendingMachineDir.VendingMachine import VendingMachine
+
+
+class TestAsyncServer(unittest.TestCase):
+
+    def setUp(self):
+        # Create new server on every test
+        Globals.v_machine = VendingMachine()
+        self.Server = AsyncServer()
+        self.Server.timeout = 2
+        Globals.running = True
+        self.server_thread = threading.Thread(target=self.Server.init_server)
+        self.server_thread.start()
+        time.sleep(1)
+
+    def tearDown(self):
+        # Stop and destroy server
+        Globals.running = False
+        self.server_thread.join()
+        Globals.v_machine = None
+
+    def _create_connection(self):
+        try:
+            connection = socket.socket()
+            connection.connect(('127.0.0.1', 22222))
+            return connection
+        except Exception as e:
+            self.fail(f"Problem creating connection to server! {e}")
+
+    def _send(self, j_input):
+        connection = self._create_connection()
+        connection.sendall(json.dumps(j_input, indent=4).encode())
+        received = connection.recv(4096).decode()
+        connection.close()
+        return json.loads(received)
+
+    def test_valid_deposit(self):
+        """
+        Sending valid json
+        Expecting "success" boolean to return true
+        """
+        json_obj = self._send({"deposit": {"coins": {"1": 1, "2": 1}}})
+        self.assertTrue(json_obj["success"] is True, "Expected successful action for valid deposit")
+        self.assertEqual(json_obj["deposit_total"], 3)
+
+    def test_slow_client_does_not_block(self):
+        """
+        Holding a connection open without sending data
+        Expecting a second client to be served before the first times out
+        """
+        slow = self._create_connection()
+        try:
+            start = time.time()
+            json_obj = self._send({"deposit": {"coins": {"1": 1}}})
+            self.assertTrue(json_obj["success"] is True)
+            self.assertLess(time.time() - start, self.Server.timeout,
+                            "Expected response before the idle connection timed out")
+
+            # The idle connection still gets its own timeout response
+            self.assertTrue("timeout" in slow.recv(4096).decode().lower())
+        finally:
+            slow.close()
+
+    def test_trickling_client_cut_off(self):
+        """
+        Sending a request one byte at a time, never pausing long enough to go idle
+        Expecting the total deadline to cut it off while other clients are served
+        """
+        self.Server.idle_timeout = 0.5
+        self.Server.request_timeout = 1
+        slow = self._create_connection()
+        try:
+            start = time.time()
+            for byte in b'{"deposit": {"coins": {"1": 1}}':
+                # Stop once the server has answered, sending after it closes would reset the connection
+                if select.select([slow], [], [], 0)[0]:
+                    break
+                slow.sendall(bytes([byte]))
+                json_obj = self._send({"deposit": {"coins": {"2": 1}}})
+                self.assertTrue(json_obj["success"] is True)
+                time.sleep(0.1)
+
+            response = slow.recv(4096).decode()
+            self.assertIn("took too long", response)
+            self.assertLess(time.time() - start, 2)
+        finally:
+            slow.close()
+
+    def test_stalled_request_cut_off(self):
+        """
+        Sending half a request then nothing
+        Expecting the idle deadline to cut it off before the total deadline
+        """
+        self.Server.idle_timeout = 0.3
+        slow = self._create_connection()
+        try:
+            start = time.time()
+            slow.sendall(b'{"deposit": {"coins"')
+            self.assertIn("stalled", slow.recv(4096).decode())
+            self.assertLess(time.time() - start, 1)
+        finally:
+            slow.close()
+
+    def test_concurrent_deposits_are_serialised(self):
+        """
+        Many clients depositing at the same time
+        Expecting every coin to be counted exactly once
+        """
+        results = []
+
+        def deposit():
+            results.append(self._send({"deposit": {"coins": {"2": 1}}}))
+
+        threads = [threading.Thread(target=deposit) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(all(item["success"] for item in results))
+        self.assertEqual(Globals.v_machine.user_deposited_total, 40)
+        self.assertEqual(Globals.v_machine.current_coins[2], 25)
+
+    def test_keep_alive_session(self):
+        """
+        Opening a keep alive session and sending several newline delimited requests
+        Expecting one json line back per request on the same socket
+        """
+        connection = self._create_connection()
+        reader = connection.makefile("rb")
+        try:
+            connection.sendall(b'{"keep_alive": true}\n')
+            self.assertTrue(json.loads(reader.readline())["success"])
+
+            connection.sendall(b'{"deposit": {"coins": {"1": 1}}}\n{"deposit": {"coins": {"2": 1}}}\n')
+            self.assertEqual(json.loads(reader.readline())["deposit_total"], 1)
+            self.assertEqual(json.loads(reader.readline())["deposit_total"], 3)
+
+            connection.sendall(b'not json\n{"deposit": {"coins": {"5": 1}}, "purchase": {"value": 4}}\n')
+            self.assertFalse(json.loads(reader.readline())["success"])
+            json_obj = json.loads(reader.readline())
+            self.assertTrue(json_obj["success"])
+            self.assertEqual(json_obj["coins"], {"2": 2})
+
+            connection.sendall(b'{"keep_alive": false}\n')
+            self.assertTrue(json.loads(reader.readline())["success"])
+            # Server closes the session after the closing request
+            self.assertEqual(reader.readline(), b"")
+        finally:
+            reader.close()
+            connection.close()
+
+    def test_format_negotiation(self):
+        """
+        Asking for compact json then binary responses in one keep alive session
+        Expecting each response in the format last asked for
+        """
+        connection = self._create_connection()
+        reader = connection.makefile("rb")
+        try:
+            connection.sendall(b'{"keep_alive": true, "format": "compact", "deposit": {"coins": {"5": 1}}}\n')
+            line = reader.readline()
+            self.assertTrue(line.startswith(b'{"response":"'))
+            self.assertEqual(json.loads(line)["deposit_total"], 5)
+
+            connection.sendall(b'{"format": "binary", "deposit": {"coins": {"1": 1}}, "purchase": {"value": 3}}\n')
+            length = int.from_bytes(reader.read(4), "big")
+            json_obj = BinaryEncoder.decode(reader.read(length))
+            self.assertTrue(json_obj["success"])
+            self.assertEqual(json_obj["coins"], {2: 1, 1: 1})
+
+            connection.sendall(b'{"format": "xml"}\n')
+            length = int.from_bytes(reader.read(4), "big")
+            self.assertFalse(BinaryEncoder.decode(reader.read(length))["success"])
+        finally:
+            reader.close()
+            connection.close()
+
+    def test_machine_ids(self):
+        """
+        Depositing into two machines served by the same process
+        Expecting each machine to keep its own deposit and unknown ids to fail
+        """
+        Globals.machines = MachineRegistry()
+        Globals.machines.create("a")
+        Globals.machines.create("b")
+        try:
+            self.assertEqual(self._send({"machine_id": "a", "deposit": {"coins": {"5": 1}}})["deposit_total"], 5)
+            self.assertEqual(self._send({"machine_id": "b", "deposit": {"coins": {"1": 1}}})["deposit_total"], 1)
+            self.assertEqual(self._send({"deposit": {"coins": {"2": 1}}})["deposit_total"], 2)
+            self.assertEqual(Globals.machines.get("a").user_deposited_total, 5)
+            self.assertEqual(Globals.machines.get("a").current_coins[5], 6)
+            self.assertEqual(Globals.v_machine.current_coins[5], 5)
+
+            self.assertFalse(self._send({"machine_id": "c", "deposit": {"coins": {"1": 1}}})["success"])
+            Globals.machines.auto_create = True
+            self.assertTrue(self._send({"machine_id": "c", "deposit": {"coins": {"1": 1}}})["success"])
+            self.assertIn("c", Globals.machines)
+        finally:
+            Globals.machines = None
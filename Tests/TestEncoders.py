@@ -0,0 +1,65 @@
+import json
+import unittest
+
+from Server.api_result import ApiResult
+from Server.encoders import BinaryEncoder, available_formats, get_encoder
+
+
+class TestEncoders(unittest.TestCase):
+
+    def setUp(self):
+        self.result = ApiResult("Successful batch.", success=True, deposit_total=120,
+                                results=[ApiResult("Successful purchase.", success=True, change={10: 1, 2: 2}),
+                                         ApiResult("Fail", success=False, errors=["one", "two"])])
+
+    def test_json_formats_match(self):
+        """
+        Encoding the same result as indented and compact json
+        Expecting the same object with fewer bytes for compact
+        """
+        indented = get_encoder("json").encode(self.result)
+        compact = get_encoder("compact").encode(self.result)
+        self.assertEqual(json.loads(indented), json.loads(compact))
+        self.assertLess(len(compact), len(indented))
+        self.assertNotIn(b"\n", compact)
+
+    def test_binary_round_trip(self):
+        """
+        Encoding a batch result in the binary format and decoding it
+        Expecting the same layout as the json formats with int coin keys
+        """
+        decoded = BinaryEncoder.decode(get_encoder("binary").encode(self.result))
+        self.assertTrue(decoded["success"])
+        self.assertEqual(decoded["deposit_total"], 120)
+        self.assertEqual(decoded["results"][0]["coins"], {10: 1, 2: 2})
+        self.assertEqual(decoded["results"][1]["errors"], {0: "one", 1: "two"})
+        self.assertFalse(decoded["results"][1]["success"])
+
+    def test_binary_session_status_and_stats(self):
+        """
+        Encoding results holding a session token, machine status and server stats in the binary format
+        Expecting the same dict back as the compact json format
+        """
+        for result in (ApiResult("Session opened.", success=True, session="abc_123"),
+                       ApiResult("Machine status.", success=True, deposit_total=5,
+                                 status={"exact_change_only": False, "change_total": 1880, "stock": {"A1": 2}}),
+                       ApiResult("Server stats.", success=True, stats={"counters": {"requests": 3}})):
+            decoded = BinaryEncoder.decode(get_encoder("binary").encode(result))
+            self.assertEqual(decoded, json.loads(get_encoder("compact").encode(result)))
+
+    def test_binary_session_frame(self):
+        """
+        Framing a binary result for a keep alive session
+        Expecting a 4 byte length prefix
+        """
+        encoder = get_encoder("binary")
+        framed = encoder.frame(self.result)
+        self.assertEqual(int.from_bytes(framed[:4], "big"), len(framed) - 4)
+
+    @unittest.skipUnless("orjson" in available_formats(), "orjson not installed")
+    def test_orjson_matches_json(self):
+        self.assertEqual(json.loads(get_encoder("orjson").encode(self.result)),
+                         json.loads(get_encoder("json").encode(self.result)))
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, get_encoder, "xml")
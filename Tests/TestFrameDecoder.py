@@ -0,0 +1,86 @@
+import json
+import unittest
+
+from Server.frame_decoder import FrameTooLargeError, JsonFrameDecoder
+
+
+class TestFrameDecoder(unittest.TestCase):
+
+    def test_split_across_reads(self):
+        """
+        Feeding a request one byte at a time
+        Expecting a frame only once the closing brace arrives
+        """
+        decoder = JsonFrameDecoder()
+        data = json.dumps({"deposit": {"coins": {"1": 1, "2": 1}}}, indent=4).encode()
+        for index in range(len(data) - 1):
+            decoder.feed(data[index:index + 1])
+            self.assertIsNone(decoder.next_frame())
+        decoder.feed(data[-1:])
+        self.assertEqual(decoder.next_frame(), {"deposit": {"coins": {"1": 1, "2": 1}}})
+        self.assertFalse(decoder.has_partial())
+
+    def test_braces_inside_strings(self):
+        """
+        Sending braces and escaped quotes inside json strings
+        Expecting them to be ignored when finding the end of the request
+        """
+        decoder = JsonFrameDecoder()
+        decoder.feed(b'{"note": "}}{ \\"}\\\\", "deposit": {"coins": {}}}')
+        self.assertEqual(decoder.next_frame(), {"note": '}}{ "}\\', "deposit": {"coins": {}}})
+
+    def test_escape_split_across_reads(self):
+        """
+        Splitting a read straight after a backslash inside a string
+        Expecting the escaped quote to not end the string
+        """
+        decoder = JsonFrameDecoder()
+        decoder.feed(b'{"note": "a\\')
+        self.assertIsNone(decoder.next_frame())
+        decoder.feed(b'"}"}')
+        self.assertEqual(decoder.next_frame(), {"note": 'a"}'})
+
+    def test_pipelined_frames(self):
+        """
+        Sending several newline delimited requests in a single read
+        Expecting each to be returned in order
+        """
+        decoder = JsonFrameDecoder()
+        decoder.feed(b'{"a": 1}\n{"b": 2}\n{"c"')
+        self.assertEqual(decoder.next_frame(), {"a": 1})
+        self.assertEqual(decoder.next_frame(), {"b": 2})
+        self.assertIsNone(decoder.next_frame())
+        self.assertTrue(decoder.has_partial())
+        decoder.feed(b': 3}\n')
+        self.assertEqual(decoder.next_frame(), {"c": 3})
+
+    def test_bad_line_is_skipped(self):
+        """
+        Sending a line which is not a json object followed by a valid request
+        Expecting a ValueError then the valid request
+        """
+        decoder = JsonFrameDecoder()
+        decoder.feed(b'None json formatted {string}\n{"a": 1}\n')
+        self.assertRaises(ValueError, decoder.next_frame)
+        self.assertEqual(decoder.next_frame(), {"a": 1})
+
+    def test_invalid_json_object(self):
+        """
+        Sending balanced braces which are not valid json
+        Expecting a ValueError and the decoder to carry on with the next request
+        """
+        decoder = JsonFrameDecoder()
+        decoder.feed(b'{"a": }{"b": 2}')
+        self.assertRaises(ValueError, decoder.next_frame)
+        self.assertEqual(decoder.next_frame(), {"b": 2})
+
+    def test_max_frame_size(self):
+        """
+        Sending a request larger than the max frame size
+        Expecting FrameTooLargeError
+        """
+        decoder = JsonFrameDecoder(max_frame_size=64)
+        decoder.feed(b'{"deposit": {"coins": {"1": 1')
+        self.assertIsNone(decoder.next_frame())
+        with self.assertRaises(FrameTooLargeError):
+            decoder.feed(b', "2": 1' * 10)
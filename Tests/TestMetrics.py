@@ -0,0 +1,86 @@
+import threading
+import unittest
+import urllib.request
+
+from Server.metrics import BUCKET_BOUNDS, Metrics, start_metrics_endpoint
+from Server.server_handler import Server
+from VendingMachineDir.VM_globals import Globals
+from VendingMachineDir.VendingMachine import VendingMachine
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_threads_merged(self):
+        """
+        Recording from several threads
+        Expecting every thread's counts in the merged stats
+        """
+        def record():
+            for _ in range(100):
+                self.metrics.increment("connections")
+                self.metrics.observe("read", 0.0005)
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = self.metrics.stats()
+        self.assertEqual(stats["counters"], {"connections": 400})
+        self.assertEqual(stats["timings"]["read"]["count"], 400)
+        self.assertAlmostEqual(stats["timings"]["read"]["mean_ms"], 0.5)
+
+    def test_percentiles_from_buckets(self):
+        """
+        99 fast timings and 1 slow one
+        Expecting p50 in the fast bucket and p999 in the slow bucket
+        """
+        for _ in range(99):
+            self.metrics.observe("parse", 3e-6)
+        self.metrics.observe("parse", 0.1)
+
+        timing = self.metrics.stats()["timings"]["parse"]
+        self.assertEqual(timing["p50_ms"], 0.004)
+        self.assertGreaterEqual(timing["p999_ms"], 100)
+        self.assertLess(timing["p99_ms"], 1)
+
+    def test_prometheus_text(self):
+        """
+        Prometheus text from the endpoint
+        Expecting counters as totals and cumulative histogram buckets
+        """
+        self.metrics.increment("connections", 3)
+        self.metrics.observe("encode", 1e-5)
+        endpoint = start_metrics_endpoint(self.metrics, 0)
+        try:
+            port = endpoint.server_address[1]
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                text = response.read().decode()
+        finally:
+            endpoint.shutdown()
+            endpoint.server_close()
+
+        self.assertIn("vending_connections_total 3\n", text)
+        self.assertIn('vending_encode_seconds_bucket{le="+Inf"} 1\n', text)
+        self.assertIn(f'vending_encode_seconds_bucket{{le="{BUCKET_BOUNDS[-1]:g}"}} 1\n', text)
+        self.assertIn('vending_encode_seconds_bucket{le="1e-06"} 0\n', text)
+        self.assertIn("vending_encode_seconds_count 1\n", text)
+
+    def test_stats_request(self):
+        """
+        Deposits then a stats request
+        Expecting the deposit handler timed and the stats in the response
+        """
+        Globals.v_machine = VendingMachine()
+        server = Server()
+        for _ in range(3):
+            server.handle_request({"deposit": {"coins": {"1": 1}}})
+        result = server.handle_request({"stats": {}})
+        Globals.v_machine = None
+
+        self.assertTrue(result.success)
+        self.assertEqual(result.to_dict()["stats"]["timings"]["handler_deposit"]["count"], 3)
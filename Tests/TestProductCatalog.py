@@ -0,0 +1,73 @@
+import unittest
+
+from Server.server_handler import Server
+from VendingMachineDir.ProductCatalog import ProductCatalog
+from VendingMachineDir.VM_globals import Globals
+from VendingMachineDir.VendingMachine import VendingMachine
+
+PRODUCTS = {"A1": {"price": 85, "quantity": 2, "name": "Crisps"},
+            "B2": {"price": 120, "quantity": 0}}
+
+
+class TestProductCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server()
+        Globals.v_machine = VendingMachine()
+        Globals.v_machine.products = ProductCatalog.from_dict(PRODUCTS)
+
+    def tearDown(self):
+        Globals.v_machine = None
+
+    def test_from_dict(self):
+        """
+        Loading products from json
+        Expecting the same products back, and invalid prices refused
+        """
+        catalog = ProductCatalog.from_dict(PRODUCTS)
+        self.assertEqual(catalog.to_dict(), PRODUCTS)
+        self.assertEqual(catalog.get("A1").price, 85)
+        self.assertIsNone(catalog.get("C3"))
+
+        for product in ({"price": 0}, {"price": "85"}, {"price": 85, "quantity": -1}, {"quantity": 1}):
+            with self.assertRaises(ValueError):
+                ProductCatalog.from_dict({"A1": product})
+
+    def test_purchase_by_slot(self):
+        """
+        Buying from a slot with a deposit over the price
+        Expecting change for the product's price and one less in stock
+        """
+        result = self.server.dispatch({"deposit": {"coins": {"100": 1}}, "purchase": {"slot": "A1"}})
+        self.assertTrue(result.success, result.errors)
+        self.assertEqual(result.change, {10: 1, 5: 1})
+        self.assertEqual(Globals.v_machine.products.quantity("A1"), 1)
+
+    def test_sold_out_slot(self):
+        """
+        Buying from an empty slot and an unknown slot
+        Expecting failures, with the coins deposited still credited
+        """
+        result = self.server.dispatch({"deposit": {"coins": {"200": 1}}, "purchase": {"slot": "B2"}})
+        self.assertFalse(result.success)
+        self.assertIn("sold out", result.errors)
+        self.assertEqual(Globals.v_machine.user_deposited_total, 200)
+
+        result = self.server.dispatch({"deposit": {"coins": {}}, "purchase": {"slot": "Z9"}})
+        self.assertIn("Unknown slot", result.errors)
+
+    def test_failed_purchase_keeps_stock(self):
+        """
+        Buying from a slot with too small a deposit, then in an atomic batch that fails
+        Expecting the stock untouched
+        """
+        result = self.server.dispatch({"deposit": {"coins": {"50": 1}}, "purchase": {"slot": "A1"}})
+        self.assertFalse(result.success)
+        self.assertEqual(Globals.v_machine.products.quantity("A1"), 2)
+
+        result = self.server.dispatch({"atomic": True, "batch": [
+            {"deposit": {"coins": {"50": 1}}, "purchase": {"slot": "A1"}},
+            {"deposit": {"coins": {}}, "purchase": {"slot": "B2"}}]})
+        self.assertFalse(result.success)
+        self.assertEqual(Globals.v_machine.products.quantity("A1"), 2)
+        self.assertEqual(Globals.v_machine.user_deposited_total, 50)
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from Server.profiler import SamplingProfiler
+from Server.server_handler import Server
+from VendingMachineDir.VM_globals import Globals
+from VendingMachineDir.VendingMachine import VendingMachine
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = Server()
+        Globals.v_machine = VendingMachine()
+
+    def tearDown(self):
+        if self.server.profiler is not None:
+            self.server.profiler.join()
+        Globals.v_machine = None
+        shutil.rmtree(self.directory)
+
+    def test_profile_disabled(self):
+        """
+        Profile request without a profiler
+        Expecting a failure and no file
+        """
+        result = self.server.handle_request({"profile": {"seconds": 1}})
+        self.assertFalse(result.success)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_profile_request_writes_stacks(self):
+        """
+        Profiling while another thread makes change
+        Expecting collapsed stacks naming the server and machine functions
+        """
+        self.server.profiler = SamplingProfiler(self.directory, interval=0.001)
+        stop = threading.Event()
+
+        def purchases():
+            while not stop.is_set():
+                Globals.v_machine.set_quantities({coin: 1000 for coin in Globals.v_machine.coin_names})
+                self.server.handle_request({"deposit": {"coins": {"200": 10}}, "purchase": {"value": 3}})
+
+        worker = threading.Thread(target=purchases)
+        worker.start()
+        try:
+            result = self.server.handle_request({"profile": {"seconds": 0.3}})
+            self.assertTrue(result.success)
+            # Only one run at a time
+            self.assertFalse(self.server.handle_request({"profile": {"seconds": 1}}).success)
+            self.server.profiler.join()
+        finally:
+            stop.set()
+            worker.join()
+
+        files = os.listdir(self.directory)
+        self.assertEqual(len(files), 1)
+        self.assertIn(files[0], result.response)
+        with open(os.path.join(self.directory, files[0])) as infile:
+            lines = infile.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(all(line.rsplit(" ", 1)[1].isdigit() for line in lines))
+        text = "\n".join(lines)
+        self.assertIn("Server.server_handler:Server.handle_purchase", text)
+        self.assertIn("VendingMachineDir.VendingMachine:VendingMachine.subtract_value", text)
+
+    def test_invalid_seconds(self):
+        """
+        Profile request with a bad duration
+        Expecting a failure
+        """
+        self.server.profiler = SamplingProfiler(self.directory)
+        self.assertFalse(self.server.handle_request({"profile": {"seconds": -1}}).success)
+        self.assertFalse(self.server.handle_request({"profile": {"seconds": "5"}}).success)
@@ -4,6 +4,7 @@ import unittest
 import time
 import threading
 import socket
+from unittest import mock
 
 from Server.server_handler import Server
 from VendingMachineDir.VM_globals import Globals
@@ -134,6 +135,17 @@ class TestServerApi(unittest.TestCase):
 
         connection.close()
 
+    def test_invalid_deposit_quantities(self):
+        """
+        Deposits with a quantity that is too large, negative, zero, a bool or a string next to a valid coin
+        Expecting each to fail with no coins added and nothing credited
+        """
+        for quantity in (10 ** 19, -10, 0, True, "1", 1.5):
+            result = self.Server.dispatch({"deposit": {"coins": {"200": 1, "1": quantity}}})
+            self.assertTrue(result.success is False, f"Expected failure for quantity {quantity!r}")
+        self.assertTrue(Globals.v_machine.current_coins == VendingMachine().current_coins)
+        self.assertTrue(Globals.v_machine.user_deposited_total == 0)
+
     def test_invalid_deposit_format(self):
         """
         Checking invalid deposit format returns success = False
@@ -361,4 +373,125 @@ class TestServerApi(unittest.TestCase):
         else:
             self.fail("Took longer than 5 seconds for vending machine response")
 
-        connection.close()
\ No newline at end of file
+        connection.close()
+
+    def test_keep_alive_session(self):
+        """
+        Opening a keep alive session and sending newline delimited requests
+        Expecting one json line back per request on the same socket
+        """
+        connection = self._create_connection()
+        reader = connection.makefile("rb")
+
+        connection.sendall(b'{"keep_alive": true, "deposit": {"coins": {"1": 1, "2": 1}}}\n')
+        json_obj = json.loads(reader.readline())
+        self.assertTrue(json_obj["deposit_total"] == 3,
+                        "Expected total deposit value of 3 for valid deposit")
+
+        connection.sendall(b'{"deposit": {"coins": {"1": 1}}, "purchase": {"value": 2}}\n{"keep_alive": false}\n')
+        json_obj = json.loads(reader.readline())
+        self.assertTrue(json_obj["success"] is True, "Expected success for valid purchase")
+        self.assertTrue(json_obj["coins"]["2"] == 1, "Expected 1 x 2p change for purchase")
+        self.assertTrue(json.loads(reader.readline())["success"] is True)
+        self.assertTrue(reader.readline() == b"", "Expected session to close")
+
+        reader.close()
+        connection.close()
+
+    def test_batch(self):
+        """
+        Sending a batch of deposits and a purchase
+        Expecting a result per operation in order
+        """
+        connection = self._create_connection()
+
+        j_input = {"batch": [{"deposit": {"coins": {"100": 1}}},
+                             {"deposit": {"coins": {"20": 1}}, "purchase": {"value": 110}},
+                             {"purchase": {"value": 1}}]}
+        connection.sendall(json.dumps(j_input, indent=4).encode())
+
+        json_obj = json.loads(connection.recv(4096).decode())
+        self.assertTrue(json_obj["success"] is False, "Expected failure as last operation fails")
+        self.assertTrue([item["success"] for item in json_obj["results"]] == [True, True, False])
+        self.assertTrue(json_obj["results"][1]["coins"] == {"10": 1}, "Expected 1 x 10p change for purchase")
+        self.assertTrue(Globals.v_machine.current_coins[100] == 6)
+
+        connection.close()
+
+    def test_atomic_batch_rolls_back(self):
+        """
+        Sending an atomic batch where the purchase is more than the deposit
+        Expecting no operations applied to the machine
+        """
+        connection = self._create_connection()
+
+        j_input = {"batch": [{"deposit": {"coins": {"1": 1}}},
+                             {"deposit": {"coins": {"2": 1}}, "purchase": {"value": 5}}],
+                   "atomic": True}
+        connection.sendall(json.dumps(j_input, indent=4).encode())
+
+        json_obj = json.loads(connection.recv(4096).decode())
+        self.assertTrue(json_obj["success"] is False, "Expected failure for atomic batch")
+        self.assertTrue(len(json_obj["results"]) == 2)
+        self.assertTrue(Globals.v_machine.user_deposited_total == 0, "Expected deposits to be rolled back")
+        self.assertTrue(Globals.v_machine.current_coins == VendingMachine().current_coins)
+
+        connection.close()
+
+    def test_atomic_batch_rolls_back_on_error(self):
+        """
+        Sending atomic batches where a later operation has coins that are not an object, or raises
+        Expecting a failure with no operations applied
+        """
+        j_input = {"batch": [{"deposit": {"coins": {"100": 1}}}, {"deposit": {"coins": [1]}}], "atomic": True}
+        result = self.Server.dispatch(j_input)
+        self.assertFalse(result.success)
+        self.assertIn("must be a json object", result.results[1].errors)
+
+        j_input = {"batch": [{"deposit": {"coins": {"100": 1}}},
+                             {"deposit": {"coins": {"20": 1}}, "purchase": {"value": 5}}], "atomic": True}
+        with mock.patch.object(VendingMachine, "subtract_value", side_effect=RuntimeError):
+            result = self.Server.dispatch(j_input)
+        self.assertFalse(result.success)
+        self.assertTrue(Globals.v_machine.user_deposited_total == 0, "Expected deposits to be rolled back")
+        self.assertTrue(Globals.v_machine.current_coins == VendingMachine().current_coins)
+
+    def test_status_exact_change_only(self):
+        """
+        Asking for status with no 1p coins left, then buying with change the machine cannot make
+        Expecting exact change only, and the purchase turned down
+        """
+        Globals.v_machine.current_coins[1] = 0
+        Globals.v_machine.set_quantities(Globals.v_machine.current_coins)
+
+        connection = self._create_connection()
+        connection.sendall(json.dumps({"keep_alive": True, "status": {}}).encode())
+        reader = connection.makefile("rb")
+        json_obj = json.loads(reader.readline())
+        self.assertTrue(json_obj["status"]["exact_change_only"] is True)
+
+        connection.sendall(b'{"deposit": {"coins": {"2": 1}}, "purchase": {"value": 1}}\n')
+        json_obj = json.loads(reader.readline())
+        self.assertTrue(json_obj["success"] is False)
+        self.assertIn("exact change", json_obj["errors"]["1"])
+        self.assertTrue(Globals.v_machine.current_coins[2] == 6, "Expected the deposit kept")
+
+        reader.close()
+        connection.close()
+
+    def test_machine_id_not_a_string(self):
+        """
+        Sending a machine id that is a json list, then a valid request
+        Expecting a failure for the bad id and the server still serving
+        """
+        connection = self._create_connection()
+        connection.sendall(json.dumps({"machine_id": ["x"], "deposit": {"coins": {"1": 1}}}).encode())
+        json_obj = json.loads(connection.recv(4096).decode())
+        self.assertTrue(json_obj["success"] is False, "Expected failure for machine id that is not a string")
+        connection.close()
+
+        connection = self._create_connection()
+        connection.sendall(json.dumps({"deposit": {"coins": {"1": 1}}}).encode())
+        json_obj = json.loads(connection.recv(4096).decode())
+        self.assertTrue(json_obj["success"] is True, "Expected server still serving")
+        connection.close()
@@ -0,0 +1,103 @@
+import unittest
+from unittest import mock
+
+from Server.server_handler import Server
+from VendingMachineDir.SessionTable import SessionTable
+from VendingMachineDir.VM_globals import Globals
+from VendingMachineDir.VendingMachine import VendingMachine
+
+
+class TestSessionTable(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server()
+        Globals.v_machine = VendingMachine()
+
+    def tearDown(self):
+        Globals.v_machine = None
+
+    def _open(self):
+        result = self.server.dispatch({"open_session": {}})
+        self.assertTrue(result.success, result.errors)
+        return result.session
+
+    def test_expired_sessions_dropped_oldest_first(self):
+        """
+        Opening sessions over time and using the first again
+        Expecting only sessions unused for longer than the ttl dropped
+        """
+        table = SessionTable()
+        with mock.patch("VendingMachineDir.SessionTable.time.monotonic") as monotonic:
+            monotonic.return_value = 0
+            first, second = table.open(), table.open()
+            monotonic.return_value = 200
+            table.get(first.token)
+            third = table.open()
+            monotonic.return_value = 350
+            self.assertIsNone(table.get(second.token))
+            self.assertEqual(list(table.sessions), [first.token, third.token])
+            monotonic.return_value = 600
+            self.assertEqual(len(table), 0)
+
+    def test_sessions_keep_their_own_credit(self):
+        """
+        Two sessions depositing in turn, then one buying
+        Expecting each purchase to spend only its own session's credit
+        """
+        first, second = self._open(), self._open()
+        self.server.dispatch({"session": first, "deposit": {"coins": {"100": 1}}})
+        result = self.server.dispatch({"session": second, "deposit": {"coins": {"20": 1}}})
+        self.assertEqual(result.deposit_total, 20)
+
+        result = self.server.dispatch({"session": second, "deposit": {"coins": {}}, "purchase": {"value": 50}})
+        self.assertFalse(result.success, "Expected the other session's credit not to be spent")
+
+        result = self.server.dispatch({"session": first, "deposit": {"coins": {}}, "purchase": {"value": 50}})
+        self.assertTrue(result.success, result.errors)
+        self.assertEqual(result.change, {50: 1})
+        self.assertEqual(Globals.v_machine.sessions.get(second).credit, 20)
+        self.assertEqual(Globals.v_machine.user_deposited_total, 0)
+
+    def test_unknown_session_and_close(self):
+        """
+        Using an unknown token, then closing a session with and without credit
+        Expecting failures for the unknown token and for closing with credit left
+        """
+        result = self.server.dispatch({"session": "nope", "deposit": {"coins": {"1": 1}}})
+        self.assertFalse(result.success)
+        self.assertEqual(Globals.v_machine.current_coins[1], 5, "Expected no coins taken")
+
+        token = self._open()
+        self.server.dispatch({"session": token, "deposit": {"coins": {"5": 1}}})
+        self.assertFalse(self.server.dispatch({"session": token, "close_session": {}}).success)
+        self.server.dispatch({"session": token, "deposit": {"coins": {}}, "purchase": {"value": 5}})
+        self.assertTrue(self.server.dispatch({"session": token, "close_session": {}}).success)
+        self.assertFalse(self.server.dispatch({"session": token, "status": {}}).success)
+
+    def test_atomic_batch_restores_session_credit(self):
+        """
+        Sending an atomic batch on a session where the purchase fails
+        Expecting the session's credit back to what it was
+        """
+        token = self._open()
+        self.server.dispatch({"session": token, "deposit": {"coins": {"10": 1}}})
+        result = self.server.dispatch({"session": token, "atomic": True, "batch": [
+            {"deposit": {"coins": {"20": 1}}}, {"deposit": {"coins": {}}, "purchase": {"value": 100}}]})
+        self.assertFalse(result.success)
+        self.assertEqual(Globals.v_machine.sessions.get(token).credit, 10)
+
+    def test_session_refund(self):
+        """
+        Two sessions depositing, then one asking for a refund
+        Expecting only that session's coins back, and the session then able to close
+        """
+        first, second = self._open(), self._open()
+        self.server.dispatch({"session": first, "deposit": {"coins": {"50": 1, "1": 2}}})
+        self.server.dispatch({"session": second, "deposit": {"coins": {"100": 1}}})
+
+        result = self.server.dispatch({"session": first, "refund": {}})
+        self.assertTrue(result.success, result.errors)
+        self.assertEqual(result.change, {50: 1, 1: 2})
+        self.assertEqual(Globals.v_machine.sessions.get(second).credit, 100)
+        self.assertEqual(self.server.dispatch({"session": first, "refund": {}}).response, "No credit to refund.")
+        self.assertTrue(self.server.dispatch({"session": first, "close_session": {}}).success)
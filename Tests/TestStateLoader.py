@@ -0,0 +1,130 @@
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from VendingMachineDir.CoinInventory import GBP_LAYOUT, CoinInventory
+from VendingMachineDir.StateLoader import load_state_file, write_binary_state
+from main import main
+
+
+class TestStateLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as outfile:
+            outfile.write(content)
+        return path
+
+    def test_csv_default_machine(self):
+        """
+        Loading the example csv
+        Expecting every coin set for the default machine and no errors
+        """
+        path = os.path.join(os.path.dirname(__file__), "..", "Resources", "in.csv")
+        result = load_state_file(path)
+        self.assertEqual(result.format, "csv")
+        self.assertEqual(result.errors, {})
+        self.assertEqual(result.machines, {"default": {coin: 4 for coin in GBP_LAYOUT.coins}})
+
+    def test_csv_errors_aggregated(self):
+        """
+        Csv with machine ids, invalid lines and unknown coins
+        Expecting valid lines loaded and errors grouped with their line numbers
+        """
+        path = self._write("state.csv", b"1,4\r\n\nbad line\n7,1\nA,5,9\nA,200,1\nnot,a,line\n3,1\n")
+        result = load_state_file(path)
+
+        self.assertEqual(result.machines, {"default": {1: 4}, "A": {5: 9, 200: 1}})
+        self.assertEqual(result.error_count(), 4)
+        self.assertEqual(result.errors["Coin '7' does not exist"], [1, [4]])
+        self.assertEqual(result.errors["Coin '3' does not exist"], [1, [8]])
+        self.assertEqual(len(result.summary()), 3)
+
+    def test_json(self):
+        """
+        Json for the default machine and for many machines
+        Expecting quantities read and invalid entries reported
+        """
+        path = self._write("default.json", b'{"1": 2, "200": 0}')
+        self.assertEqual(load_state_file(path).machines, {"default": {1: 2, 200: 0}})
+
+        path = self._write("fleet.json", b'{"machines": {"A": {"5": 1, "3": 1}, "B": {"10": -1, "20": 2}}}')
+        result = load_state_file(path)
+        self.assertEqual(result.format, "json")
+        self.assertEqual(result.machines, {"A": {5: 1}, "B": {20: 2}})
+        self.assertEqual(result.error_count(), 2)
+
+    def test_binary_round_trip(self):
+        """
+        Writing then loading a binary snapshot of many machines
+        Expecting the same quantities back, quickly
+        """
+        machines = {str(number): CoinInventory(GBP_LAYOUT, [number % 7] * len(GBP_LAYOUT.coins))
+                    for number in range(10000)}
+        machines["default"] = {1: 3, 200: 9}
+        path = os.path.join(self.directory, "fleet.vms")
+        write_binary_state(path, machines)
+
+        start = time.perf_counter()
+        result = load_state_file(path)
+        self.assertLess(time.perf_counter() - start, 1)
+
+        self.assertEqual(result.format, "binary")
+        self.assertEqual(result.errors, {})
+        self.assertEqual(len(result.machines), 10001)
+        self.assertEqual(result.machines["6"], machines["6"])
+        self.assertEqual(result.machines["default"], {1: 3, 2: 0, 5: 0, 10: 0, 20: 0, 50: 0, 100: 0, 200: 9})
+
+    def test_binary_truncated(self):
+        """
+        Binary snapshot cut short
+        Expecting the complete records loaded and the truncation reported
+        """
+        path = os.path.join(self.directory, "fleet.vms")
+        write_binary_state(path, {"A": {1: 1}, "B": {2: 2}})
+        with open(path, "rb") as infile:
+            data = infile.read()
+        path = self._write("cut.vms", data[:-4])
+
+        result = load_state_file(path)
+        self.assertEqual(list(result.machines), ["A"])
+        self.assertEqual(result.errors, {"Truncated machine record": [1, [2]]})
+
+    def test_unsafe_machine_ids(self):
+        """
+        Csv, json and binary state holding machine ids that would name files outside the journal directory
+        Expecting those machines reported as errors, the rest loaded
+        """
+        csv = self._write("unsafe.csv", b"../x,2,3\n,1,1\na:b,1,1\nA,1,2\n")
+        json_state = self._write("unsafe.json", b'{"machines": {"/abs": {"1": 1}, "A": {"1": 2}}}')
+        binary = os.path.join(self.directory, "unsafe.bin")
+        write_binary_state(binary, {"..": {1: 1}, "A": {1: 2}})
+
+        for path, count in ((csv, 3), (json_state, 1), (binary, 1)):
+            result = load_state_file(path)
+            self.assertEqual(list(result.machines), ["A"])
+            self.assertEqual(result.error_count(), count, result.summary())
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(main(["--check_state", csv]), 1)
+
+    def test_check_state_exit_code(self):
+        """
+        Checking valid, invalid and missing state files from the command line
+        Expecting exit codes 0, 1 and 2 without starting a server
+        """
+        valid = self._write("valid.csv", b"1,4\n")
+        invalid = self._write("invalid.csv", b"1,4\n9,9\n")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(main(["--check_state", valid]), 0)
+            self.assertEqual(main(["--check_state", invalid]), 1)
+            self.assertEqual(main(["--check_state", os.path.join(self.directory, "missing.csv")]), 2)
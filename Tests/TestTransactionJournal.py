@@ -0,0 +1,292 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from Server.server_handler import Server
+from VendingMachineDir.MachineRegistry import MachineRegistry
+from VendingMachineDir.ProductCatalog import ProductCatalog
+from VendingMachineDir.TransactionJournal import TransactionJournal
+from VendingMachineDir.VM_globals import Globals
+from VendingMachineDir.VendingMachine import VendingMachine
+
+
+class TestTransactionJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = Server()
+        Globals.v_machine = self._recovered_machine()
+
+    def tearDown(self):
+        Globals.v_machine.journal.close()
+        Globals.v_machine = None
+        shutil.rmtree(self.directory)
+
+    def _recovered_machine(self, **kwargs):
+        machine = VendingMachine()
+        machine.products = ProductCatalog.from_dict({"A1": {"price": 60, "quantity": 5}})
+        machine.journal = TransactionJournal(self.directory, "default", **kwargs)
+        machine.journal.recover(machine)
+        return machine
+
+    def _restart(self, **kwargs):
+        """
+        Drop the running machine without syncing or snapshotting, like a crash
+        """
+        journal = Globals.v_machine.journal
+        if journal._flush_timer is not None:
+            journal._flush_timer.cancel()
+        journal._file.close()
+        Globals.v_machine = self._recovered_machine(**kwargs)
+
+    def test_recover_after_crash(self):
+        """
+        Depositing and purchasing then restarting
+        Expecting the same coins and deposit total after recovery
+        """
+        self.server.dispatch({"deposit": {"coins": {"100": 1}}})
+        self.server.dispatch({"deposit": {"coins": {"20": 1}}, "purchase": {"value": 90}})
+        self.server.dispatch({"deposit": {"coins": {"5": 2}}})
+        coins = Globals.v_machine.current_coins.to_dict()
+
+        self._restart()
+        self.assertEqual(Globals.v_machine.current_coins, coins)
+        self.assertEqual(Globals.v_machine.user_deposited_total, 10)
+        self.assertEqual(Globals.v_machine.current_change_total, Globals.v_machine.calc_current_change_total())
+
+    def test_stock_recovered(self):
+        """
+        Buying from a slot then restarting, before and after a snapshot
+        Expecting the stock sold to stay sold
+        """
+        self.server.dispatch({"deposit": {"coins": {"50": 1, "10": 1}}, "purchase": {"slot": "A1"}})
+        self._restart()
+        self.assertEqual(Globals.v_machine.products.quantity("A1"), 4)
+
+        Globals.v_machine.journal.write_snapshot(Globals.v_machine)
+        self.server.dispatch({"deposit": {"coins": {"50": 1, "10": 1}}, "purchase": {"slot": "A1"}})
+        self._restart()
+        self.assertEqual(Globals.v_machine.products.quantity("A1"), 3)
+
+    def test_refund_recovered(self):
+        """
+        Depositing, refunding, then restarting
+        Expecting the machine back to its starting coins with no credit
+        """
+        coins = Globals.v_machine.current_coins.to_dict()
+        self.server.dispatch({"deposit": {"coins": {"200": 1, "5": 1}}})
+        result = self.server.dispatch({"refund": {}})
+        self.assertEqual(result.change, {200: 1, 5: 1})
+
+        self._restart()
+        self.assertEqual(Globals.v_machine.current_coins, coins)
+        self.assertEqual(Globals.v_machine.user_deposited_total, 0)
+
+    def test_failed_request_not_journaled(self):
+        """
+        A request that changes nothing
+        Expecting no journal line
+        """
+        self.server.dispatch({"purchase": {"value": 1}})
+        self.assertEqual(Globals.v_machine.journal.seq, 0)
+
+    def test_request_raising_still_journaled(self):
+        """
+        Depositing with an invalid purchase value, then with a handler raising after the deposit
+        Expecting the deposits kept in memory and after recovery alike
+        """
+        result = self.server.dispatch({"deposit": {"coins": {"100": 1}}, "purchase": {"value": "x"}})
+        self.assertFalse(result.success)
+        with mock.patch.object(VendingMachine, "subtract_value", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.server.dispatch({"deposit": {"coins": {"1": 1}}, "purchase": {"value": 60}})
+        coins = Globals.v_machine.current_coins.to_dict()
+        self.assertEqual(Globals.v_machine.user_deposited_total, 101)
+
+        self._restart()
+        self.assertEqual(Globals.v_machine.current_coins, coins)
+        self.assertEqual(Globals.v_machine.user_deposited_total, 101)
+
+    def test_session_credit_recovered(self):
+        """
+        Depositing into two sessions, spending one, then restarting before and after a snapshot
+        Expecting the unspent session's credit and coins back under the same token
+        """
+        first = self.server.dispatch({"open_session": {}}).session
+        second = self.server.dispatch({"open_session": {}}).session
+        self.server.dispatch({"session": first, "deposit": {"coins": {"50": 1, "10": 1}}})
+        self.server.dispatch({"session": second, "deposit": {"coins": {"20": 2}}})
+        self.server.dispatch({"session": first, "deposit": {"coins": {}}, "purchase": {"value": 60}})
+
+        self._restart()
+        sessions = Globals.v_machine.sessions
+        self.assertEqual(sessions.state(second), (40, {20: 2}))
+        self.assertIsNone(sessions.get(first))
+        self.assertEqual(Globals.v_machine.user_deposited_total, 0)
+
+        Globals.v_machine.journal.write_snapshot(Globals.v_machine)
+        self._restart()
+        result = self.server.dispatch({"session": second, "refund": {}})
+        self.assertTrue(result.success)
+        self.assertEqual(result.change, {20: 2})
+
+        self._restart()
+        self.assertEqual(len(Globals.v_machine.sessions), 0)
+
+    def test_snapshot_bounds_replay(self):
+        """
+        Writing more changes than the snapshot interval
+        Expecting recovery to replay only the lines after the last snapshot
+        """
+        Globals.v_machine.journal.close()
+        Globals.v_machine = self._recovered_machine(snapshot_every=10)
+        for _ in range(25):
+            self.server.dispatch({"deposit": {"coins": {"1": 1}}})
+
+        Globals.v_machine.journal._file.flush()
+        with open(Globals.v_machine.journal.journal_path) as infile:
+            self.assertEqual(len(infile.readlines()), 5)
+
+        self._restart(snapshot_every=10)
+        self.assertEqual(Globals.v_machine.current_coins[1], 30)
+        self.assertEqual(Globals.v_machine.user_deposited_total, 25)
+
+    def test_torn_line_ignored(self):
+        """
+        A half written line at the end of the journal
+        Expecting it to be skipped and later lines to be readable
+        """
+        self.server.dispatch({"deposit": {"coins": {"2": 1}}})
+        Globals.v_machine.journal._file.write('{"seq": 2, "coi')
+        self._restart()
+        self.assertEqual(Globals.v_machine.user_deposited_total, 2)
+
+        self.server.dispatch({"deposit": {"coins": {"2": 1}}})
+        self._restart()
+        self.assertEqual(Globals.v_machine.user_deposited_total, 4)
+        self.assertEqual(Globals.v_machine.current_coins[2], 7)
+
+    def test_burst_synced_once_idle(self):
+        """
+        A burst of deposits too small to fill a batch, then no more requests
+        Expecting every line synced once the interval passes
+        """
+        Globals.v_machine.journal.close()
+        Globals.v_machine = self._recovered_machine(fsync_batch=100, fsync_interval=0.05)
+        journal = Globals.v_machine.journal
+        for _ in range(3):
+            self.server.dispatch({"deposit": {"coins": {"1": 1}}})
+        self.assertEqual(journal.seq, 3)
+        self.assertLess(journal.durable_seq, 3)
+
+        time.sleep(0.3)
+        self.assertEqual(journal.durable_seq, 3)
+        self.assertIsNone(journal._flush_timer)
+
+    def test_group_commit_shares_fsync(self):
+        """
+        Concurrent deposits with group commit
+        Expecting every deposit synced before its response and fewer fsyncs than deposits
+        """
+        Globals.v_machine.journal.close()
+        Globals.v_machine = self._recovered_machine(group_commit=True, fsync_interval=0.02)
+        journal = Globals.v_machine.journal
+        record = journal.record
+        seqs = threading.local()
+        unsynced_responses = []
+
+        def recording(*args):
+            seqs.seq = record(*args)
+            return seqs.seq
+
+        def deposit():
+            self.server.dispatch({"deposit": {"coins": {"1": 1}}})
+            if journal.durable_seq < seqs.seq:
+                unsynced_responses.append(seqs.seq)
+
+        journal.record = recording
+
+        with mock.patch("os.fsync", wraps=os.fsync) as fsync:
+            threads = [threading.Thread(target=deposit) for _ in range(16)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(journal.seq, 16)
+        self.assertEqual(journal.durable_seq, 16)
+        self.assertEqual(unsynced_responses, [])
+        self.assertLess(fsync.call_count, 16)
+
+        # The lines were on disk when acknowledged, not only when closed
+        self._restart()
+        self.assertEqual(Globals.v_machine.user_deposited_total, 16)
+
+    def test_group_commit_lone_request_skips_window(self):
+        """
+        One deposit at a time with group commit and a long window
+        Expecting each synced before its response without waiting out the window
+        """
+        Globals.v_machine.journal.close()
+        Globals.v_machine = self._recovered_machine(group_commit=True, fsync_interval=1)
+        journal = Globals.v_machine.journal
+        start = time.perf_counter()
+        for _ in range(3):
+            self.server.dispatch({"deposit": {"coins": {"1": 1}}})
+            self.assertEqual(journal.durable_seq, journal.seq)
+        self.assertLess(time.perf_counter() - start, 1)
+
+    def test_group_commit_waits_on_event_loop(self):
+        """
+        Concurrent deposits through a 2 thread pool, waiting for durability on the event loop
+        Expecting every deposit synced before its response, more deposits in flight than threads,
+        and fewer fsyncs than deposits
+        """
+        Globals.v_machine.journal.close()
+        Globals.v_machine = self._recovered_machine(group_commit=True, fsync_interval=0.05)
+        journal = Globals.v_machine.journal
+        executor = ThreadPoolExecutor(max_workers=2)
+        unsynced_responses = []
+
+        async def deposit():
+            loop = asyncio.get_running_loop()
+            result, _, seq = await loop.run_in_executor(executor, self.server.apply,
+                                                        {"deposit": {"coins": {"1": 1}}})
+            await journal.wait_durable_async(seq)
+            if journal.durable_seq < seq:
+                unsynced_responses.append(seq)
+
+        async def run():
+            await asyncio.gather(*(deposit() for _ in range(16)))
+
+        with mock.patch("os.fsync", wraps=os.fsync) as fsync:
+            asyncio.run(run())
+        executor.shutdown()
+
+        self.assertEqual(journal.durable_seq, 16)
+        self.assertEqual(unsynced_responses, [])
+        # Waiting on the loop frees the threads, so commits hold more lines than there are threads
+        self.assertLess(fsync.call_count, 8)
+
+    def test_machine_ids_kept_in_journal_directory(self):
+        """
+        Auto creating machines with ids that are paths, then a plain id
+        Expecting the path ids refused and only the plain id's files written, inside the directory
+        """
+        registry = MachineRegistry(auto_create=True)
+        registry.journal_dir = os.path.join(self.directory, "machines", "journals")
+        for machine_id in ("../escaped", os.path.join(self.directory, "absolute"), "a\\b", "C:c", "..", ""):
+            self.assertIsNone(registry.get(machine_id), f"Expected id {machine_id!r} refused")
+            with self.assertRaises(ValueError):
+                registry.create(machine_id)
+
+        registry.get("a.1").journal.close()
+        self.assertEqual(os.listdir(os.path.dirname(registry.journal_dir)), ["journals"])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "absolute.journal")))
+        self.assertEqual(sorted(os.listdir(registry.journal_dir)), ["a.1.journal"])
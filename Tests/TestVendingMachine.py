@@ -0,0 +1,231 @@
+import itertools
+import random
+import time
+import unittest
+
+from Server.server_handler import Server
+from VendingMachineDir.CoinInventory import GBP_LAYOUT, PROFILES, CoinInventory, load_layout
+from VendingMachineDir.VendingMachine import VendingMachine
+
+
+class TestVendingMachine(unittest.TestCase):
+
+    def setUp(self):
+        self.v_machine = VendingMachine()
+
+    def _set_stock(self, stock):
+        coins = {coin: 0 for coin in self.v_machine.coin_names}
+        coins.update(stock)
+        self.v_machine.set_quantities(coins)
+
+    def test_change_greedy_would_miss(self):
+        """
+        6p change with no 1p coins but 5p and three 2p coins
+        Expecting 3 x 2p, taking the 5p would leave 1p that can't be made
+        """
+        self._set_stock({2: 3, 5: 1})
+        self.assertEqual(self.v_machine.subtract_value(6), {2: 3})
+        self.assertEqual(self.v_machine.current_coins[2], 0)
+        self.assertEqual(self.v_machine.current_coins[5], 1)
+
+    def test_change_impossible_leaves_stock(self):
+        """
+        Asking for change the coins held cannot make
+        Expecting None and no coins taken from the machine
+        """
+        self._set_stock({2: 3, 5: 1})
+        before = dict(self.v_machine.current_coins)
+        self.assertIsNone(self.v_machine.subtract_value(1))
+        self.assertIsNone(self.v_machine.subtract_value(12))
+        self.assertEqual(self.v_machine.current_coins, before)
+
+    def test_change_prefers_large_coins(self):
+        """
+        Default stock
+        Expecting the fewest coins, largest first
+        """
+        self.assertEqual(self.v_machine.subtract_value(388), {200: 1, 100: 1, 50: 1, 20: 1, 10: 1, 5: 1, 2: 1, 1: 1})
+        self.assertEqual(self.v_machine.subtract_value(0), {})
+
+    def test_change_matches_brute_force(self):
+        """
+        Random small stocks and amounts
+        Expecting the fewest coins found by trying every combination
+        """
+        generator = random.Random(4)
+        coins = [1, 2, 5, 10, 20]
+        for _ in range(100):
+            stock = {coin: generator.randint(0, 3) for coin in coins}
+            self._set_stock(stock)
+            value = generator.randint(0, 60)
+
+            fewest = None
+            for counts in itertools.product(*(range(stock[coin] + 1) for coin in coins)):
+                if sum(coin * count for coin, count in zip(coins, counts)) == value:
+                    if fewest is None or sum(counts) < fewest:
+                        fewest = sum(counts)
+
+            change = self.v_machine.find_change(value)
+            if fewest is None:
+                self.assertIsNone(change)
+            else:
+                self.assertEqual(sum(coin * count for coin, count in change.items()), value)
+                self.assertEqual(sum(change.values()), fewest)
+                self.assertTrue(all(change[coin] <= stock[coin] for coin in change))
+
+    def test_change_above_cap(self):
+        """
+        Asking for change far above the change cap, and more than the machine holds
+        Expecting the largest coins used first and the exact amount made, or None
+        """
+        self.v_machine.add_coins({200: 5000})
+        start = time.perf_counter()
+        change = self.v_machine.find_change(200 * 5000 + 388)
+        self.assertLess(time.perf_counter() - start, 0.1)
+        self.assertEqual(sum(coin * count for coin, count in change.items()), 200 * 5000 + 388)
+        self.assertEqual(change[200], 5001)
+        self.assertIsNone(self.v_machine.find_change(self.v_machine.current_change_total + 1))
+
+    def test_negative_stock_holds_no_coins(self):
+        """
+        A coin with a negative quantity
+        Expecting change still made from the other coins
+        """
+        self.v_machine.add_coins({1: -10})
+        self.assertEqual(self.v_machine.find_change(7), {5: 1, 2: 1})
+        self.assertIsNone(self.v_machine.find_change(1))
+
+    def test_reachable_change_matches_find_change(self):
+        """
+        Random stocks, then coins added and taken out
+        Expecting can_make_change to agree with find_change for every amount up to the cap
+        """
+        generator = random.Random(7)
+        self.v_machine.change_cap = 400
+        for _ in range(20):
+            self._set_stock({coin: generator.randint(0, 4) for coin in self.v_machine.coin_names})
+            self.v_machine.add_coins({generator.choice(self.v_machine.coin_names): generator.randint(1, 3)})
+            self.v_machine.subtract_value(generator.randint(0, 50))
+            self.v_machine.add_coins({2: 1})
+            for value in range(self.v_machine.change_cap + 1):
+                self.assertEqual(self.v_machine.can_make_change(value),
+                                 self.v_machine.find_change(value) is not None, f"{value}p")
+
+    def test_exact_change_only(self):
+        """
+        Emptying the small coins, then depositing some back
+        Expecting exact change only while some amount under 200p cannot be made
+        """
+        self.assertFalse(self.v_machine.exact_change_only())
+        self._set_stock({5: 10, 10: 10, 20: 10, 50: 10, 100: 10, 200: 10})
+        self.assertTrue(self.v_machine.exact_change_only())
+        self.assertFalse(self.v_machine.can_make_change(3))
+        self.v_machine.add_coins({1: 1, 2: 2})
+        self.assertFalse(self.v_machine.exact_change_only())
+        self.assertTrue(self.v_machine.can_make_change(3))
+
+    def test_refund_prefers_inserted_coins(self):
+        """
+        Refunding 40p inserted as 4 x 10p, with 20p coins also held
+        Expecting the 10p coins back rather than the fewest coins
+        """
+        self.v_machine.add_coins({10: 4})
+        self.assertEqual(self.v_machine.refund(40, {10: 4}), {10: 4})
+        self.assertEqual(self.v_machine.current_coins[10], 5)
+        self.assertEqual(self.v_machine.current_coins[20], 5)
+
+    def test_refund_falls_back_to_change(self):
+        """
+        Refunding 23p inserted as 1 x 20p and 3 x 1p, after the 1p coins were given out
+        Expecting the 20p back and the rest made from other coins, or nothing taken if impossible
+        """
+        self._set_stock({20: 1, 2: 1, 5: 1})
+        self.assertIsNone(self.v_machine.refund(23, {20: 1, 1: 3}))
+        self.assertEqual(self.v_machine.current_coins, {1: 0, 2: 1, 5: 1, 10: 0, 20: 1, 50: 0, 100: 0, 200: 0})
+
+        self._set_stock({20: 1, 1: 1, 2: 1, 5: 1})
+        self.assertEqual(self.v_machine.refund(23, {20: 1, 1: 3}), {20: 1, 1: 1, 2: 1})
+        self.assertEqual(self.v_machine.current_change_total, 5)
+
+    def test_running_change_total(self):
+        """
+        Adding, dispensing, resetting and restoring coins with the consistency check on
+        Expecting the running total to always match a full recount
+        """
+        VendingMachine.check_consistency = True
+        try:
+            snapshot = self.v_machine.snapshot()
+            self.v_machine.add_coins({1: 3, 200: 2})
+            self.assertEqual(self.v_machine.current_change_total, 1940 + 403)
+            self.v_machine.subtract_value(257)
+            self.assertEqual(self.v_machine.current_change_total, 1940 + 403 - 257)
+            self.v_machine.restore(snapshot)
+            self.assertEqual(self.v_machine.current_change_total, 1940)
+            self.v_machine.set_quantities({1: 1, 2: 1})
+            self.assertEqual(self.v_machine.current_change_total, 3)
+            self.v_machine.reset_coins_to_default()
+            self.assertEqual(self.v_machine.current_change_total, 1940)
+
+            # Changing coins behind the machine's back is caught on the next change
+            self.v_machine.current_coins[5] += 1
+            self.assertRaises(RuntimeError, self.v_machine.add_coins, {1: 1})
+        finally:
+            VendingMachine.check_consistency = False
+
+    def test_coin_inventory(self):
+        """
+        Reading, writing, snapshotting and restoring an inventory
+        Expecting dict like behaviour and restore to undo changes
+        """
+        inventory = CoinInventory.from_dict({1: 2, 200: 3})
+        self.assertEqual(inventory[1], 2)
+        self.assertEqual(inventory[5], 0)
+        self.assertEqual(inventory.total(), 602)
+        self.assertEqual(inventory, {1: 2, 2: 0, 5: 0, 10: 0, 20: 0, 50: 0, 100: 0, 200: 3})
+        self.assertNotIn(3, inventory)
+        self.assertIsNone(inventory.get(3))
+        with self.assertRaises(KeyError):
+            inventory[3] = 1
+
+        snapshot = inventory.snapshot()
+        inventory[1] += 10
+        self.assertEqual(inventory[1], 12)
+        inventory.restore(snapshot)
+        self.assertEqual(inventory[1], 2)
+
+        copy = inventory.copy()
+        copy[200] = 0
+        self.assertEqual(inventory[200], 3)
+
+    def test_load_layout(self):
+        """
+        Loading named and custom denomination profiles
+        Expecting each built once and shared, and invalid coins refused
+        """
+        self.assertIs(load_layout("GBP"), GBP_LAYOUT)
+        self.assertEqual(load_layout("usd").coins, (1, 5, 10, 25, 50, 100))
+        tokens = load_layout("TOKENS:25,5,1")
+        self.assertEqual(tokens.coins, (1, 5, 25))
+        self.assertEqual(tokens.valid, frozenset((1, 5, 25)))
+        self.assertIs(load_layout("TOKENS"), tokens)
+        try:
+            for profile in ("FOO", "1,0", "1,x", "TOKENS:1,2"):
+                with self.assertRaises(ValueError, msg=profile):
+                    load_layout(profile)
+        finally:
+            PROFILES.pop("TOKENS")
+
+    def test_usd_machine(self):
+        """
+        Depositing GBP and USD coins in a USD machine, then buying
+        Expecting the 2c coin refused and change made from USD coins
+        """
+        machine = VendingMachine(layout=load_layout("USD"))
+        server = Server()
+        result = server.handle_deposit({"deposit": {"coins": {"25": 2, "2": 1}}}, machine)
+        self.assertEqual(result.deposit_total, 50)
+        self.assertEqual(result.errors, ["Invalid key found in json : '2'. Skipping value."])
+
+        result = server.handle_purchase({"deposit": {"coins": {}}, "purchase": {"value": 20}}, machine)
+        self.assertTrue(result.success, result.errors)
+        self.assertEqual(result.change, {25: 1, 5: 1})
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+from Benchmarks.bench_startup import MAIN, ROOT, free_port
+from Server.api_result import ApiResult
+from Server.workers import WorkerRouter, supported
+from VendingMachineDir.MachineRegistry import MachineRegistry, owner_of
+
+
+class TestWorkers(unittest.TestCase):
+
+    def test_owner_of(self):
+        """
+        Picking the worker for machine ids
+        Expecting the default machine on worker 0, and every id on the same worker each time
+        """
+        self.assertEqual(owner_of(None, 4), 0)
+        self.assertEqual(owner_of(MachineRegistry.DEFAULT_ID, 4), 0)
+        owners = [owner_of(str(machine_id), 4) for machine_id in range(100)]
+        self.assertEqual(owners, [owner_of(str(machine_id), 4) for machine_id in range(100)])
+        self.assertEqual(set(owners), {0, 1, 2, 3}, "Expected machines spread over every worker")
+
+    def test_registry_only_creates_owned_machines(self):
+        """
+        Auto creating machines in a registry for worker 1 of 2
+        Expecting only the machines worker 1 owns to be created
+        """
+        registry = MachineRegistry(auto_create=True)
+        registry.worker_index, registry.worker_count = 1, 2
+        for machine_id in map(str, range(20)):
+            machine = registry.get(machine_id)
+            self.assertEqual(machine is not None, owner_of(machine_id, 2) == 1)
+
+    def test_result_round_trip(self):
+        """
+        Rebuilding a result from its dict, as when relayed from another worker
+        Expecting the same dict back
+        """
+        result = ApiResult("Batch completed with failures.", success=False, deposit_total=120,
+                           results=[ApiResult("Successful purchase.", success=True, change={20: 1, 5: 1}),
+                                    ApiResult("Fail", success=False, errors="Not enough change")])
+        decoded = json.loads(json.dumps(result.to_dict()))
+        self.assertEqual(json.dumps(ApiResult.from_dict(decoded).to_dict()), json.dumps(result.to_dict()))
+
+    def test_forward_not_retried_after_send(self):
+        """
+        Forwarding twice over a pooled connection to an owner that only answers the first request
+        Expecting the second to fail once the timeout passes, and to be sent only once
+        """
+        received = []
+        closed = asyncio.Event()
+
+        async def owner(reader, writer):
+            # Answer the connection options and the first request, then sit on every request
+            for _ in range(2):
+                await reader.readline()
+                writer.write(b'{"response":"Ok","success":true}\n')
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                received.append(line)
+            writer.close()
+            closed.set()
+
+        async def run():
+            server = await asyncio.start_server(owner, "127.0.0.1", 0)
+            router = WorkerRouter(1, 2, server.sockets[0].getsockname()[1])
+            try:
+                self.assertTrue((await router.forward({"deposit": {"coins": {"1": 1}}}, 0.2)).success)
+                return await router.forward({"deposit": {"coins": {"1": 1}}}, 0.2)
+            finally:
+                router.close()
+                await asyncio.wait_for(closed.wait(), 5)
+                server.close()
+                await server.wait_closed()
+
+        result = asyncio.run(run())
+        self.assertFalse(result.success)
+        self.assertIn("may have been applied", result.errors)
+        self.assertEqual(len(received), 1, "Expected the request sent only once")
+
+    @unittest.skipUnless(supported(), "Needs fork and SO_REUSEPORT")
+    def test_requests_reach_owning_worker(self):
+        """
+        Depositing on several machines through a server with 3 workers, a new connection each time
+        Expecting each machine's deposits to add up, whichever worker accepted the connection
+        """
+        port = free_port()
+        process = subprocess.Popen([sys.executable, MAIN, "--port", str(port), "--workers", "3",
+                                    "--worker_port", str(free_port()), "--machines", "6"],
+                                   cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            self._wait_for(port)
+            for machine_id in ("default", "1", "2", "3", "4", "5", "6"):
+                for _ in range(4):
+                    json_obj = self._send(port, {"machine_id": machine_id, "deposit": {"coins": {"2": 1}}})
+                    self.assertTrue(json_obj["success"] is True, json_obj)
+                self.assertEqual(json_obj["deposit_total"], 8, f"Deposits lost on machine {machine_id}")
+
+            # Responses far larger than a stream reader's default 64 KiB line limit
+            for machine_id in ("1", "2", "3"):
+                json_obj = self._send(port, {"machine_id": machine_id, "format": "compact",
+                                             "batch": [{"deposit": {"coins": {"1": 1}}}] * 1500})
+                self.assertTrue(json_obj["success"] is True, json_obj.get("errors"))
+                self.assertEqual(len(json_obj["results"]), 1500)
+                self.assertEqual(json_obj["results"][-1]["deposit_total"], 1508)
+
+            json_obj = self._send(port, {"machine_id": "5", "format": "compact",
+                                         "deposit": {"coins": {"100": 1}}, "purchase": {"value": 103}})
+            self.assertTrue(json_obj["success"] is True, json_obj)
+            self.assertEqual(json_obj["coins"], {"5": 1})
+        finally:
+            process.terminate()
+            self.assertEqual(process.wait(10), 0)
+
+    @staticmethod
+    def _wait_for(port, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                # Every worker, not just the first to bind
+                time.sleep(0.5)
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("Server did not start")
+
+    @staticmethod
+    def _send(port, j_input):
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as connection:
+            connection.sendall(json.dumps(j_input).encode())
+            chunks = []
+            while True:
+                chunk = connection.recv(4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        return json.loads(b"".join(chunks))
@@ -0,0 +1,188 @@
+""" Compact store of coin quantities held by a vending machine
+
+Quantities live in a fixed width array indexed by the coin's position in
+a CoinLayout. The layout is shared between every machine using the same
+coins, so each machine only holds its own array.
+
+Layouts for each currency are built once, by name from PROFILES or from a
+custom list of coins, and everything derived from the coins - the sort
+order, array positions and the set deposits are checked against - is
+worked out then rather than per request.
+"""
+import json
+import os
+from array import array
+
+
+class CoinLayout:
+    """Denominations in ascending order, the array index of each and the set of valid coins"""
+    __slots__ = ("name", "coins", "index", "valid")
+
+    def __init__(self, coins, name=None):
+        """
+
+        :param coins:   Iterable[int]   : Coin values (in the currency's smallest unit, e.g. pence)
+        :param name:    str             : Currency or token name, e.g. 'GBP'
+        :raises ValueError              : No coins, or a coin that is not a whole number greater than 0
+        """
+        coins = tuple(coins)
+        if not coins:
+            raise ValueError("A coin layout needs at least one coin")
+        for coin in coins:
+            if isinstance(coin, bool) or not isinstance(coin, int) or coin <= 0:
+                raise ValueError(f"Coin values must be whole numbers greater than 0, got {coin!r}")
+        self.name = name
+        self.coins = tuple(sorted(set(coins)))
+        self.index = {coin: position for position, coin in enumerate(self.coins)}
+        self.valid = frozenset(self.coins)
+
+    def __repr__(self):
+        return f"CoinLayout({self.name}, {list(self.coins)})"
+
+
+# Default (GBP) coins
+GBP_LAYOUT = CoinLayout((1, 2, 5, 10, 20, 50, 100, 200), "GBP")
+
+# Layouts by name, custom layouts are added as they are loaded
+PROFILES = {"GBP": GBP_LAYOUT,
+            "EUR": CoinLayout((1, 2, 5, 10, 20, 50, 100, 200), "EUR"),
+            "USD": CoinLayout((1, 5, 10, 25, 50, 100), "USD")}
+
+
+def load_layout(profile):
+    """
+    Coin layout for a denomination profile, built once and shared by every machine
+
+    :param profile: str         : 'GBP', 'EUR' or 'USD', coins as '<NAME>:<coin>,<coin>,...' or
+                                  '<coin>,<coin>,...', or a json file {"name": str, "coins": [int, ...]}
+    :return:        CoinLayout
+    :raises ValueError          : Unknown profile or invalid coins
+    :raises OSError             : Profile file cannot be read
+    """
+    layout = PROFILES.get(profile.upper())
+    if layout is not None:
+        return layout
+
+    if os.path.isfile(profile):
+        with open(profile, "r") as infile:
+            data = json.load(infile)
+        if not isinstance(data, dict) or not isinstance(data.get("coins"), list):
+            raise ValueError(f"Profile file {profile} must hold a json object with a 'coins' list")
+        name, coins = data.get("name"), data["coins"]
+    else:
+        name, _, coins = profile.rpartition(":")
+        try:
+            coins = [int(coin) for coin in coins.split(",")]
+        except ValueError:
+            raise ValueError(f"Unknown currency '{profile}', expected one of {', '.join(PROFILES)} "
+                             f"or a list of coins like 'TOKENS:1,5,25'") from None
+        name = name or None
+
+    layout = CoinLayout(coins, name)
+    if name:
+        existing = PROFILES.get(name.upper())
+        if existing is not None and existing.coins != layout.coins:
+            raise ValueError(f"Profile '{name}' is already loaded with different coins {list(existing.coins)}")
+        layout = PROFILES.setdefault(name.upper(), layout)
+    return layout
+
+
+class CoinInventory:
+    """
+    Dict like view of coin quantities - inventory[coin] = quantity
+
+    Only coins in the layout can be stored, others raise KeyError
+    """
+    __slots__ = ("layout", "counts")
+    # Largest quantity of a coin the int64 array can hold
+    MAX_QUANTITY = 2 ** 63 - 1
+
+    def __init__(self, layout=GBP_LAYOUT, counts=None):
+        """
+
+        :param layout:  CoinLayout      : Coins this inventory can hold
+        :param counts:  Iterable[int]   : Quantity of each coin in layout order, 0 if not passed
+        """
+        self.layout = layout
+        if counts is None:
+            self.counts = array("q", bytes(8 * len(layout.coins)))
+        else:
+            self.counts = array("q", counts)
+            if len(self.counts) != len(layout.coins):
+                raise ValueError(f"Expected {len(layout.coins)} coin quantities, got {len(self.counts)}")
+
+    @classmethod
+    def from_dict(cls, coins, layout=GBP_LAYOUT):
+        """
+        :param coins:   Dict{int, int}  : Coin quantities, missing coins are 0
+        :param layout:  CoinLayout      : Coins the inventory can hold
+        :return:        CoinInventory
+        """
+        inventory = cls(layout)
+        for coin, quantity in coins.items():
+            inventory[int(coin)] = int(quantity)
+        return inventory
+
+    def __getitem__(self, coin):
+        return self.counts[self.layout.index[coin]]
+
+    def __setitem__(self, coin, quantity):
+        self.counts[self.layout.index[coin]] = quantity
+
+    def __contains__(self, coin):
+        return coin in self.layout.index
+
+    def __iter__(self):
+        return iter(self.layout.coins)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __eq__(self, other):
+        if isinstance(other, CoinInventory):
+            return self.layout.coins == other.layout.coins and self.counts == other.counts
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __repr__(self):
+        return f"CoinInventory({self.to_dict()})"
+
+    def get(self, coin, default=None):
+        position = self.layout.index.get(coin)
+        if position is None:
+            return default
+        return self.counts[position]
+
+    def keys(self):
+        return self.layout.coins
+
+    def values(self):
+        return self.counts.tolist()
+
+    def items(self):
+        return zip(self.layout.coins, self.counts)
+
+    def to_dict(self):
+        return dict(zip(self.layout.coins, self.counts))
+
+    def copy(self):
+        return CoinInventory(self.layout, self.counts)
+
+    def total(self):
+        """
+        :return: int    : Value of all the coins held
+        """
+        return sum(coin * quantity for coin, quantity in zip(self.layout.coins, self.counts))
+
+    def snapshot(self):
+        """
+        :return: array  : Copy of the quantities, a single memory copy
+        """
+        return self.counts[:]
+
+    def restore(self, snapshot):
+        """
+        :param snapshot: array  : Value returned from snapshot()
+        """
+        self.counts = snapshot[:]
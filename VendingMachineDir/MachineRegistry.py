@@ -0,0 +1,142 @@
+""" Class holding every vending machine served by this process, keyed by machine id
+
+Requests pick a machine with the 'machine_id' key, requests without one
+use the default machine in Globals.v_machine. Each machine has its own
+lock so requests for different machines do not wait on each other.
+
+When served by several worker processes each machine is owned by exactly
+one of them, picked by owner_of, and a worker's registry only holds the
+machines it owns.
+"""
+import threading
+import zlib
+
+from VendingMachineDir.CoinInventory import GBP_LAYOUT
+from VendingMachineDir.VendingMachine import VendingMachine
+
+
+def owner_of(machine_id, worker_count):
+    """
+    Worker process owning a machine, the same in every process and across restarts
+
+    :param machine_id:      str     : Id sent in the request, None for the default machine
+    :param worker_count:    int     : Worker processes serving machines
+    :return:                int     : Index of the owning worker, the default machine is always worker 0
+    """
+    if machine_id is None or machine_id == MachineRegistry.DEFAULT_ID or worker_count <= 1:
+        return 0
+    return zlib.crc32(str(machine_id).encode()) % worker_count
+
+
+def is_safe_id(machine_id):
+    """
+    Check an id can name a machine's journal files without leaving the journal directory
+
+    :param machine_id:  str     : Id sent in the request
+    :return:            Boolean : True for a non empty string without '..', path separators or a drive ':'
+    """
+    return (isinstance(machine_id, str) and machine_id != "" and ".." not in machine_id
+            and not any(char in machine_id for char in "/\\:\0"))
+
+
+class MachineRegistry:
+    # Id addressing the default machine, Globals.v_machine
+    DEFAULT_ID = "default"
+
+    def __init__(self, auto_create=False, layout=GBP_LAYOUT):
+        """
+
+        :param auto_create: Boolean     : Create a machine in the default state for unknown ids
+        :param layout:      CoinLayout  : Coins taken by the machines created
+        """
+        self.machines = {}
+        self.auto_create = auto_create
+        self.layout = layout
+        # Directory for each machine's TransactionJournal, None to keep state in memory only
+        self.journal_dir = None
+        # Keyword arguments for each TransactionJournal, e.g. group_commit
+        self.journal_options = {}
+        # ProductCatalog copied into each machine created, None for no products
+        self.products = None
+        # This process's share of the machines, see owner_of
+        self.worker_index = 0
+        self.worker_count = 1
+        # Only taken when adding machines, lookups read the dict directly
+        self._lock = threading.Lock()
+
+    def __contains__(self, machine_id):
+        return machine_id in self.machines
+
+    def __len__(self):
+        return len(self.machines)
+
+    def ids(self):
+        return list(self.machines)
+
+    def owns(self, machine_id):
+        """
+        :param machine_id:  str     : Id sent in the request
+        :return:            Boolean : True if this process serves the machine
+        """
+        return owner_of(machine_id, self.worker_count) == self.worker_index
+
+    def get(self, machine_id):
+        """
+        :param machine_id:  str             : Id sent in the request
+        :return:            VendingMachine  : Machine for the id, None if unknown
+        """
+        machine = self.machines.get(machine_id)
+        if machine is None and self.auto_create and is_safe_id(machine_id) and self.owns(machine_id):
+            machine = self.create(machine_id)
+        return machine
+
+    def add(self, machine_id, machine):
+        """
+        :param machine_id:  str             : Id requests will use for the machine
+        :param machine:     VendingMachine  : Machine to serve
+        """
+        with self._lock:
+            self.machines[machine_id] = machine
+
+    def create(self, machine_id, state=None):
+        """
+        Add a new machine, or return the existing one if the id is taken
+
+        :param machine_id:  str             : Id requests will use for the machine
+        :param state:       Dict{int, int}  : Default coin state, VendingMachine default if not passed
+        :return:            VendingMachine
+        :raises ValueError                  : Id is not safe to name files with, see is_safe_id
+        """
+        if not is_safe_id(machine_id):
+            raise ValueError(f"Machine id '{machine_id}' must not be empty or hold '..', '/', '\\' or ':'")
+        with self._lock:
+            if machine_id not in self.machines:
+                machine = VendingMachine(state, self.layout)
+                if self.products is not None:
+                    machine.products = self.products.copy()
+                if self.journal_dir:
+                    self.attach_journal(machine_id, machine)
+                self.machines[machine_id] = machine
+            return self.machines[machine_id]
+
+    def attach_journal(self, machine_id, machine):
+        """
+        Recover a machine from its journal then record its changes there
+
+        :param machine_id:  str             : Id of the machine, used for the file names
+        :param machine:     VendingMachine  : Machine to recover
+        :return:            int             : Number of journal lines replayed
+        """
+        # Only needed with a journal directory, so not imported at start-up
+        from VendingMachineDir.TransactionJournal import TransactionJournal
+
+        machine.journal = TransactionJournal(self.journal_dir, machine_id, **self.journal_options)
+        return machine.journal.recover(machine)
+
+    def close(self):
+        """
+        Flush every journal to disk, used on shutdown
+        """
+        for machine in self.machines.values():
+            if machine.journal is not None:
+                machine.journal.close()
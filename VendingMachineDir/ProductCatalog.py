@@ -0,0 +1,155 @@
+""" Products a vending machine sells, keyed by slot id
+
+Each slot holds one product with a price (in pence) and a quantity in
+stock. Products are looked up by slot id in a dict, quantities live in a
+fixed width array indexed by the product's position, so taking a snapshot
+of the stock is a single memory copy like CoinInventory.
+"""
+from array import array
+
+
+class Product:
+    """Product in one slot, its quantity is held by the catalog"""
+    __slots__ = ("slot", "name", "price", "index")
+
+    def __init__(self, slot, name, price, index):
+        """
+
+        :param slot:    str     : Slot id, e.g. 'A1'
+        :param name:    str     : Product name, None if not set
+        :param price:   int     : Price in pence
+        :param index:   int     : Position of the product's quantity in the catalog
+        """
+        self.slot = slot
+        self.name = name
+        self.price = price
+        self.index = index
+
+
+class ProductCatalog:
+    __slots__ = ("products", "quantities")
+
+    def __init__(self):
+        # Slot id -> Product
+        self.products = {}
+        # Quantity of each product, by Product.index
+        self.quantities = array("q")
+
+    @classmethod
+    def from_dict(cls, products):
+        """
+        :param products:    Dict    : Slot id -> {"price": int, "quantity": int, "name": str}
+        :return:            ProductCatalog
+        :raises ValueError          : Missing or invalid price / quantity
+        """
+        if not isinstance(products, dict):
+            raise ValueError("Products must be a json object of slot id to product")
+        catalog = cls()
+        for slot, product in products.items():
+            if not isinstance(product, dict) or "price" not in product:
+                raise ValueError(f"Product in slot '{slot}' must be a json object with a 'price'")
+            catalog.add(slot, product["price"], product.get("quantity", 0), product.get("name"))
+        return catalog
+
+    def __contains__(self, slot):
+        return str(slot) in self.products
+
+    def __len__(self):
+        return len(self.products)
+
+    def __iter__(self):
+        return iter(self.products)
+
+    def add(self, slot, price, quantity=0, name=None):
+        """
+        Add a product, or replace the product already in the slot
+
+        :param slot:        str     : Slot id, e.g. 'A1'
+        :param price:       int     : Price in pence, greater than 0
+        :param quantity:    int     : Quantity in stock
+        :param name:        str     : Product name
+        :raises ValueError          : Price or quantity not a whole number in range
+        """
+        if isinstance(price, bool) or not isinstance(price, int) or price <= 0:
+            raise ValueError(f"Price for slot '{slot}' must be a whole number of pence greater than 0")
+        if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity < 0:
+            raise ValueError(f"Quantity for slot '{slot}' must be a whole number, 0 or more")
+
+        slot = str(slot)
+        product = self.products.get(slot)
+        if product is None:
+            self.products[slot] = Product(slot, name, price, len(self.quantities))
+            self.quantities.append(quantity)
+        else:
+            product.name = name
+            product.price = price
+            self.quantities[product.index] = quantity
+
+    def get(self, slot):
+        """
+        :param slot:    str     : Slot id sent in the request
+        :return:        Product : Product in the slot, None if the slot is unknown
+        """
+        return self.products.get(str(slot))
+
+    def quantity(self, slot):
+        """
+        :param slot:    str     : Slot id
+        :return:        int     : Quantity in stock
+        :raises KeyError        : Unknown slot
+        """
+        return self.quantities[self.products[str(slot)].index]
+
+    def set_quantity(self, slot, quantity):
+        self.quantities[self.products[str(slot)].index] = quantity
+
+    def take(self, slot):
+        """
+        Remove one of the product in a slot from stock
+
+        :param slot:    str     : Slot id
+        :raises ValueError      : Slot is sold out
+        """
+        index = self.products[str(slot)].index
+        if self.quantities[index] <= 0:
+            raise ValueError(f"Slot '{slot}' is sold out")
+        self.quantities[index] -= 1
+
+    def stock(self):
+        """
+        :return: Dict{str, int} : Quantity in stock per slot
+        """
+        return {slot: self.quantities[product.index] for slot, product in self.products.items()}
+
+    def to_dict(self):
+        """
+        :return: Dict   : Slot id -> product, in the layout read by from_dict
+        """
+        catalog = {}
+        for slot, product in self.products.items():
+            catalog[slot] = {"price": product.price, "quantity": self.quantities[product.index]}
+            if product.name is not None:
+                catalog[slot]["name"] = product.name
+        return catalog
+
+    def copy(self):
+        """
+        :return: ProductCatalog : Catalog with the same products, stock not shared
+        """
+        catalog = ProductCatalog()
+        catalog.products = {slot: Product(slot, product.name, product.price, product.index)
+                            for slot, product in self.products.items()}
+        catalog.quantities = self.quantities[:]
+        return catalog
+
+    def snapshot(self):
+        """
+        :return: array  : Copy of the quantities, a single memory copy
+        """
+        return self.quantities[:]
+
+    def restore(self, snapshot):
+        """
+        :param snapshot: array  : Value returned from snapshot()
+        """
+        self.quantities = snapshot[:]
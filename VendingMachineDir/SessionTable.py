@@ -0,0 +1,118 @@
+""" Sessions holding each customer's credit on a vending machine
+
+A client opens a session and sends its token with each deposit and
+purchase, so the credit from its deposits is only spent by its own
+purchases rather than by whoever buys next.
+
+Sessions are kept in a dict by token in order of last use. Every use
+moves a session to the end, so expired sessions are always at the front
+and are dropped from there without scanning the table. The table is only
+used while holding its machine's lock.
+"""
+import secrets
+import time
+from collections import OrderedDict
+
+
+class Session:
+    __slots__ = ("token", "credit", "coins", "last_used")
+
+    def __init__(self, token, now):
+        """
+
+        :param token:   str     : Token the client sends as 'session'
+        :param now:     float   : time.monotonic() the session was opened
+        """
+        self.token = token
+        # Value deposited and not yet spent (in pence)
+        self.credit = 0
+        # Coins making up the credit, handed back first by a refund
+        self.coins = {}
+        self.last_used = now
+
+
+class SessionTable:
+    # Seconds a session lasts without being used, set from --session_ttl
+    ttl = 300
+    # Open sessions allowed per machine
+    max_sessions = 10000
+
+    def __init__(self):
+        self.sessions = OrderedDict()
+
+    def __len__(self):
+        self.expire()
+        return len(self.sessions)
+
+    def open(self):
+        """
+        :return: Session    : New session with no credit, None if the table is full
+        """
+        now = time.monotonic()
+        self.expire(now)
+        if len(self.sessions) >= self.max_sessions:
+            return None
+        session = Session(secrets.token_urlsafe(16), now)
+        self.sessions[session.token] = session
+        return session
+
+    def get(self, token):
+        """
+        Find a session and mark it used
+
+        :param token:   str     : Token sent in the request
+        :return:        Session : Session for the token, None if unknown or expired
+        """
+        now = time.monotonic()
+        self.expire(now)
+        session = self.sessions.get(token) if isinstance(token, str) else None
+        if session is not None:
+            session.last_used = now
+            self.sessions.move_to_end(token)
+        return session
+
+    def state(self, token):
+        """
+        Credit held by a session, without marking it used
+
+        :param token:   str     : Token sent in the request, any value
+        :return:        tuple   : (credit, coins), (0, {}) if the session is unknown
+        """
+        session = self.sessions.get(token) if isinstance(token, str) else None
+        if session is None:
+            return 0, {}
+        return session.credit, dict(session.coins)
+
+    def restore(self, token, credit, coins):
+        """
+        Put back a session recovered from the journal, its ttl starting again from now
+
+        :param token:   str             : Token the client sends as 'session'
+        :param credit:  int             : Value deposited and not yet spent (in pence)
+        :param coins:   Dict{int, int}  : Coins making up the credit
+        """
+        session = Session(token, time.monotonic())
+        session.credit = credit
+        session.coins = dict(coins)
+        self.sessions[token] = session
+
+    def close(self, token):
+        self.sessions.pop(token, None)
+
+    def expire(self, now=None):
+        """
+        Drop sessions unused for longer than ttl, with any credit they held
+
+        :param now:     float   : time.monotonic(), read if not passed
+        :return:        int     : Sessions dropped
+        """
+        if now is None:
+            now = time.monotonic()
+        dropped = 0
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if now - session.last_used < self.ttl:
+                break
+            self.sessions.popitem(last=False)
+            dropped += 1
+        return dropped
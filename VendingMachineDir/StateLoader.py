@@ -0,0 +1,280 @@
+""" Load start-up coin state for one or many machines from a state file
+
+Three formats are read, picked from the file contents:
+
+    csv     : 'coin,quantity' per line for the default machine,
+              'machine_id,coin,quantity' per line for any machine
+    json    : {"coin": quantity, ...} for the default machine, or
+              {"machines": {"machine_id": {"coin": quantity, ...}, ...}}
+    binary  : Snapshot written by write_binary_state, see BINARY_HEADER
+
+Files are memory mapped rather than read line by line, so large fleet wide
+dumps are parsed straight from the page cache. Problems are gathered into
+the StateLoadResult, grouped by message, rather than printed per line.
+"""
+import json
+import mmap
+import re
+import struct
+import sys
+from array import array
+
+from VendingMachineDir.CoinInventory import GBP_LAYOUT, CoinInventory
+from VendingMachineDir.MachineRegistry import MachineRegistry, is_safe_id
+
+# Binary snapshot, all little endian
+#   header  : magic b"VMST", version, padding, coin count (uint16), machine count (uint32)
+#   coins   : denomination (uint32) per coin
+#   machine : id length (uint16), utf-8 id, quantity (int64) per coin, per machine
+BINARY_MAGIC = b"VMST"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sBxHI")
+BINARY_ID_LENGTH = struct.Struct("<H")
+
+# One csv line, either a valid record or anything else reported as invalid
+CSV_LINE = re.compile(rb"^[ \t]*(?:(?:([^,\r\n]*),)?(\d+),(\d+)|(.*?))[ \t\r]*$", re.MULTILINE)
+
+# Machine ids name journal files, so ids MachineRegistry would refuse are reported like any bad line
+UNSAFE_ID_ERROR = "Machine id must not be empty or hold '..', '/', '\\' or ':'"
+
+# Line / record numbers kept per error message
+MAX_ERROR_LOCATIONS = 5
+
+
+class StateLoadResult:
+    def __init__(self, path, file_format):
+        """
+
+        :param path:        str     : File loaded
+        :param file_format: str     : 'csv', 'json' or 'binary'
+        """
+        self.path = path
+        self.format = file_format
+        # Coin quantities read per machine id, Dict{int, int} or CoinInventory
+        self.machines = {}
+        # Error message -> [count, first few line / record numbers]
+        self.errors = {}
+
+    def add_error(self, message, location=None):
+        """
+        :param message:     str     : Problem found, shared by every place it occurs
+        :param location:    int     : Line or record number, None for the whole file
+        """
+        entry = self.errors.get(message)
+        if entry is None:
+            entry = self.errors[message] = [0, []]
+        entry[0] += 1
+        if location is not None and len(entry[1]) < MAX_ERROR_LOCATIONS:
+            entry[1].append(location)
+
+    def error_count(self):
+        return sum(count for count, _ in self.errors.values())
+
+    def summary(self):
+        """
+        :return: list   : One line per error message, with how often and where it occurred
+        """
+        lines = []
+        for message, (count, locations) in self.errors.items():
+            where = ""
+            if locations:
+                where = f" (first at {', '.join(str(location) for location in locations)})"
+            lines.append(f"{self.path} : {message} x{count}{where}")
+        return lines
+
+
+def detect_format(data):
+    """
+    :param data:    bytes like  : Start of the file
+    :return:        str         : 'binary', 'json' or 'csv'
+    """
+    if data[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        return "binary"
+    if data[:64].lstrip()[:1] == b"{":
+        return "json"
+    return "csv"
+
+
+def load_state_file(path, layout=GBP_LAYOUT):
+    """
+    Read every machine's coin state from a state file
+
+    :param path:    str         : State file to read
+    :param layout:  CoinLayout  : Coins the machines hold, others are reported as errors
+    :return:        StateLoadResult
+    :raises OSError             : File cannot be opened
+    """
+    with open(path, "rb") as infile:
+        try:
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            return StateLoadResult(path, "csv")
+
+    with data:
+        file_format = detect_format(data)
+        result = StateLoadResult(path, file_format)
+        if file_format == "binary":
+            _load_binary(data, layout, result)
+        elif file_format == "json":
+            _load_json(data, layout, result)
+        else:
+            _load_csv(data, layout, result)
+    return result
+
+
+def _load_csv(data, layout, result):
+    machines = result.machines
+    index = layout.index
+    line_number = 0
+    for match in CSV_LINE.finditer(data):
+        line_number += 1
+        machine_id, coin, quantity, other = match.groups()
+        if other is not None:
+            if other:
+                result.add_error("Invalid line, required form 'coin,quantity' or 'machine_id,coin,quantity'",
+                                 line_number)
+            continue
+
+        coin = int(coin)
+        if coin not in index:
+            result.add_error(f"Coin '{coin}' does not exist", line_number)
+            continue
+
+        machine_id = machine_id.strip().decode() if machine_id is not None else MachineRegistry.DEFAULT_ID
+        if not is_safe_id(machine_id):
+            result.add_error(UNSAFE_ID_ERROR, line_number)
+            continue
+        coins = machines.get(machine_id)
+        if coins is None:
+            coins = machines[machine_id] = {}
+        # As we're setting the new state, this is overridden, not appended to
+        coins[coin] = int(quantity)
+
+
+def _load_json(data, layout, result):
+    try:
+        state = json.loads(data[:])
+    except ValueError as err:
+        result.add_error(f"Invalid json : {err}")
+        return
+    if not isinstance(state, dict):
+        result.add_error("Expected a json object")
+        return
+
+    machines = state.get("machines")
+    if machines is None:
+        machines = {MachineRegistry.DEFAULT_ID: state}
+    elif not isinstance(machines, dict):
+        result.add_error("'machines' must map machine ids to coins")
+        return
+
+    for record, (machine_id, coins) in enumerate(machines.items(), start=1):
+        if not is_safe_id(machine_id):
+            result.add_error(UNSAFE_ID_ERROR, record)
+            continue
+        if not isinstance(coins, dict):
+            result.add_error("Machine coins must map coin to quantity", record)
+            continue
+        quantities = {}
+        for coin, quantity in coins.items():
+            try:
+                coin = int(coin)
+            except ValueError:
+                result.add_error(f"Coin '{coin}' does not exist", record)
+                continue
+            if coin not in layout.index:
+                result.add_error(f"Coin '{coin}' does not exist", record)
+            elif type(quantity) is not int or quantity < 0:
+                result.add_error("Quantities must be whole numbers, 0 or more", record)
+            else:
+                quantities[coin] = quantity
+        result.machines[machine_id] = quantities
+
+
+def _load_binary(data, layout, result):
+    if len(data) < BINARY_HEADER.size:
+        result.add_error("Truncated binary header")
+        return
+    magic, version, coin_count, machine_count = BINARY_HEADER.unpack_from(data, 0)
+    if version != BINARY_VERSION:
+        result.add_error(f"Unsupported binary state version {version}")
+        return
+
+    offset = BINARY_HEADER.size
+    if offset + 4 * coin_count > len(data):
+        result.add_error("Truncated binary header")
+        return
+    coins = struct.unpack_from(f"<{coin_count}I", data, offset)
+    offset += 4 * coin_count
+    # Quantities in file order can be used as they are when the coins match the layout
+    same_layout = coins == layout.coins
+    for coin in coins:
+        if coin not in layout.index:
+            result.add_error(f"Coin '{coin}' does not exist")
+    counts_size = 8 * coin_count
+
+    size = len(data)
+    with memoryview(data) as view:
+        for record in range(1, machine_count + 1):
+            if offset + BINARY_ID_LENGTH.size > size:
+                result.add_error("Truncated machine record", record)
+                return
+            id_length, = BINARY_ID_LENGTH.unpack_from(view, offset)
+            offset += BINARY_ID_LENGTH.size
+            end = offset + id_length + counts_size
+            if end > size:
+                result.add_error("Truncated machine record", record)
+                return
+            try:
+                machine_id = str(view[offset:offset + id_length], "utf-8")
+            except UnicodeDecodeError:
+                result.add_error("Machine id is not utf-8", record)
+                offset = end
+                continue
+            offset += id_length
+            if not is_safe_id(machine_id):
+                result.add_error(UNSAFE_ID_ERROR, record)
+                offset = end
+                continue
+
+            counts = array("q")
+            counts.frombytes(view[offset:end])
+            offset = end
+            if sys.byteorder == "big":
+                counts.byteswap()
+
+            if min(counts, default=0) < 0:
+                result.add_error("Quantities must be whole numbers, 0 or more", record)
+                continue
+            if same_layout:
+                result.machines[machine_id] = CoinInventory(layout, counts)
+            else:
+                result.machines[machine_id] = {coin: quantity for coin, quantity in zip(coins, counts)
+                                               if coin in layout.index}
+
+
+def write_binary_state(path, machines, layout=GBP_LAYOUT):
+    """
+    Write machines' coin state as a binary snapshot, the fastest format to load
+
+    :param path:        str                             : File to write
+    :param machines:    Dict{str, Dict{int, int}}       : Coin quantities per machine id,
+                                                          dicts or CoinInventory, missing coins are 0
+    :param layout:      CoinLayout                      : Coins to write
+    """
+    parts = [BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(layout.coins), len(machines)),
+             struct.pack(f"<{len(layout.coins)}I", *layout.coins)]
+    for machine_id, coins in machines.items():
+        if not isinstance(coins, CoinInventory):
+            coins = CoinInventory.from_dict(coins, layout)
+        machine_id = machine_id.encode()
+        counts = coins.counts[:]
+        if sys.byteorder == "big":
+            counts.byteswap()
+        parts.append(BINARY_ID_LENGTH.pack(len(machine_id)))
+        parts.append(machine_id)
+        parts.append(counts.tobytes())
+
+    with open(path, "wb") as outfile:
+        outfile.write(b"".join(parts))
@@ -0,0 +1,385 @@
+""" Write ahead journal keeping a vending machine's coin state across restarts
+
+Every request that changes a machine appends one json line holding the
+change in each coin quantity, the change in stock of any product sold, the
+new deposit total and the new credit of the session it used, if any.
+Lines are flushed to the OS on every append, so they survive the process
+dying, and fsynced to disk in batches of fsync_batch lines or every
+fsync_interval seconds. A timer syncs lines still waiting once
+fsync_interval has passed, so the end of a burst reaches disk without
+waiting for the next request.
+
+With group_commit set a request is only acknowledged once its line is on
+disk. A committer thread syncs for every waiting request, first waiting up
+to fsync_interval seconds, or until fsync_batch lines are pending, for
+requests still writing to join before a single fsync covers them all. With
+no other request writing it syncs straight away, so a lone client does not
+pay for the window. Requests on the asyncio server wait on the event loop
+rather than holding a thread.
+
+Every snapshot_every lines a compact snapshot of the whole state is written
+and the journal is emptied, so recovery only replays the lines written
+since the last snapshot however long the machine has been running.
+
+    <directory>/<machine_id>.journal
+    <directory>/<machine_id>.snapshot
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from VendingMachineDir.CoinInventory import CoinInventory
+
+
+class TransactionJournal:
+    def __init__(self, directory, machine_id, fsync_batch=32, fsync_interval=0.005, snapshot_every=1000,
+                 group_commit=False):
+        """
+
+        :param directory:       str     : Directory holding journal and snapshot files
+        :param machine_id:      str     : Id of the machine, used for the file names
+        :param fsync_batch:     int     : Lines written before forcing them to disk
+        :param fsync_interval:  float   : Seconds before forcing lines to disk, or the group commit window
+        :param snapshot_every:  int     : Lines written before taking a snapshot
+        :param group_commit:    Boolean : Acknowledge requests only once their line is on disk
+        """
+        self.journal_path = os.path.join(directory, f"{machine_id}.journal")
+        self.snapshot_path = os.path.join(directory, f"{machine_id}.snapshot")
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.group_commit = group_commit
+
+        # Sequence number of the last line written, and of the last line on disk
+        self.seq = 0
+        self.durable_seq = 0
+        self._since_snapshot = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._file = None
+        # Timer syncing lines left waiting after an append, None while nothing is waiting on it
+        self._flush_timer = None
+
+        # Guards writes to the journal file
+        self._io_lock = threading.Lock()
+        # Held while syncing or snapshotting, so the file is not swapped during an fsync
+        self._sync_lock = threading.Lock()
+        # Signals the group commit thread and its waiters
+        self._commit = threading.Condition()
+        # Requests between begin_write and end_write, that a commit can wait for
+        self._writing = 0
+        # Highest sequence number a request is waiting to see on disk
+        self._wanted_seq = 0
+        # (seq, loop, future) for requests waiting on an event loop
+        self._async_waiters = []
+        # Thread running group commits, started on the first wait
+        self._committer = None
+        self._closed = False
+
+        os.makedirs(directory, exist_ok=True)
+
+    def recover(self, machine):
+        """
+        Load the last snapshot and replay the journal lines written after it
+        Opens the journal for appending once done
+
+        :param machine:     VendingMachine  : Machine to restore, its coin layout is kept
+        :return:            int             : Number of journal lines replayed
+        """
+        coins = machine.current_coins.copy()
+        products = machine.products.copy()
+        deposit_total = machine.user_deposited_total
+        # (credit, coins) by token, sessions without credit are not kept
+        sessions = {}
+        snapshot_seq = 0
+
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, "r") as infile:
+                snapshot = json.load(infile)
+            snapshot_seq = snapshot["seq"]
+            coins = CoinInventory.from_dict(snapshot["coins"], coins.layout)
+            deposit_total = snapshot["deposit_total"]
+            for slot, quantity in snapshot.get("stock", {}).items():
+                # Slots no longer in the catalog are dropped
+                if slot in products:
+                    products.set_quantity(slot, quantity)
+            for token, session in snapshot.get("sessions", {}).items():
+                sessions[token] = session
+        self.seq = snapshot_seq
+        self.durable_seq = snapshot_seq
+
+        replayed = 0
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, "r") as infile:
+                for line in infile:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn last line from a crash part way through a write
+                        logging.warning(f"Ignoring incomplete line at end of {self.journal_path}")
+                        break
+                    if record["seq"] <= snapshot_seq:
+                        continue
+                    for coin, delta in record["coins"].items():
+                        coins[int(coin)] += delta
+                    for slot, delta in record.get("stock", {}).items():
+                        if slot in products:
+                            products.set_quantity(slot, products.quantity(slot) + delta)
+                    deposit_total = record["deposit_total"]
+                    session = record.get("session")
+                    if session is not None:
+                        if session["credit"]:
+                            sessions[session["token"]] = session
+                        else:
+                            sessions.pop(session["token"], None)
+                    self.seq = self.durable_seq = record["seq"]
+                    replayed += 1
+
+        machine.set_quantities(coins)
+        machine.products = products
+        machine.user_deposited_total = deposit_total
+        for token, session in sessions.items():
+            machine.sessions.restore(token, session["credit"],
+                                     {int(coin): quantity for coin, quantity in session["coins"].items()})
+
+        self._since_snapshot = replayed
+        self._file = open(self.journal_path, "a")
+        if os.path.getsize(self.journal_path):
+            # Fold the replayed lines, and any torn line, into a fresh snapshot
+            self.write_snapshot(machine)
+        return replayed
+
+    def record(self, before, machine, action, token=None, session_before=(0, {})):
+        """
+        Append the change a request made to a machine
+
+        :param before:          tuple           : machine.snapshot() taken before the request
+        :param machine:         VendingMachine  : Machine after the request
+        :param action:          str             : Name of the request, e.g. deposit / purchase / batch
+        :param token:           str             : Session the request sent, None without one
+        :param session_before:  tuple           : machine.sessions.state(token) taken before the request
+        :return:                int             : Sequence number of the line, None if nothing changed
+        """
+        coins_before, _, deposit_before, quantities_before, _ = before
+        coins = {}
+        for coin, old, new in zip(machine.current_coins.layout.coins, coins_before, machine.current_coins.counts):
+            if new != old:
+                coins[coin] = new - old
+        stock = {}
+        if quantities_before != machine.products.quantities:
+            for slot, product in machine.products.products.items():
+                delta = machine.products.quantities[product.index] - quantities_before[product.index]
+                if delta:
+                    stock[slot] = delta
+        session = machine.sessions.state(token)
+        if not coins and not stock and deposit_before == machine.user_deposited_total and session == session_before:
+            return None
+
+        line = {"seq": 0, "op": action, "coins": coins, "deposit_total": machine.user_deposited_total}
+        if stock:
+            line["stock"] = stock
+        if session != session_before:
+            line["session"] = {"token": token, "credit": session[0], "coins": session[1]}
+        with self._io_lock:
+            self.seq += 1
+            seq = line["seq"] = self.seq
+            self._file.write(json.dumps(line, separators=(",", ":")) + "\n")
+            self._file.flush()
+            self._unsynced += 1
+            self._since_snapshot += 1
+
+        if self._since_snapshot >= self.snapshot_every:
+            self.write_snapshot(machine)
+        elif self.group_commit:
+            if self._unsynced >= self.fsync_batch:
+                # Batch is full, cut the leader's window short
+                with self._commit:
+                    self._commit.notify_all()
+        elif self._unsynced >= self.fsync_batch or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+        else:
+            self._schedule_flush()
+        return seq
+
+    def _schedule_flush(self):
+        """
+        Start a timer to sync the lines waiting once fsync_interval passes, unless one is running
+        """
+        with self._io_lock:
+            if self._flush_timer is not None or self._file is None:
+                return
+            self._flush_timer = threading.Timer(self.fsync_interval, self._flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _flush(self):
+        with self._io_lock:
+            self._flush_timer = None
+        self.sync()
+
+    def begin_write(self):
+        """
+        Mark a request about to change the machine, a group commit waits for it to join
+        Each call is matched by end_write once the request's line is written, or it made no change
+        """
+        if self.group_commit:
+            with self._commit:
+                self._writing += 1
+
+    def end_write(self):
+        if self.group_commit:
+            with self._commit:
+                self._writing -= 1
+                if not self._writing:
+                    # Nothing left to join, cut the commit window short
+                    self._commit.notify_all()
+
+    def wait_durable(self, seq):
+        """
+        Block until a line is on disk, when group_commit is set
+        Call without holding the machine's lock, so other requests can join the commit
+
+        :param seq:     int     : Sequence number returned from record(), None returns straight away
+        """
+        if not self.group_commit or seq is None:
+            return
+        with self._commit:
+            self._want(seq)
+            while self.durable_seq < seq and not self._closed:
+                self._commit.wait()
+
+    async def wait_durable_async(self, seq):
+        """
+        As wait_durable, waiting on the running event loop rather than blocking a thread
+
+        :param seq:     int     : Sequence number returned from record(), None returns straight away
+        """
+        if not self.group_commit or seq is None:
+            return
+        # Only used by the asyncio server, which has already imported it
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._commit:
+            if self.durable_seq >= seq or self._closed:
+                return
+            self._async_waiters.append((seq, loop, future))
+            self._want(seq)
+        await future
+
+    def _want(self, seq):
+        """
+        Ask the committer thread to sync up to seq, starting it if needed
+        Called holding _commit
+        """
+        self._wanted_seq = max(self._wanted_seq, seq)
+        if self._committer is None:
+            self._committer = threading.Thread(target=self._run_committer, name="group-commit", daemon=True)
+            self._committer.start()
+        self._commit.notify_all()
+
+    def _run_committer(self):
+        while True:
+            with self._commit:
+                while self.durable_seq >= self._wanted_seq and not self._closed:
+                    self._commit.wait()
+                if self._closed:
+                    return
+                # Give requests still writing the window to join this commit
+                self._commit.wait_for(lambda: self._closed or not self._writing
+                                      or self._unsynced >= self.fsync_batch, timeout=self.fsync_interval)
+            self.sync()
+            with self._commit:
+                self._wake_waiters()
+
+    def _wake_waiters(self):
+        """
+        Release every waiter whose line is on disk, called holding _commit
+        """
+        self._commit.notify_all()
+        waiting = []
+        for seq, loop, future in self._async_waiters:
+            if seq <= self.durable_seq or self._closed:
+                try:
+                    loop.call_soon_threadsafe(_set_done, future)
+                except RuntimeError:
+                    # Event loop already closed
+                    pass
+            else:
+                waiting.append((seq, loop, future))
+        self._async_waiters = waiting
+
+    def sync(self):
+        """
+        Force every line written so far on to disk
+        """
+        with self._sync_lock:
+            with self._io_lock:
+                if self._file is None or not self._unsynced:
+                    return
+                self._file.flush()
+                # Lines written while the fsync runs wait for the next one
+                target = self.seq
+                self._unsynced = 0
+            os.fsync(self._file.fileno())
+            self._last_sync = time.monotonic()
+            self.durable_seq = target
+
+    def write_snapshot(self, machine):
+        """
+        Write the machine's full state then empty the journal
+
+        The snapshot is written to a temporary file and renamed over the old
+        one, so a crash leaves either the old or the new snapshot in place
+
+        :param machine: VendingMachine  : Machine to snapshot
+        """
+        with self._sync_lock, self._io_lock:
+            temp_path = self.snapshot_path + ".tmp"
+            with open(temp_path, "w") as outfile:
+                sessions = {session.token: {"credit": session.credit, "coins": session.coins}
+                            for session in machine.sessions.sessions.values() if session.credit}
+                json.dump({"seq": self.seq, "coins": machine.current_coins.to_dict(),
+                           "deposit_total": machine.user_deposited_total, "stock": machine.products.stock(),
+                           "sessions": sessions},
+                          outfile, separators=(",", ":"))
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(temp_path, self.snapshot_path)
+
+            # Lines up to seq are now in the snapshot
+            self._file.close()
+            self._file = open(self.journal_path, "w")
+            os.fsync(self._file.fileno())
+            self._since_snapshot = 0
+            self._unsynced = 0
+            self._last_sync = time.monotonic()
+            self.durable_seq = self.seq
+
+    def close(self):
+        with self._io_lock:
+            timer, self._flush_timer = self._flush_timer, None
+        if timer is not None:
+            timer.cancel()
+        if self._file is not None:
+            self.sync()
+        # Every line is on disk, so waiters released by closing have what they waited for
+        with self._commit:
+            self._closed = True
+            self._wake_waiters()
+        if self._committer is not None:
+            self._committer.join()
+        if self._file is not None:
+            # Under both locks, so a timer already running sees the file closed
+            with self._sync_lock, self._io_lock:
+                self._file.close()
+                self._file = None
+
+
+def _set_done(future):
+    # Run on the waiter's event loop, the request may have been cancelled meanwhile
+    if not future.done():
+        future.set_result(None)
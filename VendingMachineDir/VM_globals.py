@@ -11,6 +11,8 @@ class Globals:
     # Static references to objects
     v_machine = None
     server = None
+    # MachineRegistry of machines addressed by 'machine_id'
+    machines = None
 
     # Program variables
     running = False
@@ -5,43 +5,76 @@ If no arguments passed, assume 'default state' on startup
 Written : 23/04
 Author  : Matthew Holsey
 """
-import math
+import threading
+from collections import deque
+
+from VendingMachineDir.CoinInventory import GBP_LAYOUT, CoinInventory
+from VendingMachineDir.ProductCatalog import ProductCatalog
+from VendingMachineDir.SessionTable import SessionTable
+
+# Coin count used in the change tables for amounts that cannot be made
+NO_CHANGE = float("inf")
 
 
 class VendingMachine:
+    # Debug mode - Check the running change total against a full recount after every change
+    check_consistency = False
 
-    def __init__(self, state=None):
+    def __init__(self, state=None, layout=GBP_LAYOUT):
         """
 
-        :param state:   Dict[ str, str ]     : Containing dictionary of coins and quantity
+        :param state:   Dict[ int, int ]     : Containing dictionary of coins and quantity
+        :param layout:  CoinLayout           : Coins the machine takes, GBP if not passed
         """
 
-        # Default state - Each (GBP) coin issued quantity of 5
-        self.default_state = {1: 5, 2: 5, 5: 5, 10: 5, 20: 5, 50: 5, 100: 5, 200: 5}
+        # Default state - Each coin issued quantity of 5
+        self.default_state = CoinInventory(layout, [5] * len(layout.coins))
         if state:
-            self.default_state = state
+            self.default_state = self._to_inventory(state, layout)
 
         # Assign current coins to default at startup
         self.current_coins = self.default_state.copy()
+        # Value of coins held, kept up to date by every method changing current_coins
         self.current_change_total = self.calc_current_change_total()
 
         # Storing total user deposit for purchase ( e.g. multiple deposits )
+        # Requests sent with a 'session' token use that session's credit instead
         self.user_deposited_total = 0
+        # Coins making up the deposit total, handed back first by a refund
+        self.user_deposited_coins = {}
+        # Open sessions, each with its own credit
+        self.sessions = SessionTable()
+
+        # Products sold by slot id, empty unless loaded with --product_file
+        self.products = ProductCatalog()
+
+        # Sorted coin_names, shared with every machine using the same coins
+        self.coin_names = self.default_state.layout.coins
+        # Set of the same coins, deposits are checked against it
+        self.valid_coins = self.default_state.layout.valid
+        # Order the change tables are built in, smallest coin first
+        self.coin_order = self.coin_names
 
-        # List of coin_names
-        self.coin_names = [1, 2, 5, 10, 20, 50, 100, 200]
-        self.coin_names.sort()
+        # Largest amount (in pence) tracked by the reachable change bitset and the change tables,
+        # change above it is paid in the largest coins first
+        self.change_cap = 2000
+        # Bit n set if n pence can be made from the coins held, None until first used
+        # Adding coins updates it in place, taking coins out clears it to be rebuilt
+        self._reachable = None
+
+        # Serialises coin state changes between concurrent connections
+        self.lock = threading.Lock()
+        # TransactionJournal recording changes made by requests, None if not persisted
+        self.journal = None
 
     def calc_current_change_total(self):
         """
         Returning value of all of the coins left in the vending machine
+        Full recount - current_change_total holds the same value kept up to date
 
         :return: int    : Value of all
         """
-        ret_value = 0
-        for key in self.current_coins:
-            ret_value += int(self.current_coins[key]) * int(key)
-        return ret_value
+        return self.current_coins.total()
 
     # Return current quantity of coins held
     def return_current_quantities(self):
@@ -49,7 +82,20 @@ class VendingMachine:
 
     # Set new quantity of coins held
     def set_quantities(self, state):
-        self.current_coins = state
+        self.current_coins = self._to_inventory(state, self.default_state.layout)
+        self.current_change_total = self.calc_current_change_total()
+        self._reachable = None
+
+    @staticmethod
+    def _to_inventory(state, layout):
+        """
+        :param state:   Dict{int, int} or CoinInventory : Coin quantities
+        :param layout:  CoinLayout                      : Coins the machine holds
+        :return:        CoinInventory                   : Copy of the quantities
+        """
+        if isinstance(state, CoinInventory):
+            return state.copy()
+        return CoinInventory.from_dict(state, layout)
 
     def add_coins(self, user_deposited):
         """
@@ -58,43 +104,257 @@ class VendingMachine:
         :param user_deposited: Dict{int, int}   : Dictionary of coins deposited
         :return: N/A
         """
-        for key, val in user_deposited:
+        for key, val in user_deposited.items():
             self.current_coins[key] += val
+            self.current_change_total += key * val
+            if self._reachable is not None:
+                if val >= 0:
+                    self._reachable = self._add_to_reachable(self._reachable, key, val)
+                else:
+                    self._reachable = None
+        self._check_change_total()
 
     def reset_coins_to_default(self):
-        self.current_coins = self.default_state.copy()
+        self.set_quantities(self.default_state.copy())
+
+    def snapshot(self):
+        """
+        Copy of the coin and product state, used to roll back a failed batch
+
+        :return: tuple  : (current coins, change total, user deposited total, product quantities,
+                           user deposited coins)
+        """
+        return (self.current_coins.snapshot(), self.current_change_total, self.user_deposited_total,
+                self.products.snapshot(), dict(self.user_deposited_coins))
+
+    def restore(self, snapshot):
+        """
+        Return coin state to a snapshot taken earlier
+
+        :param snapshot: tuple  : Value returned from snapshot()
+        """
+        coins, change_total, deposited_total, quantities, deposited_coins = snapshot
+        self.current_coins.restore(coins)
+        self.current_change_total = change_total
+        self.user_deposited_total = deposited_total
+        self.user_deposited_coins = dict(deposited_coins)
+        self.products.restore(quantities)
+        self._reachable = None
+        self._check_change_total()
+
+    def _check_change_total(self):
+        """
+        Debug mode only - compare the running change total with a full recount
+
+        :raises RuntimeError    : Running total has drifted from the coins held
+        """
+        if self.check_consistency and self.current_change_total != self.calc_current_change_total():
+            raise RuntimeError(f"Change total {self.current_change_total} does not match coins held "
+                               f"{self.calc_current_change_total()}")
+        if self.check_consistency and self._reachable is not None:
+            reachable = self._reachable
+            self._reachable = None
+            if reachable != self.reachable_change():
+                raise RuntimeError("Reachable change bitset does not match coins held")
 
     # remove coins from quantity
     def subtract_value(self, product_value):
         """
-        Return correct change
+        Return correct change, using the fewest coins the current stock allows
+
+        Coins are only taken from the machine once the full amount is known
+        to be possible, otherwise the stock is left untouched
 
-        :param product_value: int                :   Value of product bought (in pence)
-        :return: ret_change : dict {int, int}    :   Coin names and values used
+        :param product_value: int                :   Value of change to give (in pence)
+        :return: ret_change : dict {int, int}    :   Coin names and values used, None if change cannot be made
         """
+        ret_change = self.find_change(product_value)
+        if ret_change is None:
+            return None
 
-        ret_change = {}
-        # Making sure biggest value coins are used first.
-        self.coin_names.sort(reverse=True)
-        for item in self.coin_names:
+        self._remove_coins(ret_change)
+        return ret_change
 
-            if (int(self.current_coins[item]) > 0) and (int(product_value) / int(self.current_coins[item]) > 0):
+    def refund(self, value, inserted):
+        """
+        Give back a credit, as the coins inserted where the machine still holds them,
+        with the change engine making up the rest
 
-                coin_quantity = math.floor(int(product_value) / int(item))
+        Coins are only taken from the machine once the full amount is known
+        to be possible, otherwise the stock is left untouched
 
-                # if there's not enough of this coin to take from, use as many as available
-                if 0 < int(self.current_coins[item]) < coin_quantity:
-                    coin_quantity = int(self.current_coins[item])
-                    self.current_coins[item] = 0
-                else:
-                    # Minus a coin from vending machine's coin stack
-                    self.current_coins[item] -= coin_quantity
+        :param value:       int             : Credit to give back (in pence)
+        :param inserted:    Dict{int, int}  : Coins deposited for the credit
+        :return:            Dict{int, int}  : Coins given back, None if the amount cannot be made
+        """
+        value = int(value)
+        taken = {}
+        remaining = value
+        for coin in sorted(inserted, reverse=True):
+            quantity = min(inserted[coin], self.current_coins.get(coin, 0), remaining // coin)
+            if quantity > 0:
+                taken[coin] = quantity
+                remaining -= coin * quantity
+        self._remove_coins(taken)
 
-                if coin_quantity > 0:
-                    # Add item to change
-                    ret_change[item] = coin_quantity
+        rest = self.subtract_value(remaining)
+        if rest is None:
+            # The remainder could not be made from what is left, give the coins back and start over
+            self.add_coins(taken)
+            return self.subtract_value(value)
+        for coin, quantity in rest.items():
+            taken[coin] = taken.get(coin, 0) + quantity
+        return taken
 
-                # Subtract coin value from remaining product value
-                product_value -= (int(item) * coin_quantity)
+    def _remove_coins(self, coins):
+        """
+        :param coins:   Dict{int, int}  : Coins to take out of the machine, all held
+        """
+        for coin, quantity in coins.items():
+            # Minus the coins from vending machine's coin stack
+            self.current_coins[coin] -= quantity
+            self.current_change_total -= coin * quantity
+        if coins:
+            self._reachable = None
+        self._check_change_total()
+
+    def reachable_change(self):
+        """
+        Amounts of change the coins held can make, up to change_cap
 
+        :return: int    : Bitset, bit n set if n pence can be made
+        """
+        if self._reachable is None:
+            reachable = 1
+            for coin, count in self.current_coins.items():
+                reachable = self._add_to_reachable(reachable, coin, count)
+            self._reachable = reachable
+        return self._reachable
+
+    def _add_to_reachable(self, reachable, coin, count):
+        """
+        :param reachable:   int     : Bitset of amounts that can be made
+        :param coin:        int     : Coin added
+        :param count:       int     : Quantity of the coin added
+        :return:            int     : Bitset of amounts that can be made with the coins added
+        """
+        mask = (1 << (self.change_cap + 1)) - 1
+        # Up to count coins as chunks of 1, 2, 4 ... so log(count) shifts rather than count
+        chunk = 1
+        while count > 0 and coin * chunk <= self.change_cap:
+            take = min(chunk, count)
+            reachable |= (reachable << (coin * take)) & mask
+            count -= take
+            chunk *= 2
+        return reachable
+
+    def can_make_change(self, value):
+        """
+        Check the coins held can make an amount exactly, without working out which coins
+
+        :param value:   int     : Value of change to give (in pence)
+        :return:        Boolean : True if the change can be made
+        """
+        value = int(value)
+        if value < 0:
+            return False
+        if value > self.change_cap:
+            return self.find_change(value) is not None
+        return (self.reachable_change() >> value) & 1 == 1
+
+    def exact_change_only(self):
+        """
+        :return: Boolean    : True if some amount below the largest coin cannot be given as change
+        """
+        limit = min(self.coin_names[-1] - 1, self.change_cap)
+        mask = (1 << (limit + 1)) - 1
+        return self.reachable_change() & mask != mask
+
+    def find_change(self, value):
+        """
+        Work out the change for a value without touching the stock
+
+        Bounded knapsack over the coins held, the largest coins are preferred
+        when two options use the same number of coins. The tables grow with
+        the amount, so change above change_cap is first paid in the largest
+        coins held until what is left is under the cap
+
+        :param value:   int                 : Value of change to give (in pence)
+        :return:        dict {int, int}     : Coins to give, None if change cannot be made
+        """
+        value = int(value)
+        if value < 0:
+            return None
+        if value == 0:
+            return {}
+
+        ret_change = {}
+        stock = self.current_coins
+        if value > self.change_cap:
+            stock = stock.copy()
+            # Leave at least a coin's worth under the cap, so the knapsack has room to make the rest
+            target = max(self.change_cap - self.coin_names[-1], 0)
+            for coin in reversed(self.coin_names):
+                quantity = min(max(stock[coin], 0), -(-(value - target) // coin), value // coin)
+                if quantity > 0:
+                    ret_change[coin] = quantity
+                    stock[coin] -= quantity
+                    value -= coin * quantity
+                if value <= target:
+                    break
+            if value > self.change_cap:
+                # Every coin held is still short of the amount
+                return None
+            if value == 0:
+                return ret_change
+
+        best, used = self._change_tables(stock, value)
+        if best[value] == NO_CHANGE:
+            return None
+
+        for stage in range(len(self.coin_order) - 1, -1, -1):
+            quantity = used[stage][value]
+            if quantity:
+                coin = self.coin_order[stage]
+                ret_change[coin] = ret_change.get(coin, 0) + quantity
+                value -= coin * quantity
         return ret_change
+
+    def _change_tables(self, stock, value):
+        """
+        Fewest coins for every amount up to value
+
+        Each coin's pass keeps a sliding window minimum per remainder of the
+        coin value, so building the tables is O(value x denominations).
+        find_change keeps value at most change_cap
+
+        :param stock:   CoinInventory   : Coins held
+        :param value:   int             : Largest amount needed
+        :return:        tuple           : (fewest coins per amount, coins of each stage used per amount)
+        """
+        best = [0] + [NO_CHANGE] * value
+        used = []
+        for coin, count in stock.items():
+            # A negative count holds no coins
+            count = max(count, 0)
+            stage_best = [NO_CHANGE] * (value + 1)
+            stage_used = [0] * (value + 1)
+            for remainder in range(min(coin, value + 1)):
+                # Entries (step, coins needed before this stage - step), lowest first
+                window = deque()
+                for step, amount in enumerate(range(remainder, value + 1, coin)):
+                    if best[amount] != NO_CHANGE:
+                        needed = best[amount] - step
+                        # Strictly greater, so ties keep the older entry and use more of this coin
+                        while window and window[-1][1] > needed:
+                            window.pop()
+                        window.append((step, needed))
+                    while window and window[0][0] < step - count:
+                        window.popleft()
+                    if window:
+                        start, needed = window[0]
+                        stage_best[amount] = needed + step
+                        stage_used[amount] = step - start
+            best = stage_best
+            used.append(stage_used)
+        return best, used
@@ -1,53 +1,275 @@
 """Main entry point for python program
 
+Only argparse is imported up front. The machines, the server and optional
+subsystems (asyncio, journal, state loading) are imported once the arguments
+show they are needed, keeping start-up fast under process supervisors.
+
 Written : 23/04
 Author  : Matthew Holsey
 """
-
-
+import signal
+import sys
 from argparse import ArgumentParser
 from argparse import RawDescriptionHelpFormatter
 
-from VendingMachineDir.VendingMachine import VendingMachine
 from VendingMachineDir.VM_globals import Globals
-from Server.server_handler import Server
-from ArgHandler import ArgHandler
 
 
-def program_init():
+def program_init(use_async=False, machine_count=0, auto_create=False, worker=0, worker_count=1, layout=None):
     """
     Function to initiate global / program variables
+
+    :param use_async: Boolean       : Serve connections concurrently with asyncio
+    :param machine_count: int       : Extra machines to create, with ids "1" to "<machine_count>"
+    :param auto_create: Boolean     : Create machines for unknown 'machine_id' values
+    :param worker: int              : Index of this worker process, only its machines are created
+    :param worker_count: int        : Worker processes sharing the machines
+    :param layout: CoinLayout       : Coins every machine takes, GBP if not passed
     """
+    from VendingMachineDir.CoinInventory import GBP_LAYOUT
+    from VendingMachineDir.VendingMachine import VendingMachine
+    from VendingMachineDir.MachineRegistry import MachineRegistry
+
+    layout = layout or GBP_LAYOUT
     # Create a VEnding machine instance - global
-    Globals.v_machine = VendingMachine()
-    # Create a Server handler - Global
-    Globals.server = Server()
+    Globals.v_machine = VendingMachine(layout=layout)
+    # Every machine served by this process, including the default
+    Globals.machines = MachineRegistry(auto_create, layout)
+    Globals.machines.worker_index = worker
+    Globals.machines.worker_count = worker_count
+    if Globals.machines.owns(MachineRegistry.DEFAULT_ID):
+        Globals.machines.add(MachineRegistry.DEFAULT_ID, Globals.v_machine)
+    for machine_id in range(1, machine_count + 1):
+        if Globals.machines.owns(str(machine_id)):
+            Globals.machines.create(str(machine_id))
+    # Create a Server handler - Global, asyncio is only imported when used
+    if use_async:
+        from Server.async_server import AsyncServer
+        Globals.server = AsyncServer()
+    else:
+        from Server.server_handler import Server
+        Globals.server = Server()
     # Set the running glad to true
     Globals.running = True
 
 
-if __name__ == '__main__':
-    """entry point"""
-    parser = ArgumentParser(prog='PROG', formatter_class=RawDescriptionHelpFormatter)
+def check_state(state_file, currency="GBP"):
+    """
+    Validate a state file without starting the server
+
+    :param state_file:  str     : State file to check
+    :param currency:    str     : Denomination profile the machines take, see --currency
+    :return:            int     : Exit code, 0 if the file loaded without errors
+    """
+    from VendingMachineDir.CoinInventory import load_layout
+    from VendingMachineDir.StateLoader import load_state_file
+
+    try:
+        result = load_state_file(state_file, load_layout(currency))
+    except OSError as err:
+        print(f"Could not read state file : {err}")
+        return 2
+    except ValueError as err:
+        print(f"Invalid currency : {err}")
+        return 2
+
+    for line in result.summary():
+        print(line)
+    print(f"{state_file} : {result.format}, {len(result.machines)} machines, {result.error_count()} errors")
+    return 1 if result.errors else 0
+
+
+def enable_profiling(profile_dir, seconds):
+    """
+    Allow the sampling profiler to be started by api request, or by SIGUSR1 for a set time
+
+    :param profile_dir: str     : Directory for collapsed stack files
+    :param seconds:     float   : Seconds sampled after SIGUSR1
+    """
+    from Server.profiler import SamplingProfiler
+
+    Globals.server.profiler = SamplingProfiler(profile_dir)
+
+    def on_signal(signum, frame):
+        path = Globals.server.profiler.start(seconds)
+        if path:
+            print(f"Profiling for {seconds} seconds, writing {path}")
+
+    # Not available on Windows
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, on_signal)
+
 
+def build_parser():
+    """
+    :return: ArgumentParser : Parser for the program arguments
+    """
+    parser = ArgumentParser(prog='PROG', formatter_class=RawDescriptionHelpFormatter)
     parser.add_argument("-sf", "--state_file",
                         help="Set state as csv formatted file", metavar="<FILE>")
 
+    parser.add_argument("-cu", "--currency", default="GBP",
+                        help="Coins the machines take, GBP, EUR, USD, a list like 'TOKENS:1,5,25' or a json "
+                             "profile file", metavar="<PROFILE>")
+
+    parser.add_argument("-pf", "--product_file",
+                        help="Products sold by slot id, as a json file", metavar="<FILE>")
+
+    parser.add_argument("-cs", "--check_state",
+                        help="Validate a state file then exit, without starting the server", metavar="<FILE>")
+
+    parser.add_argument("-as", "--async_server", action="store_true",
+                        help="Serve many connections concurrently using asyncio")
+
+    parser.add_argument("-p", "--port", type=int, default=22222,
+                        help="TCP port to listen on", metavar="<PORT>")
+
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Worker processes sharing the port, each owning a share of the machines, "
+                             "uses the asyncio server", metavar="<N>")
+
+    parser.add_argument("-wp", "--worker_port", type=int,
+                        help="Private port of worker 0 for requests forwarded between workers, worker n "
+                             "uses <PORT> + n, default --port + 1", metavar="<PORT>")
+
+    parser.add_argument("-m", "--machines", type=int, default=0,
+                        help="Extra machines to serve, addressed by 'machine_id' \"1\" to \"N\"", metavar="<N>")
+
+    parser.add_argument("-ac", "--auto_create_machines", action="store_true",
+                        help="Create a machine for any unknown 'machine_id'")
+
+    parser.add_argument("-jd", "--journal_dir",
+                        help="Keep coin state across restarts in journal files in this directory", metavar="<DIR>")
+
+    parser.add_argument("-du", "--durability", choices=("batch", "group"), default="batch",
+                        help="With --journal_dir, 'batch' answers once a change is written and syncs to disk "
+                             "in the background, 'group' answers once the change is synced to disk")
+
+    parser.add_argument("-cw", "--commit_window", type=float, default=5,
+                        help="Milliseconds to gather journal lines into one disk sync", metavar="<MS>")
+
+    parser.add_argument("-cb", "--commit_batch", type=int, default=32,
+                        help="Journal lines that trigger a disk sync without waiting for the window",
+                        metavar="<LINES>")
+
+    parser.add_argument("-ht", "--header_timeout", type=float, default=5,
+                        help="Seconds a new connection has to start its request", metavar="<SECONDS>")
+
+    parser.add_argument("-it", "--idle_timeout", type=float, default=2,
+                        help="Seconds allowed between bytes of a request", metavar="<SECONDS>")
+
+    parser.add_argument("-rt", "--request_timeout", type=float, default=5,
+                        help="Seconds allowed to send a whole request, or to read a response",
+                        metavar="<SECONDS>")
+
+    parser.add_argument("-st", "--session_ttl", type=float, default=300,
+                        help="Seconds a session and its credit last without being used", metavar="<SECONDS>")
+
+    parser.add_argument("-mf", "--max_frame_size", type=int, default=1024 * 1024,
+                        help="Largest request accepted, in bytes", metavar="<BYTES>")
+
+    parser.add_argument("-fm", "--format", default="json",
+                        help="Default response format, e.g. json, compact, binary", metavar="<FORMAT>")
+
+    parser.add_argument("-mp", "--metrics_port", type=int,
+                        help="Serve Prometheus text metrics on http://127.0.0.1:<PORT>/metrics", metavar="<PORT>")
+
+    parser.add_argument("-pd", "--profile_dir",
+                        help="Allow the sampling profiler to be started at runtime, writing to this directory",
+                        metavar="<DIR>")
+
+    parser.add_argument("-ps", "--profile_seconds", type=float, default=10,
+                        help="Seconds to profile for on SIGUSR1", metavar="<SECONDS>")
+
+    parser.add_argument("-cc", "--check_consistency", action="store_true",
+                        help="Debug - recount the machine's change total after every change")
+
     # parser.add_argument("-dr", "--display_response",
     #                     help="Display list of possible responses")
+    return parser
+
 
-    args = parser.parse_args()
+def main(argv=None):
+    """
+    :param argv:    list    : Program arguments, sys.argv if not passed
+    :return:        int     : Exit code
+    """
+    args = build_parser().parse_args(argv)
+
+    if args.check_state:
+        return check_state(args.check_state, args.currency)
+
+    from VendingMachineDir.CoinInventory import load_layout
+
+    try:
+        layout = load_layout(args.currency)
+    except (OSError, ValueError) as err:
+        print(f"Invalid currency : {err}")
+        return 2
+
+    if args.workers > 1:
+        from Server.workers import run_workers, supported
+
+        if not supported():
+            print("--workers needs fork and SO_REUSEPORT, not available on this platform")
+            return 2
+        return run_workers(args.workers, lambda index: serve(args, layout, index, args.workers))
+    return serve(args, layout)
+
+
+def serve(args, layout, worker=0, worker_count=1):
+    """
+    Set up the machines and server from the program arguments, then serve until stopped
+
+    :param args:            Namespace   : Parsed program arguments
+    :param layout:          CoinLayout  : Coins the machines take
+    :param worker:          int         : Index of this worker process
+    :param worker_count:    int         : Worker processes sharing the port
+    :return:                int         : Exit code
+    """
+    from VendingMachineDir.SessionTable import SessionTable
+    from VendingMachineDir.VendingMachine import VendingMachine
+    from Server.encoders import get_encoder
+    from ArgHandler import ArgHandler
+
+    VendingMachine.check_consistency = args.check_consistency
+    SessionTable.ttl = args.session_ttl
 
     # Setup program objects
-    program_init()
+    program_init(args.async_server or worker_count > 1, args.machines, args.auto_create_machines,
+                 worker, worker_count, layout)
+    Globals.server.tcp_port = args.port
+    Globals.server.max_frame_size = args.max_frame_size
+    Globals.server.timeout = args.header_timeout
+    Globals.server.idle_timeout = args.idle_timeout
+    Globals.server.request_timeout = args.request_timeout
+    Globals.server.encoder = get_encoder(args.format)
+    Globals.server.metrics_port = args.metrics_port
+    if worker_count > 1:
+        from Server.workers import WorkerRouter
+
+        Globals.server.router = WorkerRouter(worker, worker_count,
+                                             args.worker_port if args.worker_port else args.port + 1,
+                                             max_frame_size=args.max_frame_size)
+        if args.metrics_port is not None:
+            # One endpoint per worker
+            Globals.server.metrics_port = args.metrics_port + worker
+    if args.profile_dir:
+        enable_profiling(args.profile_dir, args.profile_seconds)
 
     # Handle program arguments
     x = ArgHandler()
     x.parse_args(args)
 
     # start listening for messages
-    Globals.server.init_server()
-
-
+    try:
+        Globals.server.init_server()
+    finally:
+        # Force any journal lines not yet synced on to disk
+        Globals.machines.close()
+    return 0
 
 
+if __name__ == '__main__':
+    """entry point"""
+    sys.exit(main())